@@ -2,6 +2,8 @@
 ASGI config for CLINIC project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+The schedule event stream (/api/schedule/stream/) needs an ASGI server, e.g.
+``uvicorn CLINIC.asgi:application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
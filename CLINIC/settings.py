@@ -14,6 +14,7 @@ from pathlib import Path
 
 import config
 import os
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -80,6 +81,32 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # BEGIN IMMEDIATE для всех транзакций — осознанный глобальный компромисс.
+            # Запись на приём (app.booking) сериализуется на уровне БД, а транзакции
+            # «прочитал, потом записал» (итоги счетов, сводки статистики) не падают с
+            # «database is locked» при повышении блокировки. Цена: любой atomic(), даже
+            # только читающий, ждёт блокировку записи (до timeout секунд).
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+        # Файловая тестовая БД (in-memory SQLite с общим кэшем не поддерживает конкурентную
+        # запись из потоков) — во временном каталоге, а не в корне репозитория
+        'TEST': {
+            'NAME': Path(tempfile.gettempdir()) / 'clinic_test_db.sqlite3',
+        },
+    }
+}
+
+# Кэш статистики (app/stats_cache.py). При нескольких воркерах нужен общий кэш
+# (django.core.cache.backends.redis.RedisCache), иначе сброс по записи виден только своему процессу
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            # Метки дней: многолетний диапазон статистики — тысячи ключей
+            'MAX_ENTRIES': 20000,
+        },
     }
 }
 
@@ -118,12 +145,59 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 # когда будут добавляться фото пациентов/врачей
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Каталоги MEDIA_ROOT, которые не раздаются по MEDIA_URL: файлы документов (documents/, blobs/ —
+# хранилище по хэшу) и части загрузок (uploads/) выдаются только после проверки прав (app/downloads.py).
+# В продакшене веб-сервер тоже не должен отдавать их из location MEDIA_URL
+PRIVATE_MEDIA_DIRS = ('documents', 'blobs', 'uploads')
 
 # Для входа/выхода
 LOGIN_URL = 'login/'
 LOGIN_REDIRECT_URL = '/dashboard/'
 LOGOUT_REDIRECT_URL = '/'
 
+# Рабочие часы клиники (начало, конец) — сетка свободных слотов
+CLINIC_WORKDAY_HOURS = (9, 21)
+
+# Поток изменений расписания (SSE, /api/schedule/stream/):
+# 'memory' — один процесс ASGI; 'poll' — несколько воркеров, опрос БД раз в POLL_SECONDS
+SCHEDULE_STREAM_MODE = 'memory'
+SCHEDULE_STREAM_POLL_SECONDS = 3
+# Окно перекрытия опроса: изменение, зафиксированное позже своего updated_at больше чем
+# на столько секунд (долгая транзакция, расхождение часов воркеров), опрос может пропустить
+SCHEDULE_STREAM_POLL_GRACE_SECONDS = 30
+SCHEDULE_STREAM_HEARTBEAT_SECONDS = 15
+
+# Статистика за диапазон, включающий сегодня, кэшируется на STATS_CACHE_TODAY_SECONDS;
+# закрытые периоды — бессрочно (до изменения записей или счетов за эти дни)
+STATS_CACHE_TODAY_SECONDS = 60
+STATS_CACHE_LOCK_SECONDS = 30
+
+# Шапка страниц (app/counters.py): ClinicInfo в памяти процесса и счётчики дашборда
+CLINIC_INFO_CACHE_SECONDS = 300
+COUNTERS_CACHE_SECONDS = 60
+
+# Кодировщик JSON ответов API (app/serializers.py): путь к функции data -> bytes.
+# None — orjson, если установлен, иначе стандартный json
+API_JSON_ENCODER = None
+
+# Максимум записей в одном запросе /api/appointments/bulk-status/
+APPOINTMENTS_BULK_LIMIT = 1000
+
+# Загрузка документов частями (app/uploads.py). Части пишутся в UPLOAD_PARTS_DIR — на той же
+# файловой системе, что MEDIA_ROOT: готовый файл переносится в хранилище переименованием
+UPLOAD_PARTS_DIR = os.path.join(MEDIA_ROOT, 'uploads')
+UPLOAD_MAX_BYTES = 4 * 1024 ** 3
+UPLOAD_CHUNK_MAX_BYTES = 64 * 1024 ** 2
+UPLOAD_BUFFER_BYTES = 1024 ** 2
+# Незавершённые и неприкреплённые загрузки старше этого срока удаляет команда expire_uploads
+UPLOAD_EXPIRE_HOURS = 24
+
+# Выдача файлов документов (app/downloads.py): None — FileResponse из Django;
+# 'x-accel' — nginx: X-Accel-Redirect на internal-location DOCUMENT_ACCEL_PREFIX (alias на MEDIA_ROOT);
+# 'x-sendfile' — Apache mod_xsendfile / lighttpd: X-Sendfile с путём к файлу
+DOCUMENT_DOWNLOAD_MODE = None
+DOCUMENT_ACCEL_PREFIX = '/protected-media/'
+
 # Custom User Model
 AUTH_USER_MODEL = 'app.User'
 
@@ -1,9 +1,10 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
 from django import forms
-from django.db.models import F, Sum
 from django.core.exceptions import ValidationError
+from .booking import doctor_day_lock
+from .events import broker
 from .models import (
     User,
     Patient,
@@ -16,6 +17,7 @@ from .models import (
     InvoiceService,
     ClinicInfo,
 )
+from .transitions import bulk_change_status
 
 
 # Проверка доступа к админке
@@ -332,6 +334,7 @@ class AppointmentAdmin(admin.ModelAdmin):
     list_filter = ['status', 'doctor', 'date_time']
     search_fields = ['patient__last_name', 'patient__first_name', 'doctor__user__last_name']
     readonly_fields = ['created_at', 'updated_at', 'get_time_slot']
+    autocomplete_fields = ['services']
     date_hierarchy = 'date_time'
     list_per_page = 20
     list_select_related = ('patient', 'doctor', 'doctor__user')
@@ -343,7 +346,7 @@ class AppointmentAdmin(admin.ModelAdmin):
             'fields': ('patient', 'doctor', 'date_time', 'duration', 'status')
         }),
         ('Информация о приеме', {
-            'fields': ('reason', 'diagnosis', 'treatment', 'notes')
+            'fields': ('reason', 'diagnosis', 'treatment', 'notes', 'services')
         }),
         ('Отмена записи', {
             'fields': ('cancel_reason_type', 'cancel_reason'),
@@ -383,6 +386,11 @@ class AppointmentAdmin(admin.ModelAdmin):
         kwargs['form'] = AppointmentForm
         return super().get_form(request, obj, **kwargs)
 
+    def save_model(self, request, obj, form, change):
+        # Повторная проверка пересечений и сохранение под блокировкой врача на день
+        with doctor_day_lock(obj.doctor_id, obj.date_time, obj.get_end_time() or obj.date_time):
+            super().save_model(request, obj, form, change)
+
     @admin.display(description='Временной слот')
     def get_time_slot(self, obj):
         if not obj or not obj.date_time:
@@ -393,26 +401,27 @@ class AppointmentAdmin(admin.ModelAdmin):
     def get_status_display(self, obj):
         return obj.get_status_display()
 
+    def _bulk_status(self, request, queryset, status, done):
+        """Смена статуса пачкой (transitions.bulk_change_status): недопустимые переходы пропускаются"""
+        result = bulk_change_status(queryset.values_list('pk', flat=True), status, skip_invalid=True)
+        broker.publish_appointments(result['updated'], 'updated')
+        self.message_user(request, f"{len(result['updated'])} {done}")
+        if result['errors']:
+            skipped = ', '.join(f'#{pk}: {reason}' for pk, reason in sorted(result['errors'].items())[:10])
+            self.message_user(request, f"Пропущено {len(result['errors'])}: {skipped}", level=messages.WARNING)
+
     @admin.action(description='Отметить как завершенные')
     def mark_as_completed(self, request, queryset):
-        updated = queryset.update(status='completed')
-        self.message_user(request, f"{updated} записей отмечено как завершенные")
+        self._bulk_status(request, queryset, 'completed', 'записей отмечено как завершенные')
 
     @admin.action(description='Отменить выбранные записи')
     def mark_as_cancelled(self, request, queryset):
-        count = 0
-        for appointment in queryset:
-            appointment.status = 'cancelled'
-            if not appointment.cancel_reason_type:
-                appointment.cancel_reason_type = 'other'
-            appointment.save()
-            count += 1
-        self.message_user(request, f"{count} записей отменено")
+        # Без типа причины ставится «Другое», пустой комментарий заполняется текстом типа (в SQL)
+        self._bulk_status(request, queryset, 'cancelled', 'записей отменено')
 
     @admin.action(description='Отметить как "Не пришел"')
     def mark_as_no_show(self, request, queryset):
-        updated = queryset.update(status='no_show')
-        self.message_user(request, f"{updated} пациентов не пришли на прием")
+        self._bulk_status(request, queryset, 'no_show', 'пациентов не пришли на прием')
 
 
 # Кастомный InvoiceServiceInline
@@ -450,16 +459,17 @@ class InvoiceAdmin(admin.ModelAdmin):
     def has_delete_permission(self, request, obj=None):
         return self.has_module_permission(request)
 
-    list_display = ['id', 'appointment', 'total_amount', 'discount_applied', 'final_amount', 'is_paid', 'created_at']
+    list_display = ['id', 'appointment', 'items_count', 'total_amount', 'discount_applied', 'final_amount', 'is_paid', 'created_at']
     list_filter = ['is_paid', 'created_at']
     search_fields = ['appointment__patient__last_name', 'appointment__doctor__user__last_name']
-    readonly_fields = ['final_amount', 'created_at', 'paid_at']
+    # Сумму и число услуг пересчитывают строки счёта (сигналы InvoiceService)
+    readonly_fields = ['total_amount', 'items_count', 'final_amount', 'created_at', 'paid_at']
     inlines = [InvoiceServiceInline]
     list_select_related = ('appointment', 'created_by')
 
     fieldsets = (
         ('Основная информация', {
-            'fields': ('appointment', 'total_amount', 'discount_applied', 'final_amount')
+            'fields': ('appointment', 'items_count', 'total_amount', 'discount_applied', 'final_amount')
         }),
         ('Оплата', {
             'fields': ('is_paid', 'paid_at', 'created_by')
@@ -473,7 +483,8 @@ class InvoiceAdmin(admin.ModelAdmin):
 
     def save_formset(self, request, form, formset, change):
         """
-        Сохраняем инлайны, затем пересчитываем суммы в счёте.
+        Сохраняем инлайны: каждая строка сама меняет сумму счёта, затем
+        перечитываем итоги в форму.
         """
         instances = formset.save(commit=False)
         for inst in instances:
@@ -483,14 +494,7 @@ class InvoiceAdmin(admin.ModelAdmin):
         for obj in formset.deleted_objects:
             obj.delete()
         formset.save_m2m()
-
-        invoice = form.instance
-        totals = InvoiceService.objects.filter(invoice=invoice).aggregate(
-            total=Sum(F('price_at_time') * F('quantity'))
-        )
-        total_amount = totals.get('total') or 0
-        invoice.total_amount = total_amount
-        invoice.save()
+        form.instance.refresh_from_db(fields=['total_amount', 'items_count', 'final_amount'])
 
 
 # НАСТРОЙКИ АДМИНКИ
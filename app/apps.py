@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class AppConfig(AppConfig):
     name = 'app'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+        from . import signals  # noqa: F401
+        from .database import ensure_database_objects
+        post_migrate.connect(ensure_database_objects, sender=self)
@@ -0,0 +1,107 @@
+"""
+Закрытие дня: счета за завершённые приёмы, у которых счёта ещё нет.
+
+Приёмы обрабатываются пачками по id. На пачку — блокировка строк записей,
+один запрос цен оказанных услуг (Appointment.services с JOIN услуг), суммы со
+скидкой пациента считаются за один проход, счета и их строки вставляются
+двумя bulk_create. Сигналы при bulk_create не срабатывают, поэтому итоги счёта
+пишутся сразу при вставке, а сводки услуг обновляются здесь же
+(rollups.lines_added). Повторный запуск пропускает
+приёмы, у которых счёт уже есть, — закрывать день можно сколько угодно раз.
+"""
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import rollups
+from .models import Appointment, Invoice, InvoiceService
+from .schedule import day_range
+
+BATCH_SIZE = 1000
+
+
+def _unbilled(start, end, after_id, limit):
+    """id завершённых приёмов дня без счёта после after_id"""
+    return list(
+        Appointment.objects.filter(
+            status='completed', date_time__gte=start, date_time__lt=end, invoice__isnull=True, pk__gt=after_id,
+        ).order_by('pk').values_list('pk', flat=True)[:limit]
+    )
+
+
+def _bill(ids, user):
+    """Счета для приёмов ids одной транзакцией: (счета, строки, приёмы без услуг)"""
+    with transaction.atomic():
+        # Параллельный close_day ждёт здесь и после блокировки видит уже созданные счета
+        rows = list(
+            Appointment.objects.filter(pk__in=ids, status='completed').select_for_update(of=('self',))
+            .values('id', 'date_time', 'doctor_id', 'patient__discount')
+        )
+        billed = set(Invoice.objects.filter(appointment_id__in=ids).values_list('appointment_id', flat=True))
+        prices = defaultdict(list)
+        for appointment_id, service_id, price in Appointment.services.through.objects.filter(
+            appointment_id__in=ids
+        ).values_list('appointment_id', 'service_id', 'service__price'):
+            prices[appointment_id].append((service_id, price))
+
+        invoices, appointments, without_services = [], {}, 0
+        for row in rows:
+            if row['id'] in billed:
+                continue
+            if not prices[row['id']]:
+                without_services += 1
+                continue
+            total = sum(price for _, price in prices[row['id']])
+            discount = row['patient__discount'] or 0
+            invoices.append(Invoice(
+                appointment_id=row['id'], total_amount=total, items_count=len(prices[row['id']]),
+                discount_applied=discount, final_amount=Invoice.final_amount_of(total, discount), created_by=user,
+            ))
+            appointments[row['id']] = row
+        if not invoices:
+            return [], [], without_services
+
+        Invoice.objects.bulk_create(invoices)
+        if not connection.features.can_return_rows_from_bulk_insert:
+            pks = dict(
+                Invoice.objects.filter(appointment_id__in=appointments).values_list('appointment_id', 'id')
+            )
+            for invoice in invoices:
+                invoice.pk = pks[invoice.appointment_id]
+
+        lines, added = [], []
+        for invoice in invoices:
+            row = appointments[invoice.appointment_id]
+            day = rollups.local_day(row['date_time'])
+            for service_id, price in prices[invoice.appointment_id]:
+                lines.append(InvoiceService(invoice_id=invoice.pk, service_id=service_id, quantity=1, price_at_time=price))
+                added.append({
+                    'day': day, 'doctor_id': row['doctor_id'], 'service_id': service_id,
+                    'quantity': 1, 'revenue': price,
+                })
+        InvoiceService.objects.bulk_create(lines)
+        rollups.lines_added(added)
+    return invoices, lines, without_services
+
+
+def close_day(day=None, user=None, batch_size=BATCH_SIZE):
+    """
+    Выставляет счета за завершённые приёмы дня day (по умолчанию — сегодня) без счёта.
+    Возвращает {'day', 'invoices', 'lines', 'final_amount', 'without_services'}.
+    """
+    day = day or timezone.localdate()
+    start, end = day_range(day)
+    result = {'day': day.isoformat(), 'invoices': 0, 'lines': 0, 'final_amount': 0, 'without_services': 0}
+    after_id = 0
+    while True:
+        ids = _unbilled(start, end, after_id, batch_size)
+        if not ids:
+            break
+        after_id = ids[-1]
+        invoices, lines, without_services = _bill(ids, user)
+        result['invoices'] += len(invoices)
+        result['lines'] += len(lines)
+        result['final_amount'] += sum(invoice.final_amount for invoice in invoices)
+        result['without_services'] += without_services
+    return result
@@ -0,0 +1,55 @@
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Appointment, Doctor
+
+
+def _lock_days(start, end):
+    """Календарные дни (локальное время), которые задевает интервал [start, end)"""
+    first = timezone.localtime(start).date()
+    last = timezone.localtime(end - timedelta(microseconds=1)).date() if end > start else first
+    days = []
+    day = first
+    while day <= last:
+        days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+@contextmanager
+def doctor_day_lock(doctor_id, start, end):
+    """
+    Транзакция, в которой запись к врачу на день сериализована.
+
+    PostgreSQL: advisory-блокировка на пару (врач, день) — записи к разным врачам
+    и на разные дни идут параллельно.
+    SQLite: транзакция открывается как BEGIN IMMEDIATE (transaction_mode в настройках БД),
+    поэтому проверка пересечений и вставка выполняются под блокировкой записи.
+    Прочие СУБД: блокировка строки врача через SELECT ... FOR UPDATE.
+    """
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                # Дни в порядке возрастания — одинаковый порядок захвата исключает взаимоблокировки
+                for day in _lock_days(start, end):
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [doctor_id, day.toordinal()])
+        elif connection.vendor != 'sqlite':
+            list(Doctor.objects.select_for_update().filter(pk=doctor_id).values_list('pk', flat=True))
+        yield
+
+
+def book_appointment(patient, doctor, date_time, duration=15, status='scheduled'):
+    """Создание записи на приём: проверка пересечений и вставка атомарны"""
+    appointment = Appointment(
+        patient=patient,
+        doctor=doctor,
+        date_time=date_time,
+        status=status,
+        duration=duration,
+    )
+    with doctor_day_lock(doctor.pk, date_time, appointment.get_end_time() or date_time):
+        appointment.save()
+    return appointment
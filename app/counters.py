@@ -0,0 +1,70 @@
+"""
+Данные шапки страниц без запросов к БД: информация о клинике и счётчики дашборда.
+
+ClinicInfo хранится в памяти процесса и сбрасывается сигналом при сохранении
+или удалении; другие воркеры перечитывают её не позже CLINIC_INFO_CACHE_SECONDS.
+Счётчики лежат в кэше Django с TTL COUNTERS_CACHE_SECONDS и сбрасываются
+сигналами при изменении пациентов, врачей и записей.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import Appointment, ClinicInfo, Doctor, Patient
+from .schedule import day_range
+
+_clinic = None
+_clinic_expires = 0.0
+_clinic_lock = threading.Lock()
+
+
+def clinic_info():
+    """ClinicInfo из памяти процесса (или заглушка, если клиника ещё не заполнена)"""
+    global _clinic, _clinic_expires
+    with _clinic_lock:
+        if _clinic is None or _clinic_expires < time.monotonic():
+            _clinic = ClinicInfo.objects.first() or ClinicInfo(name="Клиника", program_name="Программа")
+            _clinic_expires = time.monotonic() + settings.CLINIC_INFO_CACHE_SECONDS
+        return _clinic
+
+
+def reset_clinic_info():
+    global _clinic
+    with _clinic_lock:
+        _clinic = None
+
+
+# ---------- Счётчики ----------
+def _appointments_today():
+    start, end = day_range(timezone.localdate())
+    return Appointment.objects.filter(date_time__gte=start, date_time__lt=end).count()
+
+
+COUNTERS = {
+    'patients': lambda: Patient.objects.count(),
+    'doctors': lambda: Doctor.objects.filter(is_active=True).count(),
+    'appointments_today': _appointments_today,
+}
+
+
+def _counter_key(name):
+    # Счётчик «на сегодня» не должен пережить смену дня
+    if name == 'appointments_today':
+        return f'counters:{name}:{timezone.localdate().isoformat()}'
+    return f'counters:{name}'
+
+
+def get_counter(name):
+    key = _counter_key(name)
+    value = cache.get(key)
+    if value is None:
+        value = COUNTERS[name]()
+        cache.set(key, value, timeout=settings.COUNTERS_CACHE_SECONDS)
+    return value
+
+
+def reset_counters(*names):
+    cache.delete_many([_counter_key(name) for name in names or COUNTERS])
@@ -0,0 +1,168 @@
+"""
+Куб статистики: меры × измерения × фильтры поверх дневных сводок (rollups.py).
+
+Каждая мера живёт в одной сводке, и запрос к сводке — один агрегатный SQL
+(GROUP BY по выбранным измерениям). Меры из разных сводок (например, записи
+и выручка по врачам) считаются запросом на сводку и сливаются по ключу измерений.
+"""
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncMonth, TruncWeek
+
+from .models import AppointmentDayStats, PatientDayStats, ServiceDayStats
+
+TIME_DIMENSIONS = ('day', 'week', 'month')
+DIMENSIONS = TIME_DIMENSIONS + ('doctor', 'specialty', 'service', 'status')
+
+# Сводка: модель, условие непустой строки, меры, измерения/фильтры сверх общих (время, врач, специальность)
+SOURCES = {
+    'appointments': {
+        'model': AppointmentDayStats,
+        'nonempty': Q(visits__gt=0),
+        'measures': {
+            'visits': {'_visits': Sum('visits')},
+            'no_shows': {'_no_shows': Sum('visits', filter=Q(status='no_show'))},
+            'avg_duration': {'_visits': Sum('visits'), '_duration': Sum('duration')},
+        },
+        'dimensions': {'status'},
+    },
+    'services': {
+        'model': ServiceDayStats,
+        'nonempty': Q(quantity__gt=0),
+        'measures': {
+            'revenue': {'_revenue': Sum('revenue')},
+        },
+        'dimensions': {'service'},
+    },
+    'patients': {
+        'model': PatientDayStats,
+        'nonempty': Q(visits__gt=0),
+        'measures': {
+            'unique_patients': {'_patients': Count('patient_id', distinct=True)},
+        },
+        'dimensions': set(),
+    },
+}
+MEASURES = {measure: source for source, spec in SOURCES.items() for measure in spec['measures']}
+
+FILTERS = {
+    'doctor': 'doctor_id__in',
+    'specialty': 'doctor__specialty__in',
+    'service': 'service_id__in',
+    'status': 'status__in',
+}
+
+
+class CubeError(ValueError):
+    pass
+
+
+def _measure_value(measure, row):
+    if measure == 'visits':
+        return row['_visits'] or 0
+    if measure == 'no_shows':
+        return row['_no_shows'] or 0
+    if measure == 'avg_duration':
+        return round(row['_duration'] / row['_visits'], 1) if row['_visits'] else None
+    if measure == 'revenue':
+        return float(row['_revenue'] or 0)
+    return row['_patients'] or 0
+
+
+def _group_columns(dimensions):
+    """Колонки values() для измерений и функция, собирающая значение измерения из строки"""
+    columns, annotations, readers = [], {}, {}
+    for dimension in dimensions:
+        if dimension == 'day':
+            columns.append('day')
+            readers[dimension] = lambda row: row['day'].isoformat()
+        elif dimension in ('week', 'month'):
+            trunc = TruncWeek if dimension == 'week' else TruncMonth
+            annotations[f'_{dimension}'] = trunc('day')
+            columns.append(f'_{dimension}')
+            readers[dimension] = lambda row, key=f'_{dimension}': row[key].isoformat()
+        elif dimension == 'doctor':
+            columns += ['doctor_id', 'doctor__user__last_name', 'doctor__user__first_name', 'doctor__user__middle_name']
+            readers[dimension] = lambda row: {
+                'id': row['doctor_id'],
+                'name': ' '.join(filter(None, (
+                    row['doctor__user__last_name'], row['doctor__user__first_name'], row['doctor__user__middle_name']
+                ))),
+            }
+        elif dimension == 'specialty':
+            columns.append('doctor__specialty')
+            readers[dimension] = lambda row: row['doctor__specialty']
+        elif dimension == 'service':
+            columns += ['service_id', 'service__name']
+            readers[dimension] = lambda row: {'id': row['service_id'], 'name': row['service__name']}
+        else:
+            columns.append('status')
+            readers[dimension] = lambda row: row['status']
+    return columns, annotations, readers
+
+
+def _key(value):
+    return value['id'] if isinstance(value, dict) else value
+
+
+def run_cube(start, end, measures, dimensions=(), filters=None):
+    """
+    Строки куба за дни [start, end]: по строке на сочетание значений измерений.
+    filters: {'doctor': [id], 'specialty': [...], 'service': [id], 'status': [...]}
+    """
+    filters = {name: values for name, values in (filters or {}).items() if values}
+    if not measures:
+        raise CubeError('Не выбрано ни одной меры')
+    for measure in measures:
+        if measure not in MEASURES:
+            raise CubeError(f'Неизвестная мера: {measure}')
+    for dimension in dimensions:
+        if dimension not in DIMENSIONS:
+            raise CubeError(f'Неизвестное измерение: {dimension}')
+    if len(set(dimensions)) != len(dimensions):
+        raise CubeError('Измерения повторяются')
+    if len([d for d in dimensions if d in TIME_DIMENSIONS]) > 1:
+        raise CubeError('Можно выбрать только одно из измерений day/week/month')
+    for name in filters:
+        if name not in FILTERS:
+            raise CubeError(f'Неизвестный фильтр: {name}')
+
+    by_source = {}
+    for measure in measures:
+        by_source.setdefault(MEASURES[measure], []).append(measure)
+
+    columns, annotations, readers = _group_columns(dimensions)
+    merged = {}
+    for source, source_measures in by_source.items():
+        spec = SOURCES[source]
+        own = spec['dimensions']
+        for name in [d for d in dimensions if d in ('service', 'status')] + [f for f in filters if f in ('service', 'status')]:
+            if name not in own:
+                raise CubeError(f"Меры {', '.join(source_measures)} не разбиваются по «{name}»")
+
+        aggregates = {}
+        for measure in source_measures:
+            aggregates.update(spec['measures'][measure])
+
+        queryset = spec['model'].objects.filter(spec['nonempty'], day__gte=start, day__lte=end)
+        for name, values in filters.items():
+            queryset = queryset.filter(**{FILTERS[name]: values})
+        if columns:
+            rows = queryset.annotate(**annotations).values(*columns).annotate(**aggregates).order_by(*columns)
+        else:
+            # values() без колонок группирует по всем полям — итог без измерений считает aggregate()
+            rows = [queryset.aggregate(**aggregates)]
+
+        for row in rows:
+            values = {dimension: readers[dimension](row) for dimension in dimensions}
+            item = merged.setdefault(tuple(_key(values[d]) for d in dimensions), values)
+            for measure in source_measures:
+                item[measure] = _measure_value(measure, row)
+
+    # Сочетание, которого нет в одной из сводок, получает там ноль (среднее — None)
+    result = []
+    for key in sorted(merged, key=lambda k: tuple((v is None, v) for v in k)):
+        item = merged[key]
+        for measure in measures:
+            item.setdefault(measure, None if measure == 'avg_duration' else 0)
+        result.append(item)
+    return result
@@ -0,0 +1,106 @@
+"""
+Объекты схемы, зависящие от СУБД и не описываемые моделями Django:
+запрет пересечения записей врача и индекс подстрочного поиска пациентов.
+
+Здесь — текущая версия SQL для хука post_migrate. Миграции держат свою
+замороженную копию и этот модуль не импортируют: изменение здесь не должно
+менять уже применённые миграции.
+"""
+from django.db import connections
+
+APPOINTMENT_OVERLAP_CONSTRAINT = 'appointment_doctor_no_overlap'
+PATIENT_SEARCH_TABLE = 'app_patient_search'
+
+
+# ---------- Пересечение записей врача ----------
+APPOINTMENT_OVERLAP_SQL = {
+    'postgresql': [
+        'CREATE EXTENSION IF NOT EXISTS btree_gist',
+        f"""
+        ALTER TABLE app_appointment ADD CONSTRAINT {APPOINTMENT_OVERLAP_CONSTRAINT}
+        EXCLUDE USING gist (
+            doctor_id WITH =,
+            tstzrange(date_time, end_time, '[)') WITH &&
+        ) WHERE (status = 'scheduled')
+        """,
+    ],
+    # Триггеры SQLite: тот же запрет, что и exclusion constraint в PostgreSQL
+    'sqlite': [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {APPOINTMENT_OVERLAP_CONSTRAINT}_{event.split()[0].lower()}
+        BEFORE {event} ON app_appointment
+        WHEN NEW.status = 'scheduled' AND EXISTS (
+            SELECT 1 FROM app_appointment
+            WHERE doctor_id = NEW.doctor_id
+              AND status = 'scheduled'
+              AND id IS NOT NEW.id
+              AND date_time < NEW.end_time
+              AND end_time > NEW.date_time
+        )
+        BEGIN
+            SELECT RAISE(ABORT, '{APPOINTMENT_OVERLAP_CONSTRAINT}');
+        END
+        """
+        for event in ('INSERT', 'UPDATE OF doctor_id, date_time, end_time, status')
+    ],
+}
+
+# ---------- Подстрочный поиск пациентов по Patient.search_text ----------
+PATIENT_SEARCH_SQL = {
+    'postgresql': [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        f'CREATE INDEX IF NOT EXISTS {PATIENT_SEARCH_TABLE}_trgm ON app_patient USING gin (search_text gin_trgm_ops)',
+    ],
+    # FTS5 с триграммным токенизатором поверх app_patient (external content), синхронизация триггерами
+    'sqlite': [
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {PATIENT_SEARCH_TABLE}
+        USING fts5(search_text, content='app_patient', content_rowid='id', tokenize='trigram')
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {PATIENT_SEARCH_TABLE}_insert AFTER INSERT ON app_patient BEGIN
+            INSERT INTO {PATIENT_SEARCH_TABLE}(rowid, search_text) VALUES (NEW.id, NEW.search_text);
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {PATIENT_SEARCH_TABLE}_delete AFTER DELETE ON app_patient BEGIN
+            INSERT INTO {PATIENT_SEARCH_TABLE}({PATIENT_SEARCH_TABLE}, rowid, search_text)
+            VALUES ('delete', OLD.id, OLD.search_text);
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {PATIENT_SEARCH_TABLE}_update AFTER UPDATE OF search_text ON app_patient BEGIN
+            INSERT INTO {PATIENT_SEARCH_TABLE}({PATIENT_SEARCH_TABLE}, rowid, search_text)
+            VALUES ('delete', OLD.id, OLD.search_text);
+            INSERT INTO {PATIENT_SEARCH_TABLE}(rowid, search_text) VALUES (NEW.id, NEW.search_text);
+        END
+        """,
+    ],
+}
+
+
+def execute_for_vendor(connection, statements):
+    """Выполняет SQL, предназначенный для СУБД соединения (остальные СУБД пропускаются)"""
+    with connection.cursor() as cursor:
+        for statement in statements.get(connection.vendor, []):
+            cursor.execute(statement)
+
+
+def ensure_database_objects(sender, using, apps=None, **kwargs):
+    """
+    post_migrate: пересоздаёт триггеры SQLite. Django пересобирает таблицу SQLite
+    при AlterField (CREATE new / DROP old), и триггеры старой таблицы теряются.
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite' or apps is None:
+        return
+    try:
+        appointment = apps.get_model('app', 'Appointment')
+        patient = apps.get_model('app', 'Patient')
+    except LookupError:
+        return
+    # Только если миграции, создающие эти объекты, уже применены
+    if any(f.name == 'end_time' for f in appointment._meta.get_fields()):
+        execute_for_vendor(connection, APPOINTMENT_OVERLAP_SQL)
+    if any(f.name == 'search_text' for f in patient._meta.get_fields()):
+        execute_for_vendor(connection, PATIENT_SEARCH_SQL)
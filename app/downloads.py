@@ -0,0 +1,161 @@
+"""
+Выдача файлов документов после проверки прав.
+
+FileResponse отдаёт открытый файл: WSGI-сервер с wsgi.file_wrapper (gunicorn,
+uWSGI) передаёт его через sendfile(), не читая в Python. Поддерживаются
+условные запросы (ETag — хэш содержимого Blob, у старых файлов — размер и
+время изменения; Last-Modified; ответ 304) и один диапазон Range:
+bytes=начало-конец (докачка, постраничное чтение PDF; ответы 206 и 416).
+
+В режимах DOCUMENT_DOWNLOAD_MODE = 'x-accel' (nginx) и 'x-sendfile' (Apache,
+lighttpd) Django проверяет только права и условия запроса, а файл вместе с
+диапазонами отдаёт фронтенд-сервер по X-Accel-Redirect / X-Sendfile.
+
+Файлы документов и части загрузок лежат в MEDIA_ROOT, но по MEDIA_URL не
+отдаются: в DEBUG медиа раздаёт public_media, пропуская PRIVATE_MEDIA_DIRS.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+from django.views.static import serve
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+MODES = (None, 'x-accel', 'x-sendfile')
+
+
+class _Unsatisfiable(Exception):
+    pass
+
+
+class _FileSlice:
+    """length байт файла с текущей позиции — для диапазона, который кончается раньше файла"""
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        data = self.file.read(self.remaining if size < 0 else min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _validators(document, stat):
+    if document.blob_id:
+        etag = f'"{document.blob.sha256}"'
+    else:
+        etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    return etag, int(stat.st_mtime)
+
+
+def _byte_range(request, size, etag, last_modified):
+    """(начало, конец включительно) из Range или None — отдать файл целиком"""
+    header = request.headers.get('Range')
+    if not header:
+        return None
+    # If-Range: диапазон действителен, только если у клиента та же версия файла
+    if_range = request.headers.get('If-Range')
+    if if_range and if_range != etag and parse_http_date_safe(if_range) != last_modified:
+        return None
+    match = RANGE.match(header.strip())
+    if not match or not (match[1] or match[2]):
+        # Несколько диапазонов и прочие формы не поддерживаются — файл целиком (RFC 9110 это допускает)
+        return None
+    if match[1]:
+        start = int(match[1])
+        end = min(int(match[2]), size - 1) if match[2] else size - 1
+        if match[2] and int(match[2]) < start:
+            return None
+    else:
+        suffix = int(match[2])
+        if not suffix:
+            raise _Unsatisfiable
+        start, end = max(size - suffix, 0), size - 1
+    if start >= size:
+        raise _Unsatisfiable
+    return start, end
+
+
+def _file_response(request, path, size, etag, last_modified, filename, as_attachment):
+    try:
+        byte_range = _byte_range(request, size, etag, last_modified)
+    except _Unsatisfiable:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    file = open(path, 'rb')
+    if byte_range is None:
+        response = FileResponse(file, as_attachment=as_attachment, filename=filename)
+    else:
+        start, end = byte_range
+        file.seek(start)
+        # Диапазон до конца файла — сам файл с позиции (sendfile работает), иначе — срез
+        body = file if end == size - 1 else _FileSlice(file, end - start + 1)
+        response = FileResponse(body, as_attachment=as_attachment, filename=filename, status=206)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response.block_size = settings.UPLOAD_BUFFER_BYTES
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _accel_response(mode, document, path, filename, as_attachment):
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = HttpResponse(content_type=content_type)
+    if mode == 'x-accel':
+        response['X-Accel-Redirect'] = settings.DOCUMENT_ACCEL_PREFIX + quote(document.file.name)
+    else:
+        response['X-Sendfile'] = path
+    response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+    return response
+
+
+def document_response(request, document, as_attachment=False):
+    """Ответ с файлом документа; права проверяет вызывающий"""
+    mode = settings.DOCUMENT_DOWNLOAD_MODE
+    if mode not in MODES:
+        raise ImproperlyConfigured(f'DOCUMENT_DOWNLOAD_MODE: ожидается одно из {MODES}')
+    if not document.file:
+        raise Http404('У документа нет файла')
+    path = document.file.path
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise Http404('Файл документа не найден')
+
+    etag, last_modified = _validators(document, stat)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        filename = document.filename or os.path.basename(path)
+        if mode:
+            response = _accel_response(mode, document, path, filename, as_attachment)
+        else:
+            response = _file_response(request, path, stat.st_size, etag, last_modified, filename, as_attachment)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # Документы пациентов не кладутся в общие кэши; браузер перепроверяет их по ETag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def public_media(request, path, document_root=None, show_indexes=False):
+    """django.views.static.serve для MEDIA_URL в DEBUG без каталогов PRIVATE_MEDIA_DIRS"""
+    # Путь нормализуется так же, как в serve(): 'a/../blobs/...' — тоже blobs/
+    top = posixpath.normpath(path.replace('\\', '/')).lstrip('/').split('/', 1)[0]
+    if top in settings.PRIVATE_MEDIA_DIRS:
+        raise Http404('Файл выдаётся только с проверкой прав')
+    return serve(request, path, document_root=document_root, show_indexes=show_indexes)
@@ -0,0 +1,160 @@
+import asyncio
+import threading
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import Appointment
+from .schedule import SCHEDULE_FIELDS, schedule_item
+
+EVENT_FIELDS = SCHEDULE_FIELDS + ('doctor_id', 'created_at')
+
+# Очередь подписчика: при переполнении клиент получает reload и перечитывает расписание целиком
+QUEUE_SIZE = 100
+
+
+def appointment_event(kind, row):
+    """Дельта расписания из строки values(EVENT_FIELDS)"""
+    return {
+        'type': kind,
+        'id': row['id'],
+        'status': row['status'],
+        'date': timezone.localtime(row['date_time']).date().isoformat(),
+        'doctor_id': row['doctor_id'],
+        'item': schedule_item(row),
+    }
+
+
+class Subscription:
+    """
+    Подписка одного дашборда на день (и, опционально, врача).
+
+    ids — записи, которые сейчас показаны у клиента. Запись, перенесённая на
+    другой день или к другому врачу, в событии несёт уже новые дату и врача;
+    по ids подписка узнаёт её и отправляет клиенту deleted.
+    """
+
+    def __init__(self, day, doctor_id=None, ids=()):
+        self.day = day.isoformat()
+        self.doctor_id = doctor_id
+        self.ids = set(ids)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    def matches(self, event):
+        if event.get('date') != self.day:
+            return False
+        return self.doctor_id is None or event.get('doctor_id') == self.doctor_id
+
+    def route(self, event):
+        """Событие для этого клиента или None; вызывается под блокировкой брокера"""
+        if self.matches(event):
+            if event['type'] == 'deleted':
+                self.ids.discard(event['id'])
+            else:
+                self.ids.add(event['id'])
+            return event
+        if event['id'] in self.ids:
+            self.ids.discard(event['id'])
+            return {'type': 'deleted', 'id': event['id'], 'date': self.day, 'doctor_id': event.get('doctor_id')}
+        return None
+
+    def deliver(self, event):
+        # publish() вызывается из потоков синхронных view — передаём событие в цикл подписчика
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            pass  # цикл уже закрыт
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({'type': 'reload'})
+
+
+class ScheduleBroker:
+    """
+    Pub/sub изменений расписания внутри процесса.
+
+    SCHEDULE_STREAM_MODE = 'memory' — события публикуют сигналы и view этого процесса.
+    SCHEDULE_STREAM_MODE = 'poll' — для нескольких воркеров: один опрос БД на процесс
+    раз в SCHEDULE_STREAM_POLL_SECONDS по updated_at, независимо от числа подписчиков.
+
+    updated_at ставится до фиксации транзакции, поэтому строка может стать видна
+    позже строк с бо́льшим updated_at. Опрос каждый раз перечитывает окно
+    SCHEDULE_STREAM_POLL_GRACE_SECONDS до последнего увиденного updated_at, повторы
+    отсекаются по (id, updated_at). Гарантия: доставляется каждое изменение,
+    зафиксированное не позже чем через GRACE после своего updated_at (то же — для
+    расхождения часов воркеров); более долгие транзакции опрос может пропустить.
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._poller = None
+
+    @property
+    def polling(self):
+        return settings.SCHEDULE_STREAM_MODE == 'poll'
+
+    def subscribe(self, day, doctor_id=None, ids=()):
+        subscription = Subscription(day, doctor_id, ids)
+        with self._lock:
+            self._subscribers.add(subscription)
+        if self.polling and self._poller is None:
+            self._poller = asyncio.create_task(self._poll())
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, event):
+        with self._lock:
+            deliveries = [(s, s.route(event)) for s in self._subscribers]
+        for subscription, routed in deliveries:
+            if routed is not None:
+                subscription.deliver(routed)
+
+    def publish_appointment(self, pk, kind):
+        """Событие по записи из текущего процесса (в режиме poll его доставит опрос БД)"""
+        self.publish_appointments([pk], kind)
+
+    def publish_appointments(self, pks, kind):
+        """События по нескольким записям одним запросом"""
+        if self.polling or not self._subscribers or not pks:
+            return
+        for row in Appointment.objects.filter(pk__in=pks).values(*EVENT_FIELDS):
+            self.publish(appointment_event(kind, row))
+
+    async def _poll(self):
+        grace = timedelta(seconds=settings.SCHEDULE_STREAM_POLL_GRACE_SECONDS)
+        cursor = (await Appointment.objects.aaggregate(last=Max('updated_at')))['last'] or timezone.now()
+        # Изменения из окна перекрытия, которые уже есть у клиентов: id -> updated_at
+        recent = Appointment.objects.filter(updated_at__gte=cursor - grace).values_list('id', 'updated_at')
+        seen = dict(await sync_to_async(list)(recent))
+        try:
+            while self._subscribers:
+                await asyncio.sleep(settings.SCHEDULE_STREAM_POLL_SECONDS)
+                since = cursor - grace
+                changed = Appointment.objects.filter(updated_at__gte=since).order_by('updated_at', 'id')
+                rows = await sync_to_async(list)(changed.values(*EVENT_FIELDS, 'updated_at'))
+                for row in rows:
+                    if seen.get(row['id']) == row['updated_at']:
+                        continue
+                    kind = 'updated' if row['id'] in seen or row['created_at'] < since else 'created'
+                    seen[row['id']] = row['updated_at']
+                    self.publish(appointment_event(kind, row))
+                if rows:
+                    cursor = max(cursor, rows[-1]['updated_at'])
+                    seen = {pk: updated_at for pk, updated_at in seen.items() if updated_at >= cursor - grace}
+        finally:
+            self._poller = None
+
+broker = ScheduleBroker()
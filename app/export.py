@@ -0,0 +1,249 @@
+"""
+Потоковая выгрузка записей, счетов и пациентов в CSV и XLSX.
+
+Строки читаются из БД кусками (.iterator) одним запросом с JOIN связанных
+таблиц и сразу уходят в ответ или файл: память не зависит от числа строк.
+XLSX пишется без сторонних библиотек — zip с минимальным SpreadsheetML,
+который zipfile умеет писать в поток без перемотки.
+"""
+import csv
+import io
+import re
+import zipfile
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Appointment, Invoice, Patient
+from .schedule import day_range
+
+CHUNK_SIZE = 2000
+FORMATS = ('csv', 'xlsx')
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+def _appointment_filter(prefix, start=None, end=None, doctor_id=None, statuses=None):
+    """Фильтры api_stats_data (период, врач, статус) для записи по пути prefix"""
+    conditions = Q()
+    if start:
+        conditions &= Q(**{f'{prefix}date_time__gte': day_range(start)[0]})
+    if end:
+        conditions &= Q(**{f'{prefix}date_time__lt': day_range(end)[1]})
+    if doctor_id:
+        conditions &= Q(**{f'{prefix}doctor_id': doctor_id})
+    if statuses:
+        conditions &= Q(**{f'{prefix}status__in': statuses})
+    return conditions
+
+
+def _local(value, tz=None):
+    """'ГГГГ-ММ-ДД ЧЧ:ММ' в часовом поясе клиники; tz передаётся, чтобы не искать его на каждой строке"""
+    if not value:
+        return ''
+    return value.astimezone(tz or timezone.get_current_timezone()).replace(tzinfo=None).isoformat(' ', 'minutes')
+
+
+def _name(*parts):
+    return ' '.join(part for part in parts if part)
+
+
+# ---------- Наборы данных: заголовок и строки ----------
+def appointment_rows(**filters):
+    tz = timezone.get_current_timezone()
+    statuses = dict(Appointment.STATUS_CHOICES)
+    rows = (
+        Appointment.objects.filter(_appointment_filter('', **filters))
+        .order_by('date_time', 'id')
+        .values_list(
+            'id', 'date_time', 'duration', 'status',
+            'patient__last_name', 'patient__first_name', 'patient__middle_name', 'patient__phone',
+            'doctor__user__last_name', 'doctor__user__first_name', 'doctor__user__middle_name', 'doctor__specialty',
+            'reason', 'diagnosis', 'cancel_reason',
+        )
+    )
+    yield ('ID', 'Дата и время', 'Длительность (мин)', 'Статус', 'Пациент', 'Телефон',
+           'Врач', 'Специальность', 'Причина обращения', 'Диагноз', 'Причина отмены')
+    for (pk, date_time, duration, status, p_last, p_first, p_middle, phone,
+         d_last, d_first, d_middle, specialty, reason, diagnosis, cancel_reason) in rows.iterator(chunk_size=CHUNK_SIZE):
+        yield (pk, _local(date_time, tz), duration, statuses.get(status, status), _name(p_last, p_first, p_middle), phone,
+               _name(d_last, d_first, d_middle), specialty, reason, diagnosis, cancel_reason)
+
+
+def invoice_rows(**filters):
+    """Строка на услугу счёта; счёт без услуг — одна строка с пустой услугой"""
+    tz = timezone.get_current_timezone()
+    rows = (
+        Invoice.objects.filter(_appointment_filter('appointment__', **filters))
+        .order_by('id', 'items__id')
+        .values_list(
+            'id', 'appointment__date_time',
+            'appointment__patient__last_name', 'appointment__patient__first_name', 'appointment__patient__middle_name',
+            'appointment__doctor__user__last_name', 'appointment__doctor__user__first_name',
+            'appointment__doctor__user__middle_name',
+            'items__service__name', 'items__quantity', 'items__price_at_time',
+            'total_amount', 'discount_applied', 'final_amount', 'is_paid', 'paid_at',
+        )
+    )
+    yield ('Счет', 'Дата приема', 'Пациент', 'Врач', 'Услуга', 'Количество', 'Цена', 'Сумма по услуге',
+           'Сумма счета', 'Скидка, %', 'Итого', 'Оплачен', 'Дата оплаты')
+    for (pk, date_time, p_last, p_first, p_middle, d_last, d_first, d_middle, service, quantity, price,
+         total, discount, final, is_paid, paid_at) in rows.iterator(chunk_size=CHUNK_SIZE):
+        yield (pk, _local(date_time, tz), _name(p_last, p_first, p_middle), _name(d_last, d_first, d_middle),
+               service or '', quantity or '', price if price is not None else '',
+               price * quantity if price is not None else '',
+               total, discount, final, 'Да' if is_paid else 'Нет', _local(paid_at, tz))
+
+
+def patient_rows(**filters):
+    """Все пациенты или, при фильтрах, пациенты с подходящими записями"""
+    tz = timezone.get_current_timezone()
+    patients = Patient.objects.all()
+    if any(filters.values()):
+        patients = patients.filter(
+            id__in=Appointment.objects.filter(_appointment_filter('', **filters)).values('patient_id')
+        )
+    rows = patients.order_by('id').values_list(
+        'id', 'last_name', 'first_name', 'middle_name', 'birth_date', 'phone', 'email', 'discount', 'created_at',
+    )
+    yield ('ID', 'Фамилия', 'Имя', 'Отчество', 'Дата рождения', 'Телефон', 'Email', 'Скидка, %', 'Дата регистрации')
+    for pk, last, first, middle, birth_date, phone, email, discount, created_at in rows.iterator(chunk_size=CHUNK_SIZE):
+        yield (pk, last, first, middle, birth_date.isoformat() if birth_date else '', phone, email, discount,
+               _local(created_at, tz))
+
+
+DATASETS = {
+    'appointments': appointment_rows,
+    'invoices': invoice_rows,
+    'patients': patient_rows,
+}
+
+
+# ---------- Форматы ----------
+class _Buffer:
+    """Приёмник zipfile без перемотки: записанное забирается кусками"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def stream_csv(rows):
+    """Куски CSV в UTF-8 с BOM (чтобы Excel узнал кодировку), по CHUNK_SIZE строк"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    yield '\ufeff'.encode()
+    for index, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if index % CHUNK_SIZE == 0:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+# Экранирование текста ячейки и удаление символов, недопустимых в XML 1.0, за один проход
+_XML_TEXT = str.maketrans({
+    '&': '&amp;', '<': '&lt;', '>': '&gt;',
+    **{chr(code): None for code in range(32) if code not in (9, 10, 13)},
+})
+_XML_SPECIAL = re.compile('[&<>\x00-\x08\x0b\x0c\x0e-\x1f]')
+_XLSX_NUMBERS = (int, float, Decimal)
+
+_XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="{sheet}" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>'
+    ),
+}
+
+
+def _xlsx_text(value):
+    if value is None:
+        return ''
+    value = str(value)
+    return value.translate(_XML_TEXT) if _XML_SPECIAL.search(value) else value
+
+
+def _xlsx_row(row):
+    # Ячейки собираются в одном выражении: на миллионах строк вызов функции на ячейку заметен
+    return '<row>' + ''.join([
+        f'<c><v>{value}</v></c>' if type(value) in _XLSX_NUMBERS else
+        f'<c t="inlineStr"><is><t xml:space="preserve">{_xlsx_text(value)}</t></is></c>'
+        for value in row
+    ]) + '</row>'
+
+
+def stream_xlsx(rows, sheet='Данные'):
+    """Куски XLSX-файла: лист со строками rows (первая — заголовок)"""
+    buffer = _Buffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        for name, content in _XLSX_PARTS.items():
+            archive.writestr(name, content.replace('{sheet}', escape(sheet)))
+        yield buffer.take()
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet_file:
+            sheet_file.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            chunk = []
+            for row in rows:
+                chunk.append(_xlsx_row(row))
+                if len(chunk) >= CHUNK_SIZE:
+                    sheet_file.write(''.join(chunk).encode())
+                    chunk = []
+                    yield buffer.take()
+            sheet_file.write(''.join(chunk).encode() + b'</sheetData></worksheet>')
+    yield buffer.take()
+
+
+def stream_export(dataset, file_format, **filters):
+    """Итератор байтов выгрузки dataset ('appointments', 'invoices', 'patients') в file_format"""
+    rows = DATASETS[dataset](**filters)
+    if file_format == 'xlsx':
+        return stream_xlsx(rows)
+    return stream_csv(rows)
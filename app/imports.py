@@ -0,0 +1,377 @@
+"""
+Массовый импорт пациентов и записей из CSV (первая строка — заголовок) или JSONL.
+
+Файл читается потоково и обрабатывается пачками по BATCH_SIZE строк:
+проверки, которые при сохранении по одной записи делают запрос на строку
+(пациент, врач, пересечения у врача), выполняются одним запросом на пачку,
+а прошедшие проверку строки вставляются bulk_create в транзакции пачки.
+Отклонённые строки попадают в отчёт с номером строки файла.
+"""
+import csv
+import json
+import re
+from bisect import bisect_left
+from datetime import date, datetime, timedelta
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import counters, rollups
+from .models import Appointment, Doctor, Patient, normalize_phone, phone_validator
+from .search import search_cache
+
+BATCH_SIZE = 5000
+INSERT_BATCH_SIZE = 1000
+FORMATS = ('csv', 'jsonl')
+
+PHONE_RE = re.compile(phone_validator.regex.pattern)
+STATUSES = dict(Appointment.STATUS_CHOICES)
+CANCEL_REASONS = dict(Appointment.CANCEL_REASON_CHOICES)
+
+
+class ImportReport:
+    def __init__(self):
+        self.created = 0
+        self.errors = []  # (номер строки, текст ошибки)
+
+    def reject(self, line, errors):
+        if isinstance(errors, dict):
+            errors = '; '.join(f'{field}: {message}' for field, message in errors.items())
+        self.errors.append((line, errors))
+
+    def as_dict(self, limit=1000):
+        return {
+            'created': self.created,
+            'error_count': len(self.errors),
+            'errors': [{'line': line, 'error': error} for line, error in self.errors[:limit]],
+        }
+
+
+def read_rows(stream, file_format):
+    """(номер строки, dict) из текстового потока"""
+    if file_format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, {key: (value or '').strip() for key, value in row.items() if key}
+        return
+    for line, text in enumerate(stream, 1):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+        except ValueError as e:
+            yield line, {'__error__': f'Некорректный JSON: {e}'}
+            continue
+        if not isinstance(row, dict):
+            row = {'__error__': 'Строка должна быть JSON-объектом'}
+        yield line, {key: value.strip() if isinstance(value, str) else value for key, value in row.items()}
+
+
+def _batches(rows):
+    batch = []
+    for item in rows:
+        batch.append(item)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _parse_date(value):
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value))
+
+
+def _parse_datetime(value):
+    """ISO-дата и время; без часового пояса — время клиники"""
+    value = datetime.fromisoformat(str(value))
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_current_timezone())
+    return value
+
+
+def _insert(model, report, objects):
+    """bulk_create пачки; при нарушении ограничения — построчно, чтобы найти виновные строки"""
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create([obj for _, obj in objects], batch_size=INSERT_BATCH_SIZE)
+        report.created += len(objects)
+        return [obj for _, obj in objects]
+    except IntegrityError:
+        pass
+    inserted = []
+    for line, obj in objects:
+        obj.pk = None  # мог быть выдан в откатившейся пачке
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create([obj])
+            inserted.append(obj)
+        except IntegrityError as e:
+            report.reject(line, f'Нарушено ограничение БД: {e}')
+    report.created += len(inserted)
+    return inserted
+
+
+# ---------- Пациенты ----------
+def _patient(row):
+    errors = {}
+    for field in ('last_name', 'first_name', 'birth_date', 'phone'):
+        if not row.get(field):
+            errors[field] = 'Обязательное поле'
+    phone = str(row.get('phone') or '')
+    if phone and not PHONE_RE.match(phone):
+        errors['phone'] = phone_validator.message
+    birth_date = None
+    if row.get('birth_date'):
+        try:
+            birth_date = _parse_date(row['birth_date'])
+        except ValueError:
+            errors['birth_date'] = 'Дата в формате ГГГГ-ММ-ДД'
+    email = row.get('email') or ''
+    if email:
+        try:
+            validate_email(email)
+        except ValidationError:
+            errors['email'] = 'Некорректный email'
+    try:
+        discount = int(row.get('discount') or 0)
+        if not 0 <= discount <= 100:
+            errors['discount'] = 'Скидка от 0 до 100'
+    except (TypeError, ValueError):
+        errors['discount'] = 'Скидка — целое число'
+        discount = 0
+    for field, limit in (('last_name', 50), ('first_name', 50), ('middle_name', 50)):
+        if len(str(row.get(field) or '')) > limit:
+            errors[field] = f'Не длиннее {limit} символов'
+    if errors:
+        return None, errors
+
+    patient = Patient(
+        last_name=row['last_name'],
+        first_name=row['first_name'],
+        middle_name=row.get('middle_name') or '',
+        birth_date=birth_date,
+        phone=phone,
+        email=email,
+        discount=discount,
+        notes=row.get('notes') or '',
+    )
+    patient.fill_search_fields()
+    return patient, None
+
+
+def import_patients(rows):
+    report = ImportReport()
+    for batch in _batches(rows):
+        valid = []
+        for line, row in batch:
+            if '__error__' in row:
+                report.reject(line, row['__error__'])
+                continue
+            patient, errors = _patient(row)
+            if errors:
+                report.reject(line, errors)
+            else:
+                valid.append((line, patient))
+        _insert(Patient, report, valid)
+    # bulk_create не вызывает сигналы — сбрасываем кэш поиска и счётчик сами
+    if report.created:
+        search_cache.clear()
+        counters.reset_counters('patients')
+    return report
+
+
+# ---------- Записи ----------
+def _appointment(row, doctors, now):
+    """Запись из строки без обращений к БД; пациент проставляется позже для всей пачки"""
+    errors = {}
+    doctor_id = row.get('doctor_id')
+    try:
+        doctor_id = int(doctor_id)
+        if doctor_id not in doctors:
+            errors['doctor_id'] = 'Врач не найден'
+    except (TypeError, ValueError):
+        errors['doctor_id'] = 'Укажите id врача'
+
+    if not row.get('patient_id') and not row.get('patient_phone'):
+        errors['patient'] = 'Укажите patient_id или patient_phone'
+
+    date_time = None
+    try:
+        date_time = _parse_datetime(row.get('date_time'))
+        if date_time.minute % 10 != 0 or date_time.second or date_time.microsecond:
+            errors['date_time'] = 'Время должно быть кратно 10 минутам (например: 10:00, 10:10, 10:20)'
+    except (TypeError, ValueError):
+        errors['date_time'] = 'Дата и время в формате ГГГГ-ММ-ДД ЧЧ:ММ'
+
+    try:
+        duration = int(row.get('duration'))
+        if duration < 10 or duration % 10 != 0:
+            errors['duration'] = 'Длительность должна быть кратна 10 минутам'
+    except (TypeError, ValueError):
+        errors['duration'] = 'Укажите длительность в минутах'
+        duration = None
+
+    status = row.get('status') or Appointment._meta.get_field('status').default
+    if status not in STATUSES:
+        errors['status'] = f'Недопустимый статус: {status}'
+
+    cancel_reason_type = row.get('cancel_reason_type') or None
+    cancel_reason = row.get('cancel_reason') or ''
+    if cancel_reason_type and cancel_reason_type not in CANCEL_REASONS:
+        errors['cancel_reason_type'] = f'Недопустимая причина отмены: {cancel_reason_type}'
+    if status == 'cancelled' and not cancel_reason_type and not cancel_reason:
+        errors['cancel_reason'] = 'Укажите причину отмены'
+
+    # История приёмов загружается как есть; правила новой записи — только для запланированных
+    if status == 'scheduled' and not errors:
+        if date_time < now:
+            errors['date_time'] = 'Нельзя записывать на прошедшее время'
+        elif not doctors[doctor_id]:
+            errors['doctor_id'] = 'Этот врач временно не принимает'
+    if errors:
+        return None, errors
+
+    if status == 'cancelled' and not cancel_reason:
+        cancel_reason = Appointment.CANCEL_REASON_TEXT.get(cancel_reason_type, 'Запись отменена')
+    appointment = Appointment(
+        doctor_id=doctor_id,
+        date_time=date_time,
+        end_time=date_time + timedelta(minutes=duration),
+        duration=duration,
+        status=status,
+        cancel_reason_type=cancel_reason_type,
+        cancel_reason=cancel_reason,
+        reason=row.get('reason') or '',
+        diagnosis=row.get('diagnosis') or '',
+        treatment=row.get('treatment') or '',
+        notes=row.get('notes') or '',
+    )
+    return appointment, None
+
+
+def _resolve_patients(report, candidates):
+    """Проставляет patient_id всей пачке: два запроса вместо запроса на строку"""
+    ids, phones = set(), set()
+    for _, row, _ in candidates:
+        if row.get('patient_id'):
+            try:
+                ids.add(int(row['patient_id']))
+            except (TypeError, ValueError):
+                pass
+        else:
+            phones.add(normalize_phone(str(row['patient_phone'])))
+
+    known_ids = set(Patient.objects.filter(id__in=ids).values_list('id', flat=True)) if ids else set()
+    by_phone = {}
+    if phones:
+        for phone, pk in Patient.objects.filter(phone_normalized__in=phones).values_list('phone_normalized', 'id'):
+            by_phone[phone] = None if phone in by_phone else pk  # None — несколько пациентов с номером
+
+    resolved = []
+    for line, row, appointment in candidates:
+        if row.get('patient_id'):
+            try:
+                patient_id = int(row['patient_id'])
+            except (TypeError, ValueError):
+                patient_id = None
+            if patient_id not in known_ids:
+                report.reject(line, {'patient_id': 'Пациент не найден'})
+                continue
+        else:
+            phone = normalize_phone(str(row['patient_phone']))
+            if phone not in by_phone:
+                report.reject(line, {'patient_phone': 'Пациент с таким телефоном не найден'})
+                continue
+            patient_id = by_phone[phone]
+            if patient_id is None:
+                report.reject(line, {'patient_phone': 'Телефон есть у нескольких пациентов — укажите patient_id'})
+                continue
+        appointment.patient_id = patient_id
+        resolved.append((line, appointment))
+    return resolved
+
+
+def _reject_overlaps(report, candidates):
+    """
+    Пересечения запланированных записей по врачам: один запрос занятых
+    интервалов на пачку, затем проход по отсортированным интервалам.
+    """
+    scheduled = [(line, a) for line, a in candidates if a.status == 'scheduled']
+    if not scheduled:
+        return candidates
+
+    doctor_ids = {a.doctor_id for _, a in scheduled}
+    window_start = min(a.date_time for _, a in scheduled)
+    window_end = max(a.end_time for _, a in scheduled)
+    busy = {doctor_id: ([], []) for doctor_id in doctor_ids}  # врач -> (начала, окончания) по возрастанию
+    existing = Appointment.objects.filter(
+        status='scheduled', doctor_id__in=doctor_ids, date_time__lt=window_end, end_time__gt=window_start,
+    ).order_by('doctor_id', 'date_time').values_list('doctor_id', 'date_time', 'end_time')
+    for doctor_id, start, end in existing:
+        busy[doctor_id][0].append(start)
+        busy[doctor_id][1].append(end)
+
+    rejected = set()
+    last_end = {}  # врач -> (окончание, строка) последней принятой записи пачки
+    for line, appointment in sorted(scheduled, key=lambda item: (item[1].doctor_id, item[1].date_time)):
+        starts, ends = busy[appointment.doctor_id]
+        # Занятые интервалы врача не пересекаются: достаточно проверить последний начавшийся до конца новой записи
+        index = bisect_left(starts, appointment.end_time) - 1
+        if index >= 0 and ends[index] > appointment.date_time:
+            report.reject(line, {'date_time': f'Время занято: запись с {timezone.localtime(starts[index]):%d.%m.%Y %H:%M}'})
+            rejected.add(line)
+            continue
+        previous = last_end.get(appointment.doctor_id)
+        if previous and previous[0] > appointment.date_time:
+            report.reject(line, {'date_time': f'Пересекается с записью в строке {previous[1]}'})
+            rejected.add(line)
+            continue
+        last_end[appointment.doctor_id] = (appointment.end_time, line)
+    return [(line, a) for line, a in candidates if line not in rejected]
+
+
+def import_appointments(rows):
+    report = ImportReport()
+    doctors = dict(Doctor.objects.values_list('id', 'is_active'))
+    now = timezone.now()
+    first_day = last_day = None
+    for batch in _batches(rows):
+        candidates = []
+        for line, row in batch:
+            if '__error__' in row:
+                report.reject(line, row['__error__'])
+                continue
+            appointment, errors = _appointment(row, doctors, now)
+            if errors:
+                report.reject(line, errors)
+            else:
+                candidates.append((line, row, appointment))
+
+        valid = _reject_overlaps(report, _resolve_patients(report, candidates))
+        inserted = _insert(Appointment, report, valid)
+        if inserted:
+            days = [rollups.local_day(a.date_time) for a in inserted]
+            first_day = min(days + ([first_day] if first_day else []))
+            last_day = max(days + ([last_day] if last_day else []))
+
+    # bulk_create не вызывает сигналы — сводки статистики пересчитываем за затронутые дни
+    if first_day:
+        rollups.rebuild(first_day, last_day)
+        counters.reset_counters('appointments_today')
+    return report
+
+
+IMPORTERS = {
+    'patients': import_patients,
+    'appointments': import_appointments,
+}
+
+
+def run_import(dataset, stream, file_format):
+    """Импорт dataset ('patients', 'appointments') из текстового потока stream"""
+    return IMPORTERS[dataset](read_rows(stream, file_format))
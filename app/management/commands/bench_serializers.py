@@ -0,0 +1,167 @@
+import time
+from datetime import date, datetime, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.http import JsonResponse
+from django.test import RequestFactory
+from django.utils import timezone
+
+from app import views
+from app.models import Appointment, Doctor, Patient, Service, User
+from app.pagination import MAX_PAGE_SIZE, paginate
+from app.personnel import ROLES, staff_rows
+from app.schedule import SCHEDULE_FIELDS, SCHEDULE_STATUSES, _doctor_name, day_range
+
+
+class _Rollback(Exception):
+    pass
+
+
+# ---------- Было: код представлений до перехода на serializers (без изменений) ----------
+def _json_list_before(items, next_cursor):
+    response = JsonResponse(items, safe=False)
+    if next_cursor:
+        response['X-Next-Cursor'] = next_cursor
+    return response
+
+
+def _services_before(request):
+    cursor, limit = views._cursor_params(request)
+    services, next_cursor = paginate(Service.objects.all(), views.SERVICE_ORDERING, cursor, limit)
+    data = [{'id': s.id, 'name': s.name, 'price': float(s.price), 'duration': s.duration} for s in services]
+    return _json_list_before(data, next_cursor)
+
+
+def _full_name_before(row):
+    return ' '.join(part for part in (row['last_name'], row['first_name'], row['middle_name']) if part)
+
+
+def _legacy_item_before(row):
+    item = {'id': row['id'], 'full_name': _full_name_before(row)}
+    for field in ROLES[row['role']]['fields']:
+        item[field] = row[field]
+    item['is_active'] = row['is_active']
+    item['user_username'] = row['username']
+    return item
+
+
+def _doctors_before(request):
+    cursor, limit = views._cursor_params(request)
+    rows, next_cursor = paginate(staff_rows('doctor'), ('last_name', 'first_name', 'id'), cursor, limit)
+    return _json_list_before([_legacy_item_before(row) for row in rows], next_cursor)
+
+
+def _schedule_item_before(row):
+    start = timezone.localtime(row['date_time'])
+    end = start + timedelta(minutes=row['duration'])
+    item = {
+        'id': row['id'],
+        'patient_name': f"{row['patient__last_name']} {row['patient__first_name']}",
+        'doctor_name': _doctor_name(
+            row['doctor__user__last_name'], row['doctor__user__first_name'], row['doctor__user__middle_name']
+        ),
+    }
+    if row['status'] == 'scheduled':
+        item['time'] = f"{start:%H:%M} - {end:%H:%M}"
+    elif row['status'] == 'completed':
+        item['time'] = f"{start:%H:%M}"
+    return item
+
+
+def _schedule_before(request):
+    day = datetime.strptime(request.GET['date'], '%Y-%m-%d').date()
+    start, end = day_range(day)
+    appointments = Appointment.objects.filter(
+        date_time__gte=start, date_time__lt=end, status__in=SCHEDULE_STATUSES
+    )
+    schedule = {status: [] for status in SCHEDULE_STATUSES}
+    for row in appointments.order_by('date_time').values(*SCHEDULE_FIELDS):
+        schedule[row['status']].append(_schedule_item_before(row))
+    return JsonResponse(schedule)
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает прежнюю (модели + JsonResponse) и текущую (values + serializers) сборку ответов API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='Строк в каждом списке')
+        parser.add_argument('--repeat', type=int, default=5, help='Повторов замера (берётся лучший)')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._run(options['rows'], options['repeat'])
+                # Тестовые данные не сохраняются
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def _seed(self, rows):
+        Service.objects.bulk_create(
+            Service(name=f'Услуга {i:05}', price=1000 + i % 500, duration=30) for i in range(rows)
+        )
+        users = User.objects.bulk_create(
+            User(username=f'bench_doctor_{i}', last_name=f'Врач{i:05}', first_name='Иван', middle_name='Петрович')
+            for i in range(rows)
+        )
+        doctors = Doctor.objects.bulk_create(Doctor(user=user, specialty='Терапевт', room=str(i)) for i, user in enumerate(users))
+        patients = Patient.objects.bulk_create(
+            Patient(last_name=f'Пациент{i:05}', first_name='Пётр', birth_date=date(1990, 1, 1), phone='+79990000000')
+            for i in range(rows)
+        )
+        day = timezone.localdate() + timedelta(days=3650)
+        start = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+        Appointment.objects.bulk_create(
+            Appointment(
+                patient=patients[i], doctor=doctors[i], duration=30,
+                date_time=start + timedelta(seconds=i * 8), end_time=start + timedelta(seconds=i * 8, minutes=30),
+                status=SCHEDULE_STATUSES[i % len(SCHEDULE_STATUSES)],
+            )
+            for i in range(rows)
+        )
+        return day
+
+    def _fetch(self, view, path, params):
+        """Ответ целиком: все страницы по X-Next-Cursor; (число байт)"""
+        size, cursor = 0, None
+        while True:
+            request = self.factory.get(path, {**params, **({'cursor': cursor} if cursor else {})})
+            request.user = self.admin
+            response = view(request)
+            assert response.status_code == 200, response.content
+            size += len(response.content)
+            cursor = response.get('X-Next-Cursor')
+            if not cursor:
+                return size
+
+    def _best(self, repeat, *args):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            size = self._fetch(*args)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best, size
+
+    def _run(self, rows, repeat):
+        day = self._seed(rows)
+        self.factory = RequestFactory()
+        self.admin = User.objects.create(username='bench_admin', role='admin')
+        page = {'limit': MAX_PAGE_SIZE}
+        cases = [
+            ('api_services_list', _services_before, views.api_services_list, '/api/services/', page),
+            ('api_doctors_list', _doctors_before, views.api_doctors_list, '/api/personnel/doctors/', page),
+            (
+                'api_schedule_by_date_and_doctor', _schedule_before, views.api_schedule_by_date_and_doctor,
+                '/api/schedule/', {'date': day.isoformat()},
+            ),
+        ]
+        self.stdout.write(f'{rows} строк, списки страницами по {MAX_PAGE_SIZE}, лучшее из {repeat}')
+        for name, before, after, path, params in cases:
+            old, old_size = self._best(repeat, before, path, params)
+            new, new_size = self._best(repeat, after, path, params)
+            self.stdout.write(
+                f'{name:34} было {old * 1000:7.1f} мс ({old_size} байт)  '
+                f'стало {new * 1000:7.1f} мс ({new_size} байт)  x{old / new:.1f}'
+            )
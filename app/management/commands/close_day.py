@@ -0,0 +1,35 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.billing import BATCH_SIZE, close_day
+from app.models import User
+
+
+class Command(BaseCommand):
+    help = 'Выставляет счета за завершённые приёмы дня, у которых счёта ещё нет (повторный запуск безопасен)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='День (ГГГГ-ММ-ДД), по умолчанию — сегодня')
+        parser.add_argument('--user', help='Логин пользователя, от имени которого создаются счета')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Приёмов в одной транзакции')
+
+    def handle(self, *args, **options):
+        try:
+            day = date.fromisoformat(options['date']) if options['date'] else None
+        except ValueError as e:
+            raise CommandError(f'Некорректная дата: {e}')
+        user = None
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError(f'Пользователь не найден: {options["user"]}')
+
+        result = close_day(day, user=user, batch_size=options['batch_size'])
+        self.stdout.write(
+            f'{result["day"]}: счетов {result["invoices"]}, строк {result["lines"]}, '
+            f'на сумму {result["final_amount"]} руб.'
+        )
+        if result['without_services']:
+            self.stdout.write(self.style.WARNING(f'Приёмов без оказанных услуг: {result["without_services"]}'))
+        self.stdout.write(self.style.SUCCESS('День закрыт'))
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.uploads import expire_uploads
+
+
+class Command(BaseCommand):
+    help = 'Удаляет брошенные загрузки документов: незавершённые части и неприкреплённые файлы'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours', type=int, default=settings.UPLOAD_EXPIRE_HOURS, help='Возраст последней активности загрузки'
+        )
+
+    def handle(self, *args, **options):
+        expired = expire_uploads(options['hours'])
+        self.stdout.write(self.style.SUCCESS(f'Удалено загрузок: {expired}'))
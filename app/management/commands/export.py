@@ -0,0 +1,49 @@
+import io
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.export import DATASETS, FORMATS, stream_export
+
+
+class Command(BaseCommand):
+    help = 'Выгружает записи, счета или пациентов в CSV/XLSX (потоково, без загрузки в память)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(DATASETS))
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('-o', '--output', help='Файл (по умолчанию — stdout)')
+        parser.add_argument('--start', help='С даты приема (ГГГГ-ММ-ДД)')
+        parser.add_argument('--end', help='По дату приема (ГГГГ-ММ-ДД)')
+        parser.add_argument('--doctor', type=int, help='ID врача')
+        parser.add_argument('--status', action='append', help='Статус записи (можно несколько раз)')
+
+    def handle(self, *args, **options):
+        try:
+            start = date.fromisoformat(options['start']) if options['start'] else None
+            end = date.fromisoformat(options['end']) if options['end'] else None
+        except ValueError as e:
+            raise CommandError(f'Некорректная дата: {e}')
+
+        chunks = stream_export(
+            options['dataset'], options['format'],
+            start=start, end=end, doctor_id=options['doctor'], statuses=options['status'],
+        )
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                for chunk in chunks:
+                    output.write(chunk)
+            self.stderr.write(self.style.SUCCESS(f"Выгрузка сохранена в {options['output']}"))
+        else:
+            # Через OutputWrapper: вывод перехватывает call_command(stdout=...). У консоли байты
+            # пишутся в buffer; текстовый поток (StringIO) получает CSV текстом — куски целые строки
+            out = self.stdout._out
+            binary = out if isinstance(out, (io.RawIOBase, io.BufferedIOBase)) else getattr(out, 'buffer', None)
+            if binary is None and options['format'] != 'csv':
+                raise CommandError('XLSX нельзя вывести в текстовый поток — укажите --output')
+            for chunk in chunks:
+                if binary is not None:
+                    binary.write(chunk)
+                else:
+                    out.write(chunk.decode())
+            (binary or out).flush()
@@ -156,10 +156,9 @@ class Command(BaseCommand):
                     duration=60
                 )
 
-                # Создаём счёт
+                # Создаём счёт (сумму добавит строка счёта)
                 invoice = Invoice.objects.create(
                     appointment=appointment,
-                    total_amount=services[i % len(services)].price,
                     discount_applied=10,
                     is_paid=True
                 )
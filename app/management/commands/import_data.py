@@ -0,0 +1,44 @@
+import csv
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.imports import FORMATS, IMPORTERS, run_import
+
+
+class Command(BaseCommand):
+    help = 'Импортирует пациентов или записи из CSV/JSONL пачками (bulk_create)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(IMPORTERS))
+        parser.add_argument('path', help='Файл CSV (с заголовком) или JSONL')
+        parser.add_argument('--format', choices=FORMATS, help='По умолчанию — по расширению файла')
+        parser.add_argument('--report', help='CSV-файл для отчёта об ошибках (строка, ошибка)')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or options['path'].rsplit('.', 1)[-1].lower()
+        if file_format not in FORMATS:
+            raise CommandError('Укажите --format: csv или jsonl')
+
+        started = time.monotonic()
+        try:
+            with open(options['path'], encoding='utf-8-sig', newline='') as stream:
+                report = run_import(options['dataset'], stream, file_format)
+        except OSError as e:
+            raise CommandError(str(e))
+        elapsed = time.monotonic() - started
+
+        if options['report']:
+            with open(options['report'], 'w', encoding='utf-8', newline='') as output:
+                writer = csv.writer(output)
+                writer.writerow(['line', 'error'])
+                writer.writerows(report.errors)
+        else:
+            for line, error in report.errors[:20]:
+                self.stderr.write(f'Строка {line}: {error}')
+            if len(report.errors) > 20:
+                self.stderr.write(f'... и ещё {len(report.errors) - 20} (полный список: --report)')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Создано: {report.created}, ошибок: {len(report.errors)}, за {elapsed:.1f} с'
+        ))
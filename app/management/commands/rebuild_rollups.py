@@ -0,0 +1,25 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.rollups import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает дневные сводки статистики из записей и счетов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='Первый день (ГГГГ-ММ-ДД), по умолчанию — с начала')
+        parser.add_argument('--end', help='Последний день (ГГГГ-ММ-ДД), по умолчанию — до конца')
+
+    def handle(self, *args, **options):
+        try:
+            start = date.fromisoformat(options['start']) if options['start'] else None
+            end = date.fromisoformat(options['end']) if options['end'] else None
+        except ValueError as e:
+            raise CommandError(f'Некорректная дата: {e}')
+
+        created = rebuild(start, end)
+        for name, count in created.items():
+            self.stdout.write(f'{name}: {count}')
+        self.stdout.write(self.style.SUCCESS('Сводки пересчитаны'))
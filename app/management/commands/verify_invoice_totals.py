@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from app.rollups import verify_invoice_totals
+
+
+class Command(BaseCommand):
+    help = 'Сверяет суммы и число строк счетов со строками счетов и исправляет расхождения'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Счетов в одной транзакции')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать расхождения')
+
+    def handle(self, *args, **options):
+        checked, drift = verify_invoice_totals(options['chunk_size'], repair=not options['dry_run'])
+        for pk, (stored, expected) in drift.items():
+            self.stdout.write(
+                f'Счет #{pk}: сумма {stored[0]} → {expected[0]}, строк {stored[1]} → {expected[1]}, '
+                f'итого {stored[2]} → {expected[2]}'
+            )
+        self.stdout.write(f'Проверено счетов: {checked}, расхождений: {len(drift)}')
+        if drift and options['dry_run']:
+            self.stdout.write(self.style.WARNING('Расхождения не исправлены (--dry-run)'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Итоги счетов сверены'))
@@ -0,0 +1,34 @@
+# Generated by Django 6.0.1 on 2026-10-18 10:00
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def fill_end_time(apps, schema_editor):
+    Appointment = apps.get_model('app', 'Appointment')
+    batch = []
+    for appointment in Appointment.objects.only('id', 'date_time', 'duration').iterator(chunk_size=2000):
+        appointment.end_time = appointment.date_time + timedelta(minutes=appointment.duration)
+        batch.append(appointment)
+        if len(batch) >= 2000:
+            Appointment.objects.bulk_update(batch, ['end_time'])
+            batch = []
+    if batch:
+        Appointment.objects.bulk_update(batch, ['end_time'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_alter_appointment_patient'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='end_time',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Окончание приема'),
+        ),
+        migrations.RunPython(fill_end_time, migrations.RunPython.noop),
+    ]
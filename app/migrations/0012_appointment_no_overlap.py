@@ -0,0 +1,111 @@
+# Generated by Django 6.0.1 on 2026-10-18 11:00
+
+from django.db import migrations
+
+CONSTRAINT_NAME = 'appointment_doctor_no_overlap'
+
+POSTGRES_INSTALL = [
+    'CREATE EXTENSION IF NOT EXISTS btree_gist',
+    f"""
+    ALTER TABLE app_appointment ADD CONSTRAINT {CONSTRAINT_NAME}
+    EXCLUDE USING gist (
+        doctor_id WITH =,
+        tstzrange(date_time, end_time, '[)') WITH &&
+    ) WHERE (status = 'scheduled')
+    """,
+]
+
+POSTGRES_UNINSTALL = [
+    f'ALTER TABLE app_appointment DROP CONSTRAINT IF EXISTS {CONSTRAINT_NAME}',
+]
+
+# Триггеры SQLite: тот же запрет пересечений, что и exclusion constraint в PostgreSQL
+SQLITE_OVERLAP_CONDITION = """
+    NEW.status = 'scheduled' AND EXISTS (
+        SELECT 1 FROM app_appointment
+        WHERE doctor_id = NEW.doctor_id
+          AND status = 'scheduled'
+          AND id IS NOT NEW.id
+          AND date_time < NEW.end_time
+          AND end_time > NEW.date_time
+    )
+"""
+
+SQLITE_INSTALL = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {CONSTRAINT_NAME}_insert
+    BEFORE INSERT ON app_appointment
+    WHEN {SQLITE_OVERLAP_CONDITION}
+    BEGIN
+        SELECT RAISE(ABORT, '{CONSTRAINT_NAME}');
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {CONSTRAINT_NAME}_update
+    BEFORE UPDATE OF doctor_id, date_time, end_time, status ON app_appointment
+    WHEN {SQLITE_OVERLAP_CONDITION}
+    BEGIN
+        SELECT RAISE(ABORT, '{CONSTRAINT_NAME}');
+    END
+    """,
+]
+
+SQLITE_UNINSTALL = [
+    f'DROP TRIGGER IF EXISTS {CONSTRAINT_NAME}_insert',
+    f'DROP TRIGGER IF EXISTS {CONSTRAINT_NAME}_update',
+]
+
+
+def _run(schema_editor, statements):
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+# Уже пересекающиеся записи: с ними ADD CONSTRAINT в PostgreSQL падает с невнятной ошибкой
+OVERLAPS_QUERY = """
+    SELECT a.doctor_id, a.id, a.date_time, b.id, b.date_time
+    FROM app_appointment a
+    JOIN app_appointment b
+      ON b.doctor_id = a.doctor_id AND b.id > a.id
+     AND b.date_time < a.end_time AND b.end_time > a.date_time
+    WHERE a.status = 'scheduled' AND b.status = 'scheduled'
+    ORDER BY a.doctor_id, a.date_time
+    LIMIT 20
+"""
+
+
+def check_no_overlaps(schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(OVERLAPS_QUERY)
+        overlaps = cursor.fetchall()
+    if overlaps:
+        pairs = '\n'.join(
+            f'  врач {doctor_id}: запись {first_id} ({first_start}) и запись {second_id} ({second_start})'
+            for doctor_id, first_id, first_start, second_id, second_start in overlaps
+        )
+        raise RuntimeError(
+            'Нельзя включить запрет пересечений: у врачей есть пересекающиеся запланированные записи '
+            f'(не более 20 пар):\n{pairs}\n'
+            'Перенесите или отмените одну из записей каждой пары и повторите migrate.'
+        )
+
+
+def install_overlap_guard(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        check_no_overlaps(schema_editor)
+    _run(schema_editor, {'postgresql': POSTGRES_INSTALL, 'sqlite': SQLITE_INSTALL})
+
+
+def uninstall_overlap_guard(apps, schema_editor):
+    _run(schema_editor, {'postgresql': POSTGRES_UNINSTALL, 'sqlite': SQLITE_UNINSTALL})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_appointment_end_time'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_overlap_guard, uninstall_overlap_guard),
+    ]
@@ -0,0 +1,105 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:00
+
+import re
+
+from django.db import migrations, models
+
+SEARCH_TABLE = 'app_patient_search'
+
+POSTGRES_INSTALL = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    f'CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_trgm ON app_patient USING gin (search_text gin_trgm_ops)',
+]
+
+POSTGRES_UNINSTALL = [
+    f'DROP INDEX IF EXISTS {SEARCH_TABLE}_trgm',
+]
+
+# FTS5 с триграммным токенизатором поверх app_patient (external content), синхронизация триггерами
+SQLITE_INSTALL = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE}
+    USING fts5(search_text, content='app_patient', content_rowid='id', tokenize='trigram')
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_insert AFTER INSERT ON app_patient BEGIN
+        INSERT INTO {SEARCH_TABLE}(rowid, search_text) VALUES (NEW.id, NEW.search_text);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_delete AFTER DELETE ON app_patient BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, search_text)
+        VALUES ('delete', OLD.id, OLD.search_text);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_update AFTER UPDATE OF search_text ON app_patient BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, search_text)
+        VALUES ('delete', OLD.id, OLD.search_text);
+        INSERT INTO {SEARCH_TABLE}(rowid, search_text) VALUES (NEW.id, NEW.search_text);
+    END
+    """,
+    f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')",
+]
+
+SQLITE_UNINSTALL = [
+    f'DROP TRIGGER IF EXISTS {SEARCH_TABLE}_insert',
+    f'DROP TRIGGER IF EXISTS {SEARCH_TABLE}_delete',
+    f'DROP TRIGGER IF EXISTS {SEARCH_TABLE}_update',
+    f'DROP TABLE IF EXISTS {SEARCH_TABLE}',
+]
+
+
+def _normalize(value):
+    return ' '.join((value or '').casefold().replace('ё', 'е').split())
+
+
+def fill_search_fields(apps, schema_editor):
+    Patient = apps.get_model('app', 'Patient')
+    batch = []
+    fields = ('id', 'last_name', 'first_name', 'middle_name', 'phone')
+    for patient in Patient.objects.only(*fields).iterator(chunk_size=2000):
+        patient.search_name = _normalize(f"{patient.last_name} {patient.first_name} {patient.middle_name or ''}")
+        phone_digits = re.sub(r'\D', '', patient.phone or '')
+        patient.search_text = f"{patient.search_name} {phone_digits}".strip()
+        batch.append(patient)
+        if len(batch) >= 2000:
+            Patient.objects.bulk_update(batch, ['search_name', 'search_text'])
+            batch = []
+    if batch:
+        Patient.objects.bulk_update(batch, ['search_name', 'search_text'])
+
+
+def _run(schema_editor, statements):
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def install_search_index(apps, schema_editor):
+    _run(schema_editor, {'postgresql': POSTGRES_INSTALL, 'sqlite': SQLITE_INSTALL})
+
+
+def uninstall_search_index(apps, schema_editor):
+    _run(schema_editor, {'postgresql': POSTGRES_UNINSTALL, 'sqlite': SQLITE_UNINSTALL})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_appointment_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='search_name',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=160),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='search_text',
+            field=models.CharField(blank=True, default='', editable=False, max_length=200),
+        ),
+        migrations.RunPython(fill_search_fields, migrations.RunPython.noop),
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 6.0.1 on 2026-10-18 14:00
+
+import re
+
+from django.db import migrations, models
+
+SEARCH_TABLE = 'app_patient_search'
+
+# Триггеры подстрочного индекса из 0014 (таблица FTS5 переживает пересборку app_patient)
+SQLITE_SEARCH_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_insert AFTER INSERT ON app_patient BEGIN
+        INSERT INTO {SEARCH_TABLE}(rowid, search_text) VALUES (NEW.id, NEW.search_text);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_delete AFTER DELETE ON app_patient BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, search_text)
+        VALUES ('delete', OLD.id, OLD.search_text);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_update AFTER UPDATE OF search_text ON app_patient BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, search_text)
+        VALUES ('delete', OLD.id, OLD.search_text);
+        INSERT INTO {SEARCH_TABLE}(rowid, search_text) VALUES (NEW.id, NEW.search_text);
+    END
+    """,
+]
+
+
+def _normalize_phone(value):
+    digits = re.sub(r'\D', '', value or '')
+    if len(digits) == 11 and digits.startswith('8'):
+        digits = '7' + digits[1:]
+    elif len(digits) == 10 and digits.startswith('9'):
+        digits = '7' + digits
+    return digits
+
+
+def fill_phone_fields(apps, schema_editor):
+    Patient = apps.get_model('app', 'Patient')
+    batch = []
+    for patient in Patient.objects.only('id', 'phone').iterator(chunk_size=2000):
+        patient.phone_normalized = _normalize_phone(patient.phone)
+        patient.phone_reversed = patient.phone_normalized[::-1]
+        batch.append(patient)
+        if len(batch) >= 2000:
+            Patient.objects.bulk_update(batch, ['phone_normalized', 'phone_reversed'])
+            batch = []
+    if batch:
+        Patient.objects.bulk_update(batch, ['phone_normalized', 'phone_reversed'])
+
+
+def restore_search_triggers(apps, schema_editor):
+    # AddField пересобирает app_patient в SQLite — триггеры подстрочного индекса ставим заново
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in SQLITE_SEARCH_TRIGGERS:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_patient_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='phone_normalized',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='phone_reversed',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=20),
+        ),
+        migrations.RunPython(fill_phone_fields, migrations.RunPython.noop),
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+    ]
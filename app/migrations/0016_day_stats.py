@@ -0,0 +1,62 @@
+# Generated by Django 6.0.1 on 2026-10-18 15:00
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_patient_phone_lookup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentDayStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='День')),
+                ('status', models.CharField(max_length=20, verbose_name='Статус')),
+                ('visits', models.IntegerField(default=0, verbose_name='Записей')),
+                ('duration', models.IntegerField(default=0, verbose_name='Минут')),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='app.doctor', verbose_name='Врач')),
+            ],
+            options={
+                'verbose_name': 'Сводка записей за день',
+                'verbose_name_plural': 'Сводки записей за день',
+                'constraints': [models.UniqueConstraint(fields=('day', 'doctor', 'status'), name='appointment_day_stats_key')],
+            },
+        ),
+        migrations.CreateModel(
+            name='PatientDayStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='День')),
+                ('visits', models.IntegerField(default=0, verbose_name='Записей')),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='app.doctor', verbose_name='Врач')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='app.patient', verbose_name='Пациент')),
+            ],
+            options={
+                'verbose_name': 'Сводка пациентов за день',
+                'verbose_name_plural': 'Сводки пациентов за день',
+                'constraints': [models.UniqueConstraint(fields=('day', 'doctor', 'patient'), name='patient_day_stats_key')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ServiceDayStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='День')),
+                ('quantity', models.IntegerField(default=0, verbose_name='Количество')),
+                ('revenue', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14, verbose_name='Выручка')),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='app.doctor', verbose_name='Врач')),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='app.service', verbose_name='Услуга')),
+            ],
+            options={
+                'verbose_name': 'Сводка услуг за день',
+                'verbose_name_plural': 'Сводки услуг за день',
+                'constraints': [models.UniqueConstraint(fields=('day', 'doctor', 'service'), name='service_day_stats_key')],
+            },
+        ),
+    ]
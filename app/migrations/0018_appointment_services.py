@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_page_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='services',
+            field=models.ManyToManyField(blank=True, related_name='appointments', to='app.service', verbose_name='Оказанные услуги'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 6.0.1 on 2026-10-18 19:00
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_items_count(apps, schema_editor):
+    # Суммы существующих счетов пересчитывал InvoiceAdmin; расхождения исправляет verify_invoice_totals
+    Invoice = apps.get_model('app', 'Invoice')
+    InvoiceService = apps.get_model('app', 'InvoiceService')
+    counts = (
+        InvoiceService.objects.filter(invoice=OuterRef('pk')).order_by()
+        .values('invoice').annotate(count=Count('id')).values('count')
+    )
+    Invoice.objects.update(items_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0018_appointment_services'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='items_count',
+            field=models.IntegerField(default=0, verbose_name='Количество услуг'),
+        ),
+        migrations.RunPython(fill_items_count, migrations.RunPython.noop),
+    ]
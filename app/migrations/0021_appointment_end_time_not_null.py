@@ -0,0 +1,73 @@
+# Generated by Django 6.0.1 on 2026-10-18 21:00
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+CONSTRAINT_NAME = 'appointment_doctor_no_overlap'
+
+# Триггеры из 0012: AlterField пересобирает app_appointment в SQLite, и триггеры теряются
+SQLITE_OVERLAP_CONDITION = """
+    NEW.status = 'scheduled' AND EXISTS (
+        SELECT 1 FROM app_appointment
+        WHERE doctor_id = NEW.doctor_id
+          AND status = 'scheduled'
+          AND id IS NOT NEW.id
+          AND date_time < NEW.end_time
+          AND end_time > NEW.date_time
+    )
+"""
+
+SQLITE_INSTALL = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {CONSTRAINT_NAME}_insert
+    BEFORE INSERT ON app_appointment
+    WHEN {SQLITE_OVERLAP_CONDITION}
+    BEGIN
+        SELECT RAISE(ABORT, '{CONSTRAINT_NAME}');
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {CONSTRAINT_NAME}_update
+    BEFORE UPDATE OF doctor_id, date_time, end_time, status ON app_appointment
+    WHEN {SQLITE_OVERLAP_CONDITION}
+    BEGIN
+        SELECT RAISE(ABORT, '{CONSTRAINT_NAME}');
+    END
+    """,
+]
+
+
+def fill_missing_end_time(apps, schema_editor):
+    # NULL в end_time — неограниченный tstzrange в PostgreSQL и пропуск проверки в триггере SQLite
+    Appointment = apps.get_model('app', 'Appointment')
+    batch = []
+    for appointment in Appointment.objects.filter(end_time=None).only('id', 'date_time', 'duration').iterator(
+        chunk_size=2000
+    ):
+        appointment.end_time = appointment.date_time + timedelta(minutes=appointment.duration)
+        batch.append(appointment)
+    Appointment.objects.bulk_update(batch, ['end_time'], batch_size=2000)
+
+
+def restore_overlap_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in SQLITE_INSTALL:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_document_blobs'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_missing_end_time, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='appointment',
+            name='end_time',
+            field=models.DateTimeField(blank=True, editable=False, verbose_name='Окончание приема'),
+        ),
+        migrations.RunPython(restore_overlap_triggers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 6.0.1 on 2026-10-18 22:00
+
+from django.db import migrations
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+BATCH_SIZE = 2000
+
+
+def fill_day_stats(apps, schema_editor):
+    # Та же пересборка, что rollups.rebuild(), на моделях этой миграции: сводки за всё время из исходных таблиц
+    Appointment = apps.get_model('app', 'Appointment')
+    InvoiceService = apps.get_model('app', 'InvoiceService')
+    AppointmentDayStats = apps.get_model('app', 'AppointmentDayStats')
+    ServiceDayStats = apps.get_model('app', 'ServiceDayStats')
+    PatientDayStats = apps.get_model('app', 'PatientDayStats')
+
+    tz = timezone.get_current_timezone()
+    appointments = Appointment.objects.annotate(day=TruncDate('date_time', tzinfo=tz)).order_by()
+    lines = InvoiceService.objects.annotate(
+        day=TruncDate('invoice__appointment__date_time', tzinfo=tz),
+        doctor_id=F('invoice__appointment__doctor_id'),
+    ).order_by()
+    sources = [
+        (AppointmentDayStats, appointments.values('day', 'doctor_id', 'status').annotate(
+            total_visits=Count('id'), total_duration=Sum('duration'))),
+        (ServiceDayStats, lines.values('day', 'doctor_id', 'service_id').annotate(
+            total_quantity=Sum('quantity'), total_revenue=Sum(F('price_at_time') * F('quantity')))),
+        (PatientDayStats, appointments.values('day', 'doctor_id', 'patient_id').annotate(
+            total_visits=Count('id'))),
+    ]
+    for model, rows in sources:
+        model.objects.all().delete()
+        batch = []
+        for row in rows.iterator(chunk_size=BATCH_SIZE):
+            batch.append(model(**{name.removeprefix('total_'): value for name, value in row.items()}))
+            if len(batch) >= BATCH_SIZE:
+                model.objects.bulk_create(batch)
+                batch = []
+        model.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_appointment_end_time_not_null'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_day_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 6.0.1 on 2026-10-18 23:00
+
+from django.db import migrations, models
+
+
+def _normalize(value):
+    return ' '.join((value or '').casefold().replace('ё', 'е').split())
+
+
+def fill_search_text(apps, schema_editor):
+    User = apps.get_model('app', 'User')
+    batch = []
+    for user in User.objects.only('id', 'last_name', 'first_name', 'middle_name', 'username').iterator(chunk_size=2000):
+        user.search_text = _normalize(f"{user.last_name} {user.first_name} {user.middle_name or ''} {user.username}")
+        batch.append(user)
+    User.objects.bulk_update(batch, ['search_text'], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0022_fill_day_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='search_text',
+            field=models.CharField(blank=True, default='', editable=False, max_length=510),
+        ),
+        migrations.RunPython(fill_search_text, migrations.RunPython.noop),
+    ]
@@ -1,12 +1,17 @@
+import re
+import uuid
 from decimal import Decimal, ROUND_HALF_UP
 from datetime import timedelta
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 from django.core.validators import RegexValidator, MinValueValidator
 
+# Exclusion constraint (PostgreSQL) / триггеры (SQLite), запрещающие пересечение записей врача
+from .database import APPOINTMENT_OVERLAP_CONSTRAINT
+
 
 # ==================== Клиника ====================
 class ClinicInfo(models.Model):
@@ -40,6 +45,8 @@ class User(AbstractUser):
     role = models.CharField('Роль', max_length=20, choices=ROLE_CHOICES, default='doctor')
     phone = models.CharField('Телефон', max_length=20, blank=True)
     middle_name = models.CharField('Отчество', max_length=50, blank=True, null=True)
+    # ФИО и логин в виде normalize_search: поиск персонала без учёта регистра кириллицы (personnel.py)
+    search_text = models.CharField(max_length=510, blank=True, default='', editable=False)
 
     groups = models.ManyToManyField(
         'auth.Group',
@@ -56,8 +63,32 @@ class User(AbstractUser):
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
 
+    def save(self, *args, **kwargs):
+        self.search_text = normalize_search(
+            f"{self.last_name} {self.first_name} {self.middle_name or ''} {self.username}"
+        )
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'search_text'}
+        super().save(*args, **kwargs)
+
+
+def normalize_phone(value):
+    """Цифры номера в формате E.164 без '+': 8XXXXXXXXXX и XXXXXXXXXX (РФ) → 7XXXXXXXXXX"""
+    digits = re.sub(r'\D', '', value or '')
+    if len(digits) == 11 and digits.startswith('8'):
+        digits = '7' + digits[1:]
+    elif len(digits) == 10 and digits.startswith('9'):
+        digits = '7' + digits
+    return digits
+
 
 # ==================== ПАЦИЕНТ ====================
+def normalize_search(value):
+    """Приведение к виду поискового индекса: регистр (в т.ч. кириллица), ё → е, одиночные пробелы"""
+    return ' '.join((value or '').casefold().replace('ё', 'е').split())
+
+
 class Patient(models.Model):
     first_name = models.CharField('Имя', max_length=50)
     last_name = models.CharField('Фамилия', max_length=50)
@@ -69,10 +100,21 @@ class Patient(models.Model):
     notes = models.TextField('Заметки', blank=True)
     created_at = models.DateTimeField('Дата создания', auto_now_add=True)
 
+    # Теневые поля поиска (см. app.search): заполняются в save()
+    search_name = models.CharField(max_length=160, blank=True, default='', db_index=True, editable=False)
+    search_text = models.CharField(max_length=200, blank=True, default='', editable=False)
+    # Телефон цифрами (E.164) и те же цифры задом наперёд: поиск по последним цифрам — префикс по индексу
+    phone_normalized = models.CharField(max_length=20, blank=True, default='', db_index=True, editable=False)
+    phone_reversed = models.CharField(max_length=20, blank=True, default='', db_index=True, editable=False)
+
     class Meta:
         verbose_name = 'Пациент'
         verbose_name_plural = 'Пациенты'
         ordering = ['last_name', 'first_name']
+        indexes = [
+            # Ключ keyset-пагинации списков пациентов (app/pagination.py)
+            models.Index(fields=['last_name', 'first_name', 'id'], name='patient_name_page_idx'),
+        ]
 
     def __str__(self):
         return f"{self.last_name} {self.first_name}"
@@ -80,6 +122,22 @@ class Patient(models.Model):
     def get_full_name(self):
         return f"{self.last_name} {self.first_name}"
 
+    def fill_search_fields(self):
+        self.search_name = normalize_search(f"{self.last_name} {self.first_name} {self.middle_name or ''}")
+        phone_digits = re.sub(r'\D', '', self.phone or '')
+        self.search_text = f"{self.search_name} {phone_digits}".strip()
+        self.phone_normalized = normalize_phone(self.phone)
+        self.phone_reversed = self.phone_normalized[::-1]
+
+    def save(self, *args, **kwargs):
+        self.fill_search_fields()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {
+                *update_fields, 'search_name', 'search_text', 'phone_normalized', 'phone_reversed'
+            }
+        super().save(*args, **kwargs)
+
 
 # ==================== ВРАЧ ====================
 class Doctor(models.Model):
@@ -179,9 +237,37 @@ class Appointment(models.Model):
         ('other', 'Другое'),
     ]
 
+    # Допустимые переходы статуса (app/transitions.py и clean()); в завершённые
+    # и отменённые без отметки неявки записи не возвращаются
+    STATUS_TRANSITIONS = {
+        'scheduled': ('waiting', 'active', 'completed', 'cancelled', 'no_show'),
+        'waiting': ('scheduled', 'active', 'completed', 'cancelled', 'no_show'),
+        'active': ('waiting', 'completed', 'cancelled'),
+        'completed': (),
+        # Отменённую по ошибке запись можно вернуть в расписание (если время ещё свободно)
+        'cancelled': ('scheduled',),
+        'no_show': (),
+    }
+
+    # Поля, изменения которых проверяет clean(): остальные правки валидацию не запускают
+    VALIDATED_FIELDS = (
+        'date_time', 'duration', 'doctor_id', 'patient_id', 'status', 'cancel_reason_type', 'cancel_reason',
+    )
+
+    # Текст причины отмены, если комментарий не заполнен
+    CANCEL_REASON_TEXT = {
+        'patient_cancelled': 'Пациент отменил запись',
+        'doctor_cancelled': 'Врач отменил запись',
+        'emergency': 'Экстренная ситуация',
+        'other': 'Запись отменена',
+    }
+
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, verbose_name='Пациент', related_name='appointments')
     doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, verbose_name='Врач')
     date_time = models.DateTimeField('Дата и время приема')
+    # Хранимое окончание приёма: по нему БД отбирает пересекающиеся записи диапазонным запросом.
+    # NOT NULL: NULL дал бы неограниченный диапазон в PostgreSQL и пропуск проверки в триггере SQLite
+    end_time = models.DateTimeField('Окончание приема', blank=True, editable=False)
     status = models.CharField('Статус', max_length=20, choices=STATUS_CHOICES, default='scheduled')
 
     duration = models.IntegerField(
@@ -205,6 +291,8 @@ class Appointment(models.Model):
     treatment = models.TextField('Лечение', blank=True)
     cancel_reason = models.TextField('Причина отмены (комментарий)', blank=True)
     notes = models.TextField('Заметки врача', blank=True)
+    # Оказанные услуги: по ним команда close_day выставляет счёт (app/billing.py)
+    services = models.ManyToManyField(Service, blank=True, verbose_name='Оказанные услуги', related_name='appointments')
     created_at = models.DateTimeField('Дата создания', auto_now_add=True)
     updated_at = models.DateTimeField('Дата обновления', auto_now=True)
 
@@ -212,6 +300,10 @@ class Appointment(models.Model):
         verbose_name = 'Запись на прием'
         verbose_name_plural = 'Записи на прием'
         ordering = ['-date_time']
+        indexes = [
+            models.Index(fields=['doctor', 'date_time'], name='appointment_doctor_time_idx'),
+            models.Index(fields=['status', 'date_time'], name='appointment_status_time_idx'),
+        ]
         # Partial index/condition: работает в PostgreSQL. Если используете SQLite в dev — учтите ограничение.
         constraints = [
             models.UniqueConstraint(
@@ -221,28 +313,58 @@ class Appointment(models.Model):
             )
         ]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Значения из БД: clean() проверяет только то, что с тех пор изменилось
+        instance._loaded = {
+            field: getattr(instance, field) for field in cls.VALIDATED_FIELDS if field in instance.__dict__
+        }
+        return instance
+
+    def changed_fields(self):
+        """Поля из VALIDATED_FIELDS, изменённые после загрузки (у новой записи — все)"""
+        loaded = getattr(self, '_loaded', None)
+        if self._state.adding or loaded is None:
+            return set(self.VALIDATED_FIELDS)
+        return {
+            field for field in self.VALIDATED_FIELDS
+            if field not in loaded or getattr(self, field) != loaded[field]
+        }
+
     def clean(self):
-        """ВАЛИДАЦИЯ ПЕРЕД СОХРАНЕНИЕМ"""
+        """ВАЛИДАЦИЯ ПЕРЕД СОХРАНЕНИЕМ (только изменённых полей)"""
         super().clean()
         errors = {}
+        changed = self.changed_fields()
 
         #  Проверка: запись не в прошлом
-        if self.date_time and self.date_time < timezone.now():
+        if 'date_time' in changed and self.date_time and self.date_time < timezone.now():
             errors['date_time'] = 'Нельзя записывать на прошедшее время'
 
         # ✅ Проверка: время кратно 10 минутам (только минуты)
-        if self.date_time and self.date_time.minute % 10 != 0:
+        if 'date_time' in changed and self.date_time and self.date_time.minute % 10 != 0:
             errors['date_time'] = 'Время должно быть кратно 10 минутам (например: 10:00, 10:10, 10:20)'
 
         # Проверка: длительность кратна 10 минутам
-        if self.duration and self.duration % 10 != 0:
+        if 'duration' in changed and self.duration and self.duration % 10 != 0:
             errors['duration'] = '⏱️ Длительность должна быть кратна 10 минутам'
 
         # Проверка: врач активен
-        if self.doctor and not self.doctor.is_active:
+        if 'doctor_id' in changed and self.doctor_id and not self.doctor.is_active:
             errors['doctor'] = '🚫 Этот врач временно не принимает (в отпуске или уволен)'
 
-        if self.status == 'scheduled' and self.date_time and self.doctor:
+        # Проверка: переход статуса допустим
+        if 'status' in changed and not self._state.adding:
+            old_status = self._loaded.get('status')
+            if old_status and self.status not in self.STATUS_TRANSITIONS.get(old_status, ()):
+                errors['status'] = (
+                    f'Нельзя перевести запись из «{dict(self.STATUS_CHOICES).get(old_status, old_status)}» '
+                    f'в «{self.get_status_display()}»'
+                )
+
+        overlap_fields = {'date_time', 'duration', 'doctor_id', 'status'}
+        if self.status == 'scheduled' and self.date_time and self.doctor_id and changed & overlap_fields:
             overlap_error = self._check_time_overlap()
             if overlap_error:
                 errors['date_time'] = overlap_error
@@ -255,54 +377,92 @@ class Appointment(models.Model):
         if errors:
             raise ValidationError(errors)
 
+    def get_end_time(self):
+        """Окончание приёма по дате начала и длительности"""
+        if not self.date_time or not self.duration:
+            return None
+        return self.date_time + timedelta(minutes=self.duration)
+
+    @classmethod
+    def find_overlapping(cls, doctor, start, end, exclude_pk=None):
+        """
+        Запланированные записи врача, пересекающиеся с интервалом [start, end).
+        БД отбирает только кандидатов в окне нового слота по хранимому end_time.
+        """
+        overlapping = cls.objects.filter(
+            doctor=doctor,
+            status='scheduled',
+            date_time__lt=end,
+            end_time__gt=start,
+        ).order_by('date_time')
+        if exclude_pk:
+            overlapping = overlapping.exclude(pk=exclude_pk)
+        return overlapping
+
     def _check_time_overlap(self):
         """Проверка пересечения времени у врача"""
         if not self.doctor or not self.date_time:
             return None
 
-        end_time = self.date_time + timedelta(minutes=self.duration)
-
-        overlapping = Appointment.objects.filter(
-            doctor=self.doctor,
-            status='scheduled'
-        ).exclude(pk=self.pk if self.pk else None)
-
-        for appointment in overlapping:
-            appt_end = appointment.date_time + timedelta(minutes=appointment.duration)
-            if (self.date_time < appt_end and end_time > appointment.date_time):
-                return (
-                    f"⏰ ВРЕМЯ ЗАНЯТО!\n"
-                    f"У врача {self.doctor} уже есть запись:\n"
-                    f"• Пациент: {appointment.patient}\n"
-                    f"• Время: {appointment.date_time.strftime('%d.%m.%Y %H:%M')}\n"
-                    f"• Длительность: {appointment.duration} мин\n"
-                    f"• Окончание: {appt_end.strftime('%H:%M')}"
-                )
-        return None
+        end_time = self.get_end_time()
+        appointment = (
+            Appointment.find_overlapping(self.doctor, self.date_time, end_time, exclude_pk=self.pk)
+            .select_related('patient')
+            .first()
+        )
+        if appointment is None:
+            return None
+
+        return (
+            f"⏰ ВРЕМЯ ЗАНЯТО!\n"
+            f"У врача {self.doctor} уже есть запись:\n"
+            f"• Пациент: {appointment.patient}\n"
+            f"• Время: {appointment.date_time.strftime('%d.%m.%Y %H:%M')}\n"
+            f"• Длительность: {appointment.duration} мин\n"
+            f"• Окончание: {appointment.end_time.strftime('%H:%M')}"
+        )
 
     def get_time_slot_display(self):
         """Отображение временного слота"""
         if not self.date_time:
             return ""
-        end_time = self.date_time + timedelta(minutes=self.duration)
+        end_time = self.get_end_time()
         return f"{self.date_time.strftime('%H:%M')} - {end_time.strftime('%H:%M')}"
 
     def save(self, *args, **kwargs):
         """Автоматическая валидация и заполнение при сохранении"""
-        # Вызываем полную валидацию
-        self.full_clean()
+        # Валидация изменённых полей: неизменённые поля и ограничения на них не перепроверяются
+        changed = self.changed_fields()
+        unchanged = [
+            field.name for field in self._meta.concrete_fields
+            if field.attname in self.VALIDATED_FIELDS and field.attname not in changed
+        ]
+        self.full_clean(exclude=unchanged)
+
+        # Окончание приёма храним в БД для диапазонной проверки пересечений
+        self.end_time = self.get_end_time()
 
         # Автоматически заполняем поля при отмене
+        filled = {'end_time'}
         if self.status == 'cancelled' and not self.cancel_reason and self.cancel_reason_type:
-            reason_map = {
-                'patient_cancelled': 'Пациент отменил запись',
-                'doctor_cancelled': 'Врач отменил запись',
-                'emergency': 'Экстренная ситуация',
-                'other': 'Запись отменена',
-            }
-            self.cancel_reason = reason_map.get(self.cancel_reason_type, 'Запись отменена')
-
-        super().save(*args, **kwargs)
+            self.cancel_reason = self.CANCEL_REASON_TEXT.get(self.cancel_reason_type, 'Запись отменена')
+            filled.add('cancel_reason')
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, *filled}
+
+        try:
+            # Savepoint: после нарушения ограничения транзакция остаётся пригодной для запроса ниже
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+        except IntegrityError as e:
+            if APPOINTMENT_OVERLAP_CONSTRAINT not in str(e):
+                raise
+            raise ValidationError({
+                'date_time': self._check_time_overlap() or '⏰ ВРЕМЯ ЗАНЯТО!'
+            })
+        self._loaded = {field: getattr(self, field) for field in self.VALIDATED_FIELDS}
 
     def __str__(self):
         if not self.date_time:
@@ -314,7 +474,9 @@ class Appointment(models.Model):
 # ==================== СЧЕТ ====================
 class Invoice(models.Model):
     appointment = models.OneToOneField(Appointment, on_delete=models.CASCADE, verbose_name='Запись')
+    # Сумма и число строк ведутся сигналами InvoiceService (rollups.line_changed); сверка — verify_invoice_totals
     total_amount = models.DecimalField('Общая сумма', max_digits=10, decimal_places=2, default=Decimal('0.00'))
+    items_count = models.IntegerField('Количество услуг', default=0)
     discount_applied = models.IntegerField('Примененная скидка', default=0)
     final_amount = models.DecimalField('Итоговая сумма', max_digits=10, decimal_places=2, default=Decimal('0.00'))
     is_paid = models.BooleanField('Оплачен', default=False)
@@ -336,14 +498,37 @@ class Invoice(models.Model):
     def __str__(self):
         return f"Счет #{self.id} - {self.final_amount} руб."
 
+    @staticmethod
+    def final_amount_of(total_amount, discount):
+        """Итоговая сумма со скидкой в процентах (Decimal, округление до копеек)"""
+        total = Decimal(total_amount) if total_amount is not None else Decimal('0.00')
+        discount_factor = (Decimal(100) - Decimal(discount or 0)) / Decimal(100)
+        return (total * discount_factor).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+    # Поля, которые меняет только rollups._add_to_invoice (F()) и verify_invoice_totals
+    COUNTER_FIELDS = ('total_amount', 'items_count')
+
     def save(self, *args, **kwargs):
-        # Используем Decimal для точных вычислений и округления
-        total = Decimal(self.total_amount) if self.total_amount is not None else Decimal('0.00')
-        discount = Decimal(self.discount_applied or 0)
-        discount_factor = (Decimal(100) - discount) / Decimal(100)
-        calculated = (total * discount_factor).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
-        self.final_amount = calculated
-        super().save(*args, **kwargs)
+        if self._state.adding or self.pk is None:
+            # Используем Decimal для точных вычислений и округления
+            self.final_amount = self.final_amount_of(self.total_amount, self.discount_applied)
+            return super().save(*args, **kwargs)
+
+        with transaction.atomic():
+            # Сумма и число строк на экземпляре могли устареть: берём их из БД под блокировкой
+            # и не перезаписываем, итог со скидкой считаем от хранимой суммы
+            stored = Invoice.objects.select_for_update().filter(pk=self.pk).values(*self.COUNTER_FIELDS).first()
+            if stored is None:
+                return super().save(*args, **kwargs)
+            for field, value in stored.items():
+                setattr(self, field, value)
+            self.final_amount = self.final_amount_of(self.total_amount, self.discount_applied)
+
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+            kwargs['update_fields'] = (set(update_fields) | {'final_amount'}) - set(self.COUNTER_FIELDS)
+            super().save(*args, **kwargs)
 
 
 # ==================== УСЛУГИ В СЧЕТЕ ====================
@@ -367,16 +552,122 @@ class InvoiceService(models.Model):
         super().save(*args, **kwargs)
 
 
+# ==================== ФАЙЛЫ ДОКУМЕНТОВ ====================
+class Blob(models.Model):
+    """Содержимое файла по SHA-256: одинаковые файлы хранятся одной копией (app/uploads.py)"""
+    sha256 = models.CharField('SHA-256', max_length=64, unique=True)
+    size = models.BigIntegerField('Размер (байт)')
+    # Документы и завершённые, но ещё не прикреплённые загрузки; при нуле файл удаляется
+    ref_count = models.PositiveIntegerField('Ссылок', default=0)
+    created_at = models.DateTimeField('Дата создания', auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Файл'
+        verbose_name_plural = 'Файлы'
+
+    def __str__(self):
+        return self.sha256
+
+    @staticmethod
+    def name_for(sha256):
+        """Путь в MEDIA_ROOT по хэшу содержимого"""
+        return f'blobs/{sha256[:2]}/{sha256[2:4]}/{sha256}'
+
+    @property
+    def name(self):
+        return self.name_for(self.sha256)
+
+
+class Upload(models.Model):
+    """Загрузка файла частями с продолжением после обрыва"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    filename = models.CharField('Имя файла', max_length=255)
+    size = models.BigIntegerField('Размер (байт)')
+    received = models.BigIntegerField('Получено (байт)', default=0)
+    # Конец части, которая сейчас пишется на диск: следующая часть и завершение ждут её
+    pending = models.BigIntegerField('Принимается до (байт)', null=True, blank=True)
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, null=True, blank=True, verbose_name='Файл', related_name='+')
+    created_by = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, blank=True, verbose_name='Загрузил', related_name='+'
+    )
+    created_at = models.DateTimeField('Дата создания', auto_now_add=True)
+    updated_at = models.DateTimeField('Дата обновления', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Загрузка'
+        verbose_name_plural = 'Загрузки'
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size})"
+
+
 # models.py
 class Document(models.Model):
     title = models.CharField('Название', max_length=200)
     description = models.TextField('Описание', blank=True)
     file = models.FileField('Файл', upload_to='documents/', blank=True, null=True)
+    # Файл из хранилища по хэшу (file указывает на тот же путь); у старых документов пусто
+    blob = models.ForeignKey(
+        Blob, on_delete=models.PROTECT, null=True, blank=True, editable=False, verbose_name='Содержимое',
+        related_name='documents'
+    )
+    filename = models.CharField('Имя файла', max_length=255, blank=True)
     created_at = models.DateTimeField('Дата создания', auto_now_add=True)
 
     class Meta:
         verbose_name = 'Документ'
         verbose_name_plural = 'Документы'
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='document_created_page_idx'),
+        ]
 
     def __str__(self):
         return self.title
+
+
+# ==================== СТАТИСТИКА (ДНЕВНЫЕ СВОДКИ) ====================
+# Поддерживаются инкрементально (app/rollups.py), пересобираются командой rebuild_rollups.
+# День — календарная дата записи в часовом поясе клиники.
+class AppointmentDayStats(models.Model):
+    day = models.DateField('День')
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, verbose_name='Врач', related_name='+')
+    status = models.CharField('Статус', max_length=20)
+    visits = models.IntegerField('Записей', default=0)
+    duration = models.IntegerField('Минут', default=0)
+
+    class Meta:
+        verbose_name = 'Сводка записей за день'
+        verbose_name_plural = 'Сводки записей за день'
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'doctor', 'status'], name='appointment_day_stats_key'),
+        ]
+
+
+class ServiceDayStats(models.Model):
+    day = models.DateField('День')
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, verbose_name='Врач', related_name='+')
+    service = models.ForeignKey(Service, on_delete=models.CASCADE, verbose_name='Услуга', related_name='+')
+    quantity = models.IntegerField('Количество', default=0)
+    revenue = models.DecimalField('Выручка', max_digits=14, decimal_places=2, default=Decimal('0.00'))
+
+    class Meta:
+        verbose_name = 'Сводка услуг за день'
+        verbose_name_plural = 'Сводки услуг за день'
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'doctor', 'service'], name='service_day_stats_key'),
+        ]
+
+
+class PatientDayStats(models.Model):
+    """Пациенты, бывшие у врача в этот день: уникальных пациентов нельзя сложить из счётчиков"""
+    day = models.DateField('День')
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, verbose_name='Врач', related_name='+')
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, verbose_name='Пациент', related_name='+')
+    visits = models.IntegerField('Записей', default=0)
+
+    class Meta:
+        verbose_name = 'Сводка пациентов за день'
+        verbose_name_plural = 'Сводки пациентов за день'
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'doctor', 'patient'], name='patient_day_stats_key'),
+        ]
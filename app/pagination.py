@@ -0,0 +1,104 @@
+"""
+Keyset-пагинация списков: страница — это «следующие limit строк после ключа».
+
+Ключ — значения полей сортировки последней строки (например, фамилия, имя, id),
+упакованные в подписанный непрозрачный курсор. Условие «после ключа» идёт
+по индексу, поэтому страница на любой глубине стоит столько же, сколько первая
+(в отличие от OFFSET, который перебирает все пропущенные строки).
+"""
+import datetime
+import json
+
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+_SALT = 'app.pagination'
+
+
+class CursorError(ValueError):
+    pass
+
+
+class _CursorEncoder(DjangoJSONEncoder):
+    # DjangoJSONEncoder обрезает время до миллисекунд — строки из той же миллисекунды выпали бы из списка
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+class _CursorSerializer:
+    # Даты и Decimal в ключе сериализуются строками — фильтр по полю примет их обратно
+    def dumps(self, obj):
+        return json.dumps(obj, cls=_CursorEncoder, separators=(',', ':')).encode('latin-1')
+
+    def loads(self, data):
+        return json.loads(data.decode('latin-1'))
+
+
+def encode_cursor(values):
+    return signing.dumps(list(values), salt=_SALT, serializer=_CursorSerializer)
+
+
+def decode_cursor(cursor, size):
+    try:
+        values = signing.loads(cursor, salt=_SALT, serializer=_CursorSerializer)
+    except (signing.BadSignature, ValueError):
+        raise CursorError('Некорректный курсор')
+    if not isinstance(values, list) or len(values) != size:
+        raise CursorError('Курсор не подходит к этому списку')
+    return values
+
+
+def after(fields, values, descending=False):
+    """
+    Q «строка идёт после ключа values» при сортировке по fields.
+    Первое поле дублируется нестрогим сравнением, чтобы СУБД начала с диапазона по индексу.
+    """
+    op = 'lt' if descending else 'gt'
+    condition = Q(**{f'{fields[-1]}__{op}': values[-1]})
+    for field, value in zip(reversed(fields[:-1]), reversed(values[:-1])):
+        condition = Q(**{f'{field}__{op}': value}) | (Q(**{field: value}) & condition)
+    return Q(**{f'{fields[0]}__{op}e': values[0]}) & condition
+
+
+def order(fields, descending=False):
+    return [f'-{field}' if descending else field for field in fields]
+
+
+def _value(item, field):
+    if isinstance(item, dict):
+        return item[field]
+    for name in field.split('__'):
+        item = getattr(item, name)
+    return item
+
+
+def page_size(value, default=DEFAULT_PAGE_SIZE):
+    """Размер страницы из параметра запроса"""
+    try:
+        size = int(value) if value not in (None, '') else default
+    except ValueError:
+        raise CursorError('Некорректный limit')
+    if not 1 <= size <= MAX_PAGE_SIZE:
+        raise CursorError(f'limit должен быть от 1 до {MAX_PAGE_SIZE}')
+    return size
+
+
+def paginate(queryset, fields, cursor=None, limit=DEFAULT_PAGE_SIZE, descending=False):
+    """
+    Страница queryset, отсортированного по fields (последнее поле уникально, обычно id).
+    Возвращает (строки, курсор следующей страницы или None).
+    Строки — модели или словари values(); поля ключа должны в них быть.
+    """
+    if cursor:
+        queryset = queryset.filter(after(fields, decode_cursor(cursor, len(fields)), descending))
+    # Лишняя строка показывает, есть ли следующая страница, без COUNT
+    items = list(queryset.order_by(*order(fields, descending))[:limit + 1])
+    if len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    return items, encode_cursor([_value(items[-1], field) for field in fields])
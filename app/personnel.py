@@ -0,0 +1,111 @@
+"""
+Справочник персонала: врачи, медсёстры и регистраторы одним загрузчиком.
+
+Строки читаются через values() с JOIN таблицы пользователей, поэтому список
+любой длины — это один запрос на роль (без догрузки User на каждую строку).
+Общий список всех ролей — UNION ALL трёх запросов, страницы по курсору
+(pagination.py): один запрос на страницу.
+"""
+from django.db.models import CharField, F, Q, Value
+
+from .models import Doctor, Nurse, Receptionist, User, normalize_search
+from .pagination import DEFAULT_PAGE_SIZE, after, decode_cursor, encode_cursor, paginate
+from .serializers import Field, Serializer, full_name
+
+ROLES = {
+    'doctor': {'model': Doctor, 'fields': ('specialty', 'room')},
+    'nurse': {'model': Nurse, 'fields': ('department', 'room')},
+    'receptionist': {'model': Receptionist, 'fields': ('office',)},
+}
+ROLE_LABELS = dict(User.ROLE_CHOICES)
+# Поля ролей, которых нет у других ролей, в общем списке пустые
+EXTRA_FIELDS = ('specialty', 'department', 'office', 'room')
+COLUMNS = ('id', 'role', 'last_name', 'first_name', 'middle_name', 'username', 'is_active') + EXTRA_FIELDS
+# Порядок общего списка; id повторяются между ролями, поэтому в ключе есть роль
+ORDERING = ('last_name', 'first_name', 'role', 'id')
+
+
+class PersonnelError(ValueError):
+    pass
+
+
+def _search(query):
+    # search_text уже приведён normalize_search: icontains в SQLite не складывает регистр кириллицы
+    conditions = Q()
+    for term in normalize_search(query).split():
+        conditions &= Q(user__search_text__contains=term)
+    return conditions
+
+
+def staff_rows(role, query=''):
+    """values()-queryset сотрудников роли с колонками COLUMNS"""
+    spec = ROLES[role]
+    own = spec['fields']
+    return (
+        spec['model'].objects.filter(_search(query))
+        .annotate(
+            role=Value(role, output_field=CharField()),
+            last_name=F('user__last_name'),
+            first_name=F('user__first_name'),
+            middle_name=F('user__middle_name'),
+            username=F('user__username'),
+            **{field: Value('', output_field=CharField()) for field in EXTRA_FIELDS if field not in own},
+        )
+        .values(*COLUMNS)
+        .order_by('last_name', 'first_name', 'id')
+    )
+
+
+FULL_NAME = Field('last_name', 'first_name', 'middle_name', format=full_name)
+
+# Формат api_doctors_list / api_nurses_list / api_receptionists_list
+LEGACY = {
+    role: Serializer({
+        'id': 'id',
+        'full_name': FULL_NAME,
+        **{field: field for field in spec['fields']},
+        'is_active': 'is_active',
+        'user_username': 'username',
+    })
+    for role, spec in ROLES.items()
+}
+
+STAFF = Serializer({
+    'id': 'id',
+    'role': 'role',
+    'role_label': Field('role', format=lambda role: ROLE_LABELS.get(role, role)),
+    'full_name': FULL_NAME,
+    'username': 'username',
+    'is_active': 'is_active',
+    **{field: Field(field, format=lambda value: value or '') for field in EXTRA_FIELDS},
+})
+
+
+def staff_list(role, query='', cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """Страница сотрудников роли одним запросом: (строки, курсор следующей страницы)"""
+    rows, next_cursor = paginate(staff_rows(role, query), ('last_name', 'first_name', 'id'), cursor, limit)
+    return LEGACY[role].many(rows), next_cursor
+
+
+def staff_detail(role, pk):
+    row = staff_rows(role).filter(pk=pk).first()
+    return LEGACY[role].one(row) if row else None
+
+
+def load_personnel(roles=None, query='', cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """Страница общего списка персонала ролей roles (по умолчанию — всех) после курсора"""
+    roles = list(roles or ROLES)
+    for role in roles:
+        if role not in ROLES:
+            raise PersonnelError(f'Неизвестная роль: {role}')
+
+    # Условие курсора ставится в каждую часть UNION: отфильтровать объединение целиком нельзя
+    keyset = after(ORDERING, decode_cursor(cursor, len(ORDERING))) if cursor else Q()
+    queries = [staff_rows(role, query).filter(keyset).order_by() for role in roles]
+    combined = queries[0].union(*queries[1:], all=True) if len(queries) > 1 else queries[0]
+    rows = list(combined.order_by(*ORDERING)[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][field] for field in ORDERING])
+    return {'results': STAFF.many(rows), 'next_cursor': next_cursor}
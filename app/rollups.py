@@ -0,0 +1,342 @@
+"""
+Дневные сводки статистики: AppointmentDayStats, ServiceDayStats, PatientDayStats.
+
+Сводки меняются на разницу между старым и новым состоянием записи или строки
+счёта в той же транзакции, что и сама запись (сигналы в signals.py). Массовые
+смены статуса (transitions.bulk_change_status) и счета закрытия дня
+(billing.close_day) вносят дельты пачкой через add_many(). Расхождения
+(правки в обход ORM) исправляет команда rebuild_rollups.
+
+Также ведутся итоги самих счетов: сумма, число строк и итог со скидкой
+меняются на разницу строки через F(); сверку делает verify_invoice_totals.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import (
+    Appointment, AppointmentDayStats, Invoice, InvoiceService, PatientDayStats, ServiceDayStats,
+)
+from .schedule import day_range
+from .stats_cache import touch_all, touch_days
+
+APPOINTMENT_STATE_FIELDS = ('date_time', 'doctor_id', 'patient_id', 'status', 'duration')
+
+
+def local_day(value):
+    return timezone.localtime(value).date()
+
+
+def _add(model, key, **deltas):
+    """Прибавляет deltas к строке сводки key (создаёт строку, если её нет)"""
+    if not any(deltas.values()):
+        return
+    # Закэшированная статистика с этим днём устаревает после фиксации транзакции
+    transaction.on_commit(lambda: touch_days([key['day']]))
+    updates = {field: F(field) + delta for field, delta in deltas.items()}
+    if model.objects.filter(**key).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**key, **deltas)
+    except IntegrityError:
+        # Строку только что создала параллельная транзакция
+        model.objects.filter(**key).update(**updates)
+
+
+def add_many(model, key_fields, deltas):
+    """
+    _add для многих строк сводки: deltas {значения key_fields: {поле: дельта}}.
+    Существующие строки читаются с блокировкой и пишутся одним bulk_update,
+    недостающие — одним bulk_create: число запросов не зависит от числа ключей.
+    """
+    deltas = {key: fields for key, fields in deltas.items() if any(fields.values())}
+    if not deltas:
+        return
+    day_index = key_fields.index('day')
+    transaction.on_commit(lambda: touch_days({key[day_index] for key in deltas}))
+
+    # Выборка по каждому полю ключа отдельно — надмножество нужных строк, лишние отбрасываются
+    candidates = model.objects.select_for_update().filter(**{
+        f'{field}__in': {key[index] for key in deltas} for index, field in enumerate(key_fields)
+    })
+    existing = []
+    for row in candidates:
+        key = tuple(getattr(row, field) for field in key_fields)
+        if key in deltas:
+            for field, delta in deltas[key].items():
+                setattr(row, field, getattr(row, field) + delta)
+            existing.append(row)
+    changed = sorted({field for fields in deltas.values() for field in fields})
+    if existing:
+        model.objects.bulk_update(existing, changed)
+
+    found = {tuple(getattr(row, field) for field in key_fields) for row in existing}
+    missing = [key for key in deltas if key not in found]
+    if not missing:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create([model(**dict(zip(key_fields, key)), **deltas[key]) for key in missing])
+    except IntegrityError:
+        # Часть строк только что создали параллельные транзакции
+        for key in missing:
+            _add(model, dict(zip(key_fields, key)), **deltas[key])
+
+
+# ---------- Записи ----------
+def appointment_state(pk):
+    """Поля записи, от которых зависят сводки, в том виде, в каком они лежат в БД"""
+    row = Appointment.objects.filter(pk=pk).values(*APPOINTMENT_STATE_FIELDS).first()
+    return _state(row) if row else None
+
+
+def appointment_state_of(appointment):
+    return _state({field: getattr(appointment, field) for field in APPOINTMENT_STATE_FIELDS})
+
+
+def appointment_state_of_row(row):
+    """Состояние из строки с date_time, doctor_id, patient_id, status, duration"""
+    return _state(row)
+
+
+def _state(row):
+    state = dict(row)
+    state['day'] = local_day(state.pop('date_time'))
+    return state
+
+
+def _apply_appointment(state, sign, patients=True):
+    _add(
+        AppointmentDayStats,
+        {'day': state['day'], 'doctor_id': state['doctor_id'], 'status': state['status']},
+        visits=sign, duration=sign * (state['duration'] or 0),
+    )
+    if patients:
+        _add(
+            PatientDayStats,
+            {'day': state['day'], 'doctor_id': state['doctor_id'], 'patient_id': state['patient_id']},
+            visits=sign,
+        )
+
+
+def appointment_changed(pk, old, new):
+    """Переносит запись в сводках из состояния old в new (None — записи нет)"""
+    if old == new:
+        return
+    same_patient_day = bool(old and new) and all(
+        old[field] == new[field] for field in ('day', 'doctor_id', 'patient_id')
+    )
+    if old:
+        _apply_appointment(old, -1, patients=not same_patient_day)
+    if new:
+        _apply_appointment(new, +1, patients=not same_patient_day)
+
+    # Услуги счёта привязаны ко дню и врачу записи
+    if old and new and (old['day'], old['doctor_id']) != (new['day'], new['doctor_id']):
+        for line in _appointment_lines(pk):
+            service = line.pop('service_id')
+            _apply_line({'day': old['day'], 'doctor_id': old['doctor_id'], 'service_id': service}, line, -1)
+            _apply_line({'day': new['day'], 'doctor_id': new['doctor_id'], 'service_id': service}, line, +1)
+
+
+def statuses_changed(rows, status):
+    """Перенос записей rows (date_time, doctor_id, status, duration — до смены) в статус status"""
+    moved = defaultdict(lambda: {'visits': 0, 'duration': 0})
+    for row in rows:
+        day, doctor_id = local_day(row['date_time']), row['doctor_id']
+        for key, sign in (((day, doctor_id, row['status']), -1), ((day, doctor_id, status), +1)):
+            moved[key]['visits'] += sign
+            moved[key]['duration'] += sign * (row['duration'] or 0)
+    add_many(AppointmentDayStats, ('day', 'doctor_id', 'status'), moved)
+
+
+# ---------- Услуги в счетах ----------
+def _appointment_lines(appointment_id):
+    lines = (
+        InvoiceService.objects.filter(invoice__appointment_id=appointment_id)
+        .values('service_id')
+        .annotate(total_quantity=Sum('quantity'), total_revenue=Sum(F('price_at_time') * F('quantity')))
+    )
+    return [
+        {'service_id': line['service_id'], 'quantity': line['total_quantity'], 'revenue': line['total_revenue']}
+        for line in lines
+    ]
+
+
+def _apply_line(key, line, sign):
+    _add(ServiceDayStats, key, quantity=sign * line['quantity'], revenue=sign * line['revenue'])
+
+
+def line_state(pk):
+    row = InvoiceService.objects.filter(pk=pk).values('invoice_id', 'service_id', 'quantity', 'price_at_time').first()
+    return _line_state(row) if row else None
+
+
+def line_state_of(line):
+    return _line_state({
+        'invoice_id': line.invoice_id,
+        'service_id': line.service_id,
+        'quantity': line.quantity,
+        'price_at_time': line.price_at_time,
+    })
+
+
+def _line_state(row):
+    appointment = Invoice.objects.filter(pk=row['invoice_id']).values(
+        'appointment__date_time', 'appointment__doctor_id'
+    ).first()
+    if appointment is None:
+        return None
+    return {
+        'invoice_id': row['invoice_id'],
+        'key': {
+            'day': local_day(appointment['appointment__date_time']),
+            'doctor_id': appointment['appointment__doctor_id'],
+            'service_id': row['service_id'],
+        },
+        'quantity': row['quantity'],
+        'revenue': row['price_at_time'] * row['quantity'],
+    }
+
+
+def line_changed(old, new):
+    if old == new:
+        return
+    if old:
+        _apply_line(old['key'], old, -1)
+    if new:
+        _apply_line(new['key'], new, +1)
+    _line_totals_changed(old, new)
+
+
+# ---------- Итоги счетов ----------
+def _add_to_invoice(invoice_id, amount, count):
+    """Прибавляет к сумме и числу строк счёта; итоговая сумма пересчитывается со скидкой счёта"""
+    if not amount and not count:
+        return
+    with transaction.atomic():
+        # Счёт заблокирован до конца транзакции: итог со скидкой считается от той же суммы, что и F()
+        row = Invoice.objects.select_for_update().filter(pk=invoice_id).values(
+            'total_amount', 'discount_applied'
+        ).first()
+        if row is None:
+            return
+        Invoice.objects.filter(pk=invoice_id).update(
+            total_amount=F('total_amount') + amount,
+            items_count=F('items_count') + count,
+            final_amount=Invoice.final_amount_of(row['total_amount'] + amount, row['discount_applied']),
+        )
+
+
+def _line_totals_changed(old, new):
+    if old and new and old['invoice_id'] == new['invoice_id']:
+        _add_to_invoice(new['invoice_id'], new['revenue'] - old['revenue'], 0)
+        return
+    if old:
+        _add_to_invoice(old['invoice_id'], -old['revenue'], -1)
+    if new:
+        _add_to_invoice(new['invoice_id'], new['revenue'], +1)
+
+
+def verify_invoice_totals(chunk_size=2000, repair=True):
+    """
+    Сверяет total_amount, items_count и final_amount счетов со строками пачками
+    по chunk_size счетов; при repair исправляет расхождения. Возвращает
+    (проверено счетов, {id счёта: (сохранённые итоги, правильные итоги)}).
+    """
+    checked, drift, after_id = 0, {}, 0
+    while True:
+        with transaction.atomic():
+            invoices = list(
+                Invoice.objects.filter(pk__gt=after_id).order_by('pk').select_for_update()
+                .values('id', 'total_amount', 'items_count', 'discount_applied', 'final_amount')[:chunk_size]
+            )
+            if not invoices:
+                break
+            after_id = invoices[-1]['id']
+            lines = {
+                row['invoice_id']: row for row in
+                InvoiceService.objects.filter(invoice_id__in=[invoice['id'] for invoice in invoices])
+                .values('invoice_id').annotate(total=Sum(F('price_at_time') * F('quantity')), count=Count('id'))
+                .order_by()
+            }
+            repaired = []
+            for invoice in invoices:
+                line = lines.get(invoice['id'], {'total': 0, 'count': 0})
+                total = Decimal(line['total'] or 0).quantize(Decimal('0.01'))
+                expected = (total, line['count'], Invoice.final_amount_of(total, invoice['discount_applied']))
+                stored = (invoice['total_amount'], invoice['items_count'], invoice['final_amount'])
+                if stored != expected:
+                    drift[invoice['id']] = (stored, expected)
+                    repaired.append(Invoice(
+                        pk=invoice['id'], total_amount=expected[0], items_count=expected[1], final_amount=expected[2],
+                    ))
+            if repair and repaired:
+                Invoice.objects.bulk_update(repaired, ['total_amount', 'items_count', 'final_amount'])
+            checked += len(invoices)
+    return checked, drift
+
+
+def lines_added(lines):
+    """Строки счетов, вставленные bulk_create: dict с day, doctor_id, service_id, quantity, revenue"""
+    added = defaultdict(lambda: {'quantity': 0, 'revenue': 0})
+    for line in lines:
+        key = (line['day'], line['doctor_id'], line['service_id'])
+        added[key]['quantity'] += line['quantity']
+        added[key]['revenue'] += line['revenue']
+    add_many(ServiceDayStats, ('day', 'doctor_id', 'service_id'), added)
+
+
+# ---------- Полная пересборка ----------
+def rebuild(start=None, end=None, batch_size=2000):
+    """Пересчитывает сводки за дни [start, end] (по умолчанию — за всё время) из исходных таблиц"""
+    tz = timezone.get_current_timezone()
+    appointments = Appointment.objects.all()
+    lines = InvoiceService.objects.all()
+    stats = [AppointmentDayStats.objects.all(), ServiceDayStats.objects.all(), PatientDayStats.objects.all()]
+    if start:
+        appointments = appointments.filter(date_time__gte=day_range(start)[0])
+        lines = lines.filter(invoice__appointment__date_time__gte=day_range(start)[0])
+        stats = [qs.filter(day__gte=start) for qs in stats]
+    if end:
+        appointments = appointments.filter(date_time__lt=day_range(end)[1])
+        lines = lines.filter(invoice__appointment__date_time__lt=day_range(end)[1])
+        stats = [qs.filter(day__lte=end) for qs in stats]
+
+    appointments = appointments.annotate(day=TruncDate('date_time', tzinfo=tz)).order_by()
+    lines = lines.annotate(
+        day=TruncDate('invoice__appointment__date_time', tzinfo=tz),
+        doctor_id=F('invoice__appointment__doctor_id'),
+    ).order_by()
+
+    # Агрегаты называются total_*, чтобы не совпадать с полями исходных моделей
+    sources = [
+        (AppointmentDayStats, appointments.values('day', 'doctor_id', 'status').annotate(
+            total_visits=Count('id'), total_duration=Sum('duration'))),
+        (ServiceDayStats, lines.values('day', 'doctor_id', 'service_id').annotate(
+            total_quantity=Sum('quantity'), total_revenue=Sum(F('price_at_time') * F('quantity')))),
+        (PatientDayStats, appointments.values('day', 'doctor_id', 'patient_id').annotate(
+            total_visits=Count('id'))),
+    ]
+
+    created = {}
+    with transaction.atomic():
+        for qs in stats:
+            qs.delete()
+        for model, rows in sources:
+            batch, count = [], 0
+            for row in rows.iterator(chunk_size=batch_size):
+                batch.append(model(**{name.removeprefix('total_'): value for name, value in row.items()}))
+                if len(batch) >= batch_size:
+                    model.objects.bulk_create(batch)
+                    count += len(batch)
+                    batch = []
+            model.objects.bulk_create(batch)
+            created[model._meta.model_name] = count + len(batch)
+        transaction.on_commit(touch_all)
+    return created
@@ -0,0 +1,77 @@
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+
+from .models import Appointment
+
+# Колонки дашборда в порядке отображения
+SCHEDULE_STATUSES = ('scheduled', 'waiting', 'active', 'completed')
+
+
+def day_range(day):
+    """
+    Календарный день часового пояса клиники (TIME_ZONE) как aware-интервал [start, end).
+    Фильтр date_time__gte/__lt использует индексы, в отличие от date_time__date.
+    """
+    tz = timezone.get_current_timezone()
+    start = timezone.make_aware(datetime.combine(day, time.min), tz)
+    end = timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min), tz)
+    return start, end
+
+
+def _doctor_name(last_name, first_name, middle_name):
+    """То же, что Doctor.get_full_name, по значениям из values()"""
+    parts = [last_name, first_name]
+    if middle_name:
+        parts.append(middle_name)
+    return ' '.join(parts)
+
+
+# Поля values(), из которых строится карточка расписания
+SCHEDULE_FIELDS = (
+    'id', 'status', 'date_time', 'duration',
+    'patient__last_name', 'patient__first_name',
+    'doctor__user__last_name', 'doctor__user__first_name', 'doctor__user__middle_name',
+)
+
+
+def schedule_item(row, tz=None):
+    """Карточка дашборда из строки values(SCHEDULE_FIELDS); tz передаётся, чтобы не искать его на каждой строке"""
+    start = row['date_time'].astimezone(tz or timezone.get_current_timezone())
+    end = start + timedelta(minutes=row['duration'])
+    item = {
+        'id': row['id'],
+        'patient_name': f"{row['patient__last_name']} {row['patient__first_name']}",
+        'doctor_name': _doctor_name(
+            row['doctor__user__last_name'], row['doctor__user__first_name'], row['doctor__user__middle_name']
+        ),
+    }
+    if row['status'] == 'scheduled':
+        item['time'] = f"{start:%H:%M} - {end:%H:%M}"
+    elif row['status'] == 'completed':
+        item['time'] = f"{start:%H:%M}"
+    return item
+
+
+def day_appointments(day, doctor_id=None):
+    """Записи дня, которые видны на дашборде"""
+    start, end = day_range(day)
+    appointments = Appointment.objects.filter(
+        date_time__gte=start, date_time__lt=end, status__in=SCHEDULE_STATUSES
+    )
+    if doctor_id:
+        appointments = appointments.filter(doctor_id=doctor_id)
+    return appointments
+
+
+def load_schedule(day, doctor_id=None):
+    """
+    Расписание на день, разложенное по статусам дашборда.
+    Один запрос через values(): без загрузки моделей пациента, врача и пользователя.
+    """
+    appointments = day_appointments(day, doctor_id)
+    tz = timezone.get_current_timezone()
+    schedule = {status: [] for status in SCHEDULE_STATUSES}
+    for row in appointments.order_by('date_time').values(*SCHEDULE_FIELDS):
+        schedule[row['status']].append(schedule_item(row, tz))
+    return schedule
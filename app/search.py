@@ -0,0 +1,240 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.db import connection
+
+from .database import PATIENT_SEARCH_TABLE
+from .models import Patient, normalize_phone, normalize_search
+
+# Кандидатов из подстрочного индекса берём с запасом: они переранжируются в Python
+SUBSTRING_CANDIDATES = 5
+
+# Меньше цифр — слишком много совпадений по хвосту номера
+PHONE_SUFFIX_MIN_DIGITS = 4
+
+
+def _startswith(field, value):
+    """Фильтр «поле начинается с value», который обслуживает обычный B-tree индекс поля"""
+    if connection.vendor == 'postgresql':
+        # db_index в PostgreSQL создаёт и varchar_pattern_ops-индекс для LIKE 'x%'
+        return {f'{field}__startswith': value}
+    return {f'{field}__gte': value, f'{field}__lt': value + '\U0010ffff'}
+
+
+def _prefix_matches(query, limit):
+    """Начало ФИО (фамилия, затем имя) — диапазон по индексу search_name"""
+    patients = Patient.objects.filter(**_startswith('search_name', query))
+    return list(patients.order_by('search_name', 'id')[:limit])
+
+
+def find_by_phone(value, limit=10):
+    """
+    Пациенты по номеру телефона в любом формате. Полный номер (10+ цифр) ищется
+    точным совпадением phone_normalized, неполный — как последние цифры номера:
+    префикс по индексу phone_reversed вместо LIKE '%1234'.
+    """
+    digits = normalize_phone(value)
+    if len(digits) < PHONE_SUFFIX_MIN_DIGITS:
+        return []
+    if len(digits) >= 10:
+        patients = Patient.objects.filter(phone_normalized=digits)
+    else:
+        patients = Patient.objects.filter(**_startswith('phone_reversed', digits[::-1]))
+    return list(patients.order_by('phone_reversed', 'id')[:limit])
+
+
+def _substring_ids(query, limit):
+    """id пациентов, у которых query встречается в search_text (ФИО + цифры телефона)"""
+    if connection.vendor == 'sqlite':
+        # FTS5 trigram: подстрока из 3+ символов ищется по индексу.
+        # Без ORDER BY rank: bm25 пришлось бы считать по всем совпадениям, ранжируем сами
+        phrase = '"' + query.replace('"', '""') + '"'
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {PATIENT_SEARCH_TABLE} WHERE {PATIENT_SEARCH_TABLE} MATCH %s LIMIT %s',
+                [phrase, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+    # PostgreSQL: LIKE '%x%' обслуживается GIN-индексом pg_trgm
+    return list(Patient.objects.filter(search_text__contains=query).values_list('id', flat=True)[:limit])
+
+
+def _rank(patient, query):
+    """Меньше — выше: точная фамилия, начало ФИО, начало слова, конец телефона, подстрока"""
+    words = patient.search_name.split()
+    if words and words[0] == query:
+        return 0
+    if patient.search_name.startswith(query):
+        return 1
+    if any(word.startswith(query) for word in patient.search_text.split()):
+        return 2
+    if query.isdigit() and patient.phone_normalized.endswith(query):
+        return 3
+    return 4
+
+
+def normalize_query(query):
+    """Запрос в форме search_name/search_text; телефон в любом формате (+7 (999) 123-45-67) — цифрами"""
+    query = normalize_search(query)
+    if re.fullmatch(r'[\d\s()+-]+', query):
+        query = re.sub(r'\D', '', query)
+    return query
+
+
+def search_patients(query, limit=10):
+    """Ранжированный поиск пациентов по ФИО и телефону без учёта регистра (включая кириллицу)"""
+    query = normalize_query(query)
+    if len(query) < 2:
+        return []
+
+    found = {patient.id: patient for patient in _prefix_matches(query, limit)}
+    if query.isdigit():
+        for patient in find_by_phone(query, limit):
+            found.setdefault(patient.id, patient)
+
+    # Подстрочный индекс работает с 3+ символов
+    if len(found) < limit and len(query) >= 3:
+        ids = [pk for pk in _substring_ids(query, limit * SUBSTRING_CANDIDATES) if pk not in found]
+        if ids:
+            found.update(Patient.objects.in_bulk(ids))
+
+    ranked = sorted(found.values(), key=lambda p: (_rank(p, query), p.search_name, p.id))
+    return ranked[:limit]
+
+
+# ---------- Кэш поиска по мере набора ----------
+# Поля пациента, нужные для ранжирования и ответа api_patients_search
+CACHED_FIELDS = (
+    'id', 'last_name', 'first_name', 'middle_name', 'phone', 'birth_date',
+    'search_name', 'search_text', 'phone_normalized',
+)
+
+
+class PrefixSearchCache:
+    """
+    LRU-кэш результатов поиска пациентов внутри процесса.
+
+    Для запросов из 3+ символов кэшируется полный набор совпадений (query входит
+    в search_text), если их не больше candidates. Запрос, продолжающий такой
+    префикс («ива» → «иван»), сужается фильтром этого набора в Python без
+    обращения к БД: всё, что содержит «иван», содержит и «ива».
+
+    Память ограничена числом записей и суммарным числом пациентов в кэше.
+    Сброс — при сохранении/удалении пациента (signals.py); ttl ограничивает
+    устаревание в других процессах, которые сигнал не видят.
+    """
+
+    def __init__(self, max_entries=256, max_rows=20000, candidates=500, ttl=60):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.candidates = candidates
+        self.ttl = ttl
+        self._entries = OrderedDict()  # query -> (expires, complete, patients)
+        self._rows = 0
+        self._lock = threading.Lock()
+        self.hits = self.narrowed = self.misses = 0
+
+    def search(self, query, limit=10):
+        query = normalize_query(query)
+        if len(query) < 2:
+            return []
+
+        patients = self._get(query)
+        if patients is not None:
+            self._count('hits')
+        else:
+            patients = self._narrow(query)
+            if patients is not None:
+                self._count('narrowed')
+                self._put(query, True, patients)
+            else:
+                self._count('misses')
+                complete, patients = self._load(query, limit)
+                self._put(query, complete, patients)
+
+        ranked = sorted(patients, key=lambda p: (_rank(p, query), p.search_name, p.id))
+        return ranked[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'narrowed': self.narrowed,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'rows': self._rows,
+            }
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _lookup(self, query):
+        entry = self._entries.get(query)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(query)
+            return None
+        self._entries.move_to_end(query)
+        return entry
+
+    def _get(self, query):
+        with self._lock:
+            entry = self._lookup(query)
+        return entry[2] if entry else None
+
+    def _narrow(self, query):
+        """Ближайший закэшированный полный набор по префиксу query, отфильтрованный по query"""
+        # Полный номер ищется ещё и по phone_normalized (8... = +7...) — это не подстрока префикса
+        if query.isdigit() and len(query) >= 10:
+            return None
+        with self._lock:
+            for end in range(len(query) - 1, 2, -1):
+                entry = self._lookup(query[:end])
+                if entry and entry[1]:
+                    superset = entry[2]
+                    break
+            else:
+                return None
+        return [p for p in superset if query in p.search_text]
+
+    def _load(self, query, limit):
+        """(полный ли набор, пациенты) из БД"""
+        if len(query) >= 3:
+            ids = _substring_ids(query, self.candidates + 1)
+            if len(ids) <= self.candidates:
+                patients = Patient.objects.filter(id__in=ids).only(*CACHED_FIELDS)
+                found = {p.id: p for p in patients}
+                if query.isdigit():
+                    for patient in find_by_phone(query, limit):
+                        found.setdefault(patient.id, patient)
+                return True, list(found.values())
+        # Слишком общий запрос: кэшируем только его собственный результат
+        return False, search_patients(query, limit)
+
+    def _put(self, query, complete, patients):
+        if len(patients) > self.max_rows:
+            return
+        with self._lock:
+            self._drop(query)
+            self._entries[query] = (time.monotonic() + self.ttl, complete, patients)
+            self._rows += len(patients)
+            while len(self._entries) > self.max_entries or self._rows > self.max_rows:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+
+    def _drop(self, query):
+        entry = self._entries.pop(query, None)
+        if entry:
+            self._rows -= len(entry[2])
+
+
+search_cache = PrefixSearchCache()
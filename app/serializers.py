@@ -0,0 +1,150 @@
+"""
+Сериализация ответов API без загрузки моделей.
+
+Serializer описывает ответ как {ключ: колонка values() или Field}. Колонки
+выбираются одним values() (только нужные, включая поля связанных таблиц через
+'__'), а даты, суммы и составные значения форматируются за один проход по
+строкам. JSON кодирует API_JSON_ENCODER (по умолчанию orjson, если он
+установлен, иначе стандартный json).
+"""
+import json
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# ---------- Форматы значений ----------
+def as_float(value):
+    return float(value) if value is not None else None
+
+
+def as_iso(value):
+    return value.isoformat() if value is not None else None
+
+
+def full_name(last_name, first_name, middle_name=None):
+    return ' '.join(part for part in (last_name, first_name, middle_name) if part)
+
+
+class LocalTime:
+    """Дата-время в часовом поясе клиники по strftime-формату; пояс берётся один раз на ответ"""
+
+    def __init__(self, fmt='%Y-%m-%dT%H:%M:%S%z'):
+        self.fmt = fmt
+
+    def bind(self, tz):
+        fmt = self.fmt
+        return lambda value: value.astimezone(tz).strftime(fmt) if value is not None else None
+
+
+class Field:
+    """Значение ответа из одной или нескольких колонок: format(*значения)"""
+
+    def __init__(self, *sources, format=None):
+        self.sources = sources
+        self.format = format
+
+
+# ---------- Сериализатор ----------
+class Serializer:
+    def __init__(self, fields):
+        self.fields = {
+            key: field if isinstance(field, Field) else Field(field)
+            for key, field in fields.items()
+        }
+        self.columns = tuple(dict.fromkeys(source for field in self.fields.values() for source in field.sources))
+
+    def values(self, queryset):
+        """queryset.values() только с колонками ответа"""
+        return queryset.values(*self.columns)
+
+    def _plan(self):
+        tz = timezone.get_current_timezone()
+        plan = []
+        for key, field in self.fields.items():
+            fmt = field.format.bind(tz) if hasattr(field.format, 'bind') else field.format
+            plan.append((key, field.sources if len(field.sources) > 1 else field.sources[0], fmt))
+        return plan
+
+    def many(self, rows):
+        """Словари ответа из строк values(): форматы применяются в одном цикле"""
+        plan = self._plan()
+        result = []
+        for row in rows:
+            item = {}
+            for key, source, fmt in plan:
+                if fmt is None:
+                    item[key] = row[source]
+                elif type(source) is tuple:
+                    item[key] = fmt(*[row[name] for name in source])
+                else:
+                    item[key] = fmt(row[source])
+            result.append(item)
+        return result
+
+    def one(self, row):
+        return self.many([row])[0]
+
+
+# ---------- Кодирование JSON ----------
+def _default(value):
+    # То, что не отформатировал сериализатор (Decimal, даты, UUID, ленивые строки)
+    if isinstance(value, Decimal):
+        return float(value)
+    return DjangoJSONEncoder().default(value)
+
+
+def orjson_dumps(data):
+    return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def stdlib_dumps(data):
+    return json.dumps(data, default=_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+_dumps = None
+
+
+@receiver(setting_changed)
+def _reset_encoder(setting, **kwargs):
+    # Кодировщик выбирается при первом вызове; смена настройки (override_settings) выбирает заново
+    global _dumps
+    if setting == 'API_JSON_ENCODER':
+        _dumps = None
+
+
+def dumps(data):
+    """JSON в байтах кодировщиком API_JSON_ENCODER (путь к функции data -> bytes)"""
+    global _dumps
+    if _dumps is None:
+        path = getattr(settings, 'API_JSON_ENCODER', None)
+        if path:
+            _dumps = import_string(path)
+        else:
+            _dumps = orjson_dumps if orjson is not None else stdlib_dumps
+    return _dumps(data)
+
+
+def json_response(data, status=200, headers=None):
+    """Замена JsonResponse с быстрым кодировщиком (списки разрешены)"""
+    return HttpResponse(dumps(data), content_type='application/json', status=status, headers=headers)
+
+
+# ---------- Ответы API ----------
+SERVICE = Serializer({
+    'id': 'id',
+    'name': 'name',
+    'price': Field('price', format=as_float),
+    'duration': 'duration',
+})
@@ -0,0 +1,101 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import counters, rollups, uploads
+from .events import broker
+from .models import Appointment, ClinicInfo, Doctor, Document, InvoiceService, Patient
+from .search import search_cache
+
+
+@receiver(post_save, sender=Appointment)
+def publish_appointment_saved(sender, instance, created, **kwargs):
+    kind = 'created' if created else 'updated'
+    transaction.on_commit(lambda: broker.publish_appointment(instance.pk, kind))
+
+
+@receiver(post_delete, sender=Appointment)
+def publish_appointment_deleted(sender, instance, **kwargs):
+    event = {
+        'type': 'deleted',
+        'id': instance.pk,
+        'date': timezone.localtime(instance.date_time).date().isoformat(),
+        'doctor_id': instance.doctor_id,
+    }
+    transaction.on_commit(lambda: broker.publish(event))
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+def clear_patient_search_cache(sender, **kwargs):
+    # Новый или изменённый пациент может попасть в любой закэшированный результат
+    transaction.on_commit(search_cache.clear)
+
+
+# ---------- Дневные сводки статистики (rollups.py) ----------
+# Срабатывают внутри транзакции сохранения/удаления: сводка меняется вместе с записью
+@receiver(pre_save, sender=Appointment)
+def remember_appointment_state(sender, instance, **kwargs):
+    instance._rollup_state = rollups.appointment_state(instance.pk) if instance.pk else None
+
+
+@receiver(post_save, sender=Appointment)
+def update_appointment_rollups(sender, instance, update_fields=None, **kwargs):
+    # При update_fields в БД попали не все поля экземпляра — берём сохранённое состояние
+    new = rollups.appointment_state(instance.pk) if update_fields else rollups.appointment_state_of(instance)
+    rollups.appointment_changed(instance.pk, getattr(instance, '_rollup_state', None), new)
+
+
+@receiver(pre_delete, sender=Appointment)
+def remove_appointment_rollups(sender, instance, **kwargs):
+    # Строки счёта удаляются каскадом и вычитаются своим сигналом
+    rollups.appointment_changed(instance.pk, rollups.appointment_state(instance.pk), None)
+
+
+@receiver(pre_save, sender=InvoiceService)
+def remember_line_state(sender, instance, **kwargs):
+    instance._rollup_state = rollups.line_state(instance.pk) if instance.pk else None
+
+
+@receiver(post_save, sender=InvoiceService)
+def update_line_rollups(sender, instance, update_fields=None, **kwargs):
+    new = rollups.line_state(instance.pk) if update_fields else rollups.line_state_of(instance)
+    rollups.line_changed(getattr(instance, '_rollup_state', None), new)
+
+
+@receiver(pre_delete, sender=InvoiceService)
+def remove_line_rollups(sender, instance, **kwargs):
+    rollups.line_changed(rollups.line_state(instance.pk), None)
+
+
+# ---------- Шапка страниц и счётчики (counters.py) ----------
+@receiver(post_save, sender=ClinicInfo)
+@receiver(post_delete, sender=ClinicInfo)
+def reset_clinic_info(sender, **kwargs):
+    transaction.on_commit(counters.reset_clinic_info)
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+def reset_patient_counter(sender, **kwargs):
+    transaction.on_commit(lambda: counters.reset_counters('patients'))
+
+
+@receiver(post_save, sender=Doctor)
+@receiver(post_delete, sender=Doctor)
+def reset_doctor_counter(sender, **kwargs):
+    transaction.on_commit(lambda: counters.reset_counters('doctors'))
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def reset_appointment_counter(sender, **kwargs):
+    transaction.on_commit(lambda: counters.reset_counters('appointments_today'))
+
+
+# ---------- Файлы документов (uploads.py) ----------
+@receiver(post_delete, sender=Document)
+def release_document_blob(sender, instance, **kwargs):
+    if instance.blob_id:
+        uploads.release(instance.blob_id)
@@ -0,0 +1,140 @@
+from datetime import datetime, time, timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Appointment
+
+SLOT_MINUTES = 10
+
+# Статусы, при которых время врача свободно
+FREE_STATUSES = ('cancelled', 'no_show')
+
+
+def _day_bounds(day):
+    start_hour, end_hour = settings.CLINIC_WORKDAY_HOURS
+    tz = timezone.get_current_timezone()
+    start = timezone.make_aware(datetime.combine(day, time(start_hour)), tz)
+    end = timezone.make_aware(datetime.combine(day, time(end_hour)), tz)
+    return start, end
+
+
+def _slot_count():
+    start_hour, end_hour = settings.CLINIC_WORKDAY_HOURS
+    return (end_hour - start_hour) * 60 // SLOT_MINUTES
+
+
+def _days(start_date, end_date):
+    day = start_date
+    while day <= end_date:
+        yield day
+        day += timedelta(days=1)
+
+
+def build_occupancy(doctor_ids, start_date, end_date):
+    """
+    Занятость врачей: {(doctor_id, day): int}, где бит i — занятый 10-минутный слот
+    рабочего дня. Одним запросом по всем врачам и дням диапазона.
+    """
+    start_hour, _ = settings.CLINIC_WORKDAY_HOURS
+    range_start, _ = _day_bounds(start_date)
+    _, range_end = _day_bounds(end_date)
+    slots = _slot_count()
+    day_minutes = 24 * 60
+
+    occupancy = {}
+    rows = (
+        Appointment.objects.filter(
+            doctor_id__in=doctor_ids,
+            date_time__lt=range_end,
+            end_time__gt=range_start,
+        )
+        .exclude(status__in=FREE_STATUSES)
+        .values_list('doctor_id', 'date_time', 'duration')
+    )
+    for doctor_id, date_time, duration in rows:
+        local = timezone.localtime(date_time)
+        day = local.date()
+        # Смещение от начала рабочего дня в минутах
+        offset = local.hour * 60 + local.minute - start_hour * 60
+        end = offset + duration
+        # Запись может заходить за полночь — помечаем слоты каждого задетого дня
+        while end > 0:
+            first = max(0, offset // SLOT_MINUTES)
+            last = min(slots, -(-end // SLOT_MINUTES))
+            if first < last:
+                mask = ((1 << (last - first)) - 1) << first
+                occupancy[(doctor_id, day)] = occupancy.get((doctor_id, day), 0) | mask
+            offset -= day_minutes
+            end -= day_minutes
+            day += timedelta(days=1)
+    return occupancy
+
+
+def free_starts(occupied, length, slots, not_before=0):
+    """Номера слотов, с которых помещается length свободных подряд слотов"""
+    free = ~occupied & ((1 << slots) - 1)
+    # Бит i остаётся, только если свободны слоты i .. i + length - 1
+    runs = free
+    for shift in range(1, length):
+        runs &= free >> shift
+    runs &= ~((1 << not_before) - 1)
+    while runs:
+        low = runs & -runs
+        yield low.bit_length() - 1
+        runs ^= low
+
+
+def find_free_slots(doctors, start_date, end_date, duration, limit=10, window_days=7):
+    """
+    Ближайшие limit свободных слотов длительностью duration минут
+    среди doctors в диапазоне дат, по возрастанию времени.
+    Занятость читается окнами по window_days дней, пока не набрано limit слотов.
+    """
+    doctors = {doctor.pk: doctor for doctor in doctors}
+    if not doctors:
+        return []
+
+    length = -(-duration // SLOT_MINUTES)
+    slots = _slot_count()
+    slot = timedelta(minutes=SLOT_MINUTES)
+    now = timezone.localtime()
+
+    result = []
+    window_start = start_date
+    while window_start <= end_date and len(result) < limit:
+        window_end = min(end_date, window_start + timedelta(days=window_days - 1))
+        occupancy = build_occupancy(list(doctors), window_start, window_end)
+
+        for day in _days(window_start, window_end):
+            day_start, day_end = _day_bounds(day)
+            if day_end <= now:
+                continue
+            # Сегодня — только слоты, которые ещё не начались
+            not_before = max(0, -((day_start - now) // slot))
+
+            candidates = []
+            for doctor_id in doctors:
+                occupied = occupancy.get((doctor_id, day), 0)
+                # У каждого врача достаточно limit первых слотов дня
+                for index in islice(free_starts(occupied, length, slots, not_before), limit):
+                    candidates.append((index, doctor_id))
+            candidates.sort()
+
+            for index, doctor_id in candidates[:limit - len(result)]:
+                doctor = doctors[doctor_id]
+                start = timezone.localtime(day_start + index * slot)
+                result.append({
+                    'doctor_id': doctor.id,
+                    'doctor_name': doctor.get_full_name(),
+                    'specialty': doctor.specialty,
+                    'date': day.isoformat(),
+                    'time': start.strftime('%H:%M'),
+                    'start': start.isoformat(),
+                    'end': (start + timedelta(minutes=duration)).isoformat(),
+                })
+            if len(result) >= limit:
+                break
+        window_start = window_end + timedelta(days=1)
+    return result
@@ -1,6 +1,10 @@
 // ✅ Переменные для хранения состояния
 let currentDate = null;
 let selectedPatientId = null;
+// ✅ Текущее расписание по колонкам и поток изменений (SSE)
+let scheduleState = { scheduled: [], waiting: [], active: [], completed: [] };
+let scheduleStream = null;
+let scheduleStreamKey = null;
 
 document.addEventListener('DOMContentLoaded', function() {
     // Данные из контекста (получаются из HTML)
@@ -119,20 +123,57 @@ document.addEventListener('DOMContentLoaded', function() {
 
             const data = await res.json();
 
-            // Обновляем колонки
-            updateSection('scheduled', data.scheduled || []);
-            updateSection('waiting', data.waiting || []);
-            updateSection('active', data.active || []);
-            updateSection('completed', data.completed || []);
+            scheduleState = {
+                scheduled: data.scheduled || [],
+                waiting: data.waiting || [],
+                active: data.active || [],
+                completed: data.completed || []
+            };
+            renderSchedule();
 
-            // Инициализация Drag & Drop
-            setupDragAndDrop();
+            // ✅ Дальше получаем только изменения
+            subscribeToSchedule(date, doctorId);
 
         } catch (e) {
             alert('Ошибка: ' + e.message);
         }
     }
 
+    function renderSchedule() {
+        // Обновляем колонки: карточки создаются заново вместе с dragstart, drop у колонок привязан один раз
+        Object.keys(scheduleState).forEach(section => updateSection(section, scheduleState[section]));
+    }
+
+    // ✅ Поток изменений расписания (Server-Sent Events)
+    function subscribeToSchedule(date, doctorId) {
+        if (!window.EventSource) return;
+        const key = `${date}|${doctorId || ''}`;
+        if (scheduleStream && scheduleStreamKey === key && scheduleStream.readyState !== EventSource.CLOSED) return;
+
+        if (scheduleStream) scheduleStream.close();
+        scheduleStreamKey = key;
+        scheduleStream = new EventSource(`/api/schedule/stream/?date=${date}${doctorId ? '&doctor_id=' + doctorId : ''}`);
+        ['created', 'updated', 'deleted'].forEach(type => scheduleStream.addEventListener(type, applyScheduleDelta));
+        scheduleStream.addEventListener('reload', () => loadSchedule(date, doctorId));
+    }
+
+    function isStreamOpen() {
+        return scheduleStream && scheduleStream.readyState === EventSource.OPEN;
+    }
+
+    function applyScheduleDelta(e) {
+        const event = JSON.parse(e.data);
+
+        // Убираем карточку из всех колонок и кладём в колонку нового статуса
+        Object.keys(scheduleState).forEach(section => {
+            scheduleState[section] = scheduleState[section].filter(i => i.id !== event.id);
+        });
+        if (event.item && scheduleState[event.status]) {
+            scheduleState[event.status].push(event.item);
+        }
+        renderSchedule();
+    }
+
     function updateSection(section, items) {
         const container = document.getElementById(`${section}-list`);
         const countEl = document.getElementById(`${section}-count`);
@@ -178,7 +219,7 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
-    // Drag & Drop
+    // Drag & Drop: колонки статичны — обработчики вешаются один раз при загрузке страницы
     function setupDragAndDrop() {
         const columns = document.querySelectorAll('.column');
         columns.forEach(col => {
@@ -200,6 +241,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
                 // ✅ Проверяем, можно ли перейти в этот статус
                 const currentCard = document.querySelector(`.patient-card[data-id="${appointmentId}"]`);
+                if (!currentCard) return; // карточку уже убрало изменение из потока
                 // Найдём текущую колонку (откуда перетащили)
                 const currentColumn = currentCard.closest('.column');
                 const currentStatus = currentColumn.dataset.status; // например: 'scheduled'
@@ -219,11 +261,12 @@ document.addEventListener('DOMContentLoaded', function() {
                             'Content-Type': 'application/json',
                             'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value
                         },
-                        body: JSON.stringify({ status: newStatus })
+                        body: JSON.stringify({ status: newStatus, from: currentStatus })
                     });
 
                     if (res.ok) {
-                        loadSchedule(currentDate, ''); // ✅ Обновляем с текущей датой
+                        // ✅ Изменение придёт по потоку; без потока — перечитываем расписание
+                        if (!isStreamOpen()) loadSchedule(currentDate, '');
                     } else {
                         const err = await res.json();
                         alert('Ошибка изменения статуса: ' + err.error);
@@ -341,8 +384,16 @@ document.addEventListener('DOMContentLoaded', function() {
     // ✅ Загрузка врачей для записи
     async function loadDoctorsForAppointment() {
         try {
-            const res = await fetch('/api/personnel/doctors/');
-            const doctors = await res.json();
+            // Список постраничный: идём по X-Next-Cursor, пока он есть
+            const doctors = [];
+            let cursor = null;
+            do {
+                const url = '/api/personnel/doctors/' + (cursor ? '?cursor=' + encodeURIComponent(cursor) : '');
+                const res = await fetch(url);
+                if (!res.ok) throw new Error(`HTTP ${res.status}`);
+                doctors.push(...await res.json());
+                cursor = res.headers.get('X-Next-Cursor');
+            } while (cursor);
 
             const select = document.getElementById('doctor-select-modal');
             if (select) {
@@ -433,7 +484,7 @@ document.addEventListener('DOMContentLoaded', function() {
             if (res.ok) {
                 alert('Запись создана!');
                 new bootstrap.Modal(document.getElementById('addPatientAndAppointmentModal')).hide();
-                loadSchedule(currentDate, ''); // ✅ Обновляем расписание с текущей датой
+                if (!isStreamOpen()) loadSchedule(currentDate, ''); // ✅ Иначе запись придёт по потоку
             } else {
                 const err = await res.json();
                 alert('Ошибка: ' + err.error);
@@ -472,6 +523,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // Инициализация событий
     setupEventListeners();
+    setupDragAndDrop();
 
     // ✅ Загружаем расписание для текущей даты при старте
     loadSchedule(currentDate, '');
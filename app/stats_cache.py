@@ -0,0 +1,98 @@
+"""
+Кэш результатов статистики по (метрика, первый день, последний день).
+
+Актуальность проверяется по меткам дней: любое изменение сводок за день
+(rollups._add) выдаёт дню новую метку, и все закэшированные диапазоны с этим
+днём перестают совпадать. Закрытые периоды хранятся бессрочно, диапазоны с
+сегодняшним днём — STATS_CACHE_TODAY_SECONDS. Одинаковые параллельные запросы
+считает один из них, остальные ждут его результат (блокировка через cache.add).
+"""
+import hashlib
+import json
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+EPOCH_KEY = 'stats:epoch'
+# Ожидание чужого вычисления: шаг опроса кэша
+WAIT_STEP = 0.05
+
+
+def _day_key(day):
+    return f'stats:day:{day.isoformat()}'
+
+
+def _new_stamp():
+    return uuid.uuid4().hex
+
+
+def touch_days(days):
+    """Данные за эти дни изменились"""
+    cache.set_many({_day_key(day): _new_stamp() for day in set(days)}, timeout=None)
+
+
+def touch_all():
+    """Изменились данные за любые дни (пересборка сводок)"""
+    cache.set(EPOCH_KEY, _new_stamp(), timeout=None)
+
+
+def _stamps(start, end):
+    """Отпечаток меток всех дней диапазона"""
+    keys = [EPOCH_KEY]
+    day = start
+    while day <= end:
+        keys.append(_day_key(day))
+        day += timedelta(days=1)
+    found = cache.get_many(keys)
+    # Нет метки (не выдавалась или вытеснена из кэша) — выдаём новую: иначе вытесненная
+    # метка совпала бы с «пустой» меткой записей, посчитанных до изменения
+    missing = [key for key in keys if key not in found]
+    if missing:
+        # add(), а не set(): параллельный запрос должен получить ту же метку
+        for key in missing:
+            cache.add(key, _new_stamp(), timeout=None)
+        found.update(cache.get_many(missing))
+    return hashlib.md5(''.join(found.get(key) or _new_stamp() for key in keys).encode()).hexdigest()
+
+
+def _entry_key(metric, start, end):
+    metric = json.dumps(metric, sort_keys=True, ensure_ascii=False, default=str)
+    digest = hashlib.md5(metric.encode()).hexdigest()
+    return f'stats:result:{digest}:{start.isoformat()}:{end.isoformat()}'
+
+
+def cached_stats(metric, start, end, compute):
+    """
+    Результат compute() для метрики за дни [start, end] — из кэша, если данные
+    за эти дни с тех пор не менялись. metric — любое JSON-представимое описание.
+    """
+    key = _entry_key(metric, start, end)
+    timeout = settings.STATS_CACHE_TODAY_SECONDS if end >= timezone.localdate() else None
+    deadline = time.monotonic() + settings.STATS_CACHE_LOCK_SECONDS
+
+    while True:
+        stamps = _stamps(start, end)
+        entry = cache.get(key)
+        if entry and entry[0] == stamps:
+            return entry[1]
+
+        if cache.add(f'{key}:lock', 1, timeout=settings.STATS_CACHE_LOCK_SECONDS):
+            try:
+                # Пока мы брали блокировку, результат мог положить предыдущий её владелец
+                entry = cache.get(key)
+                if entry and entry[0] == stamps:
+                    return entry[1]
+                value = compute()
+                cache.set(key, (stamps, value), timeout=timeout)
+                return value
+            finally:
+                cache.delete(f'{key}:lock')
+
+        # Этот же результат уже считает другой запрос
+        if time.monotonic() >= deadline:
+            return compute()
+        time.sleep(WAIT_STEP)
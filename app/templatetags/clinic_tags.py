@@ -7,11 +7,9 @@ register = template.Library()
 
 @register.simple_tag
 def get_clinic_info():
-    from app.models import ClinicInfo
-    return ClinicInfo.objects.first() or ClinicInfo(
-        name="Клиника",
-        program_name="Программа"
-    )
+    # Из памяти процесса: шапка base.html не делает запросов к БД
+    from app.counters import clinic_info
+    return clinic_info()
 
 
 # Фильтр: добавляет "руб." к числу
@@ -66,20 +64,19 @@ def status_label(status):
 # Простой тег: получить количество активных пациентов
 @register.simple_tag
 def active_patients_count():
-    from app.models import Patient
-    return Patient.objects.count()
+    from app.counters import get_counter
+    return get_counter('patients')
 
 
 # Простой тег: получить количество активных врачей
 @register.simple_tag
 def active_doctors_count():
-    from app.models import Doctor
-    return Doctor.objects.filter(is_active=True).count()
+    from app.counters import get_counter
+    return get_counter('doctors')
 
 
 # Простой тег: получить количество записей на сегодня
 @register.simple_tag
 def appointments_today_count():
-    from app.models import Appointment
-    from datetime import date
-    return Appointment.objects.filter(date_time__date=date.today()).count()
+    from app.counters import get_counter
+    return get_counter('appointments_today')
@@ -1,3 +1,1939 @@
-from django.test import TestCase
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import Http404
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .billing import close_day
+from .booking import book_appointment
+from .cube import CubeError, run_cube
+from .downloads import public_media
+from .events import ScheduleBroker, broker
+from .imports import run_import
+from .pagination import CursorError, order, paginate
+from . import counters, export, rollups, serializers, stats_cache
+from .rollups import verify_invoice_totals
+from .schedule import load_schedule, day_range
+from .search import PrefixSearchCache, find_by_phone, search_cache, search_patients
+from .slots import build_occupancy, find_free_slots, free_starts
+from .transitions import BulkTransitionError, TransitionError, bulk_change_status, change_status
+from .uploads import attach_file, complete_upload, expire_uploads
+from .models import (
+    Appointment, AppointmentDayStats, Blob, ClinicInfo, Document, Doctor, Invoice, InvoiceService, Nurse, Patient,
+    PatientDayStats, Receptionist, Service, ServiceDayStats, User, normalize_phone,
+)
+
+
+def next_day_at(hour, minute=0, days=2):
+    return timezone.localtime().replace(hour=hour, minute=minute, second=0, microsecond=0) + timedelta(days=days)
+
+
+def marker_dumps(data):
+    """Кодировщик для проверки API_JSON_ENCODER"""
+    return b'"marker"'
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+    CLIENTS = 50
+
+    def setUp(self):
+        self.doctors = [
+            Doctor.objects.create(
+                user=User.objects.create(username=f'dr_{i}', last_name=f'Врач{i}'),
+                specialty='Терапевт',
+            )
+            for i in range(self.CLIENTS)
+        ]
+        self.patient = Patient.objects.create(
+            first_name='Иван', last_name='Иванов', birth_date=date(1990, 1, 1), phone='+79990000000'
+        )
+
+    def _run_clients(self, jobs):
+        """Запускает jobs одновременно (по потоку на клиента), возвращает (успешные, отказы)"""
+        barrier = threading.Barrier(len(jobs))
+        booked, rejected = [], []
+        lock = threading.Lock()
+
+        def client(doctor, start, duration):
+            try:
+                barrier.wait()
+                appointment = book_appointment(self.patient, doctor, start, duration=duration)
+                with lock:
+                    booked.append(appointment.pk)
+            except ValidationError:
+                with lock:
+                    rejected.append(start)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=client, args=job) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return booked, rejected
+
+    def test_no_double_booking_for_one_doctor(self):
+        doctor = self.doctors[0]
+        start = next_day_at(10)
+        # Все клиенты целятся в пересекающиеся слоты 10:00–10:40 одного врача
+        jobs = [(doctor, start + timedelta(minutes=10 * (i % 3)), 30) for i in range(self.CLIENTS)]
+
+        booked, rejected = self._run_clients(jobs)
+
+        self.assertEqual(len(booked), 1)
+        self.assertEqual(len(rejected), self.CLIENTS - 1)
+        scheduled = list(Appointment.objects.filter(doctor=doctor, status='scheduled').order_by('date_time'))
+        for earlier, later in zip(scheduled, scheduled[1:]):
+            self.assertLessEqual(earlier.end_time, later.date_time)
+
+    def test_non_conflicting_bookings_all_succeed(self):
+        start = next_day_at(10)
+        jobs = [(doctor, start, 30) for doctor in self.doctors]
+
+        booked, rejected = self._run_clients(jobs)
+
+        self.assertEqual(len(booked), self.CLIENTS)
+        self.assertEqual(rejected, [])
+
+
+class OverlapQueryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = Doctor.objects.create(user=User.objects.create(username='doc', last_name='Врачев'), specialty='Терапевт')
+        cls.patient = Patient.objects.create(
+            first_name='Пётр', last_name='Пациент', birth_date=date(1990, 1, 1), phone='+79990000000'
+        )
+        cls.first = cls._book(10, 0)
+        cls.second = cls._book(10, 30)
+        cancelled = cls._book(12, 0)
+        Appointment.objects.filter(pk=cancelled.pk).update(status='cancelled')
+
+    @classmethod
+    def _book(cls, hour, minute, duration=30):
+        return Appointment.objects.create(
+            patient=cls.patient, doctor=cls.doctor, date_time=next_day_at(hour, minute), duration=duration
+        )
+
+    def _overlapping(self, hour, minute, duration, exclude_pk=None):
+        start = next_day_at(hour, minute)
+        found = Appointment.find_overlapping(self.doctor, start, start + timedelta(minutes=duration), exclude_pk)
+        return list(found.values_list('pk', flat=True))
+
+    def test_window_bounds_are_half_open(self):
+        self.assertEqual(self._overlapping(10, 20, 20), [self.first.pk, self.second.pk])
+        # Приём, который кончается в 10:30, не мешает приёму с 10:30
+        self.assertEqual(self._overlapping(10, 30, 10), [self.second.pk])
+        self.assertEqual(self._overlapping(9, 30, 30), [])
+        self.assertEqual(self._overlapping(11, 0, 30), [])
+        # Отменённые записи время не занимают
+        self.assertEqual(self._overlapping(12, 0, 30), [])
+        self.assertEqual(self._overlapping(10, 0, 60, exclude_pk=self.first.pk), [self.second.pk])
+
+    def test_check_is_one_query_whatever_the_history(self):
+        # Годы истории врача: прошедшие записи не входят в окно и не читаются
+        past = [
+            Appointment(
+                patient=self.patient, doctor=self.doctor, duration=30,
+                date_time=next_day_at(10, days=-day), end_time=next_day_at(10, 30, days=-day),
+            )
+            for day in range(1, 500)
+        ]
+        Appointment.objects.bulk_create(past)
+        appointment = Appointment(patient=self.patient, doctor=self.doctor, date_time=next_day_at(10, 10), duration=30)
+
+        with self.assertNumQueries(1):
+            message = appointment._check_time_overlap()
+
+        self.assertTrue(message.startswith('⏰ ВРЕМЯ ЗАНЯТО!\n'))
+        self.assertIn(f'• Пациент: {self.patient}\n', message)
+        self.assertIn('• Длительность: 30 мин\n• Окончание: ', message)
+        with self.assertRaises(ValidationError) as error:
+            appointment.save()
+        self.assertEqual(error.exception.message_dict['date_time'], [message])
+
+    def test_update_fields_keep_end_time(self):
+        self.first.duration = 10
+        self.first.save(update_fields=['duration'])
+        self.assertEqual(Appointment.objects.get(pk=self.first.pk).end_time, next_day_at(10, 10))
+
+        self.first.date_time = next_day_at(9, 30)
+        self.first.save(update_fields=['date_time'])
+        self.assertEqual(Appointment.objects.get(pk=self.first.pk).end_time, next_day_at(9, 40))
+
+        # Пересечение со второй записью ловит ограничение БД по сохранённому end_time
+        self.first.duration = 70
+        with mock.patch.object(Appointment, 'clean'), self.assertRaises(ValidationError):
+            self.first.save(update_fields=['duration'])
+        self.assertEqual(Appointment.objects.get(pk=self.first.pk).end_time, next_day_at(9, 40))
+
+
+class OverlapConstraintTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+        cls.doctor = Doctor.objects.create(user=User.objects.create(username='doc'), specialty='Терапевт')
+        cls.patient = Patient.objects.create(
+            first_name='Пётр', last_name='Пациент', birth_date=date(1990, 1, 1), phone='+79990000000'
+        )
+        cls.start = next_day_at(10)
+        cls.booked = Appointment.objects.create(
+            patient=cls.patient, doctor=cls.doctor, date_time=cls.start, duration=30
+        )
+
+    def _overlapping(self):
+        return Appointment(
+            patient=self.patient, doctor=self.doctor, date_time=self.start + timedelta(minutes=20), duration=30
+        )
+
+    def test_constraint_violation_becomes_validation_error(self):
+        # Проверка в clean() пропущена (как при гонке) — пересечение ловит ограничение БД
+        with mock.patch.object(Appointment, '_check_time_overlap', side_effect=[None, 'ВРЕМЯ ЗАНЯТО']):
+            with self.assertRaises(ValidationError) as error:
+                self._overlapping().save()
+        self.assertEqual(error.exception.message_dict, {'date_time': ['ВРЕМЯ ЗАНЯТО']})
+        self.assertEqual(Appointment.objects.count(), 1)
+
+    def test_api_create_overlap_is_400(self):
+        self.client.force_login(self.admin)
+        payload = {
+            'patient_id': self.patient.pk, 'doctor_id': self.doctor.pk, 'duration': 30,
+            'datetime': timezone.localtime(self.start + timedelta(minutes=20)).strftime('%Y-%m-%dT%H:%M'),
+        }
+        with mock.patch.object(Appointment, 'clean'):
+            response = self.client.post('/api/appointments/create/', payload, content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ВРЕМЯ ЗАНЯТО', response.json()['error'])
+
+    def test_end_time_is_required(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Appointment.objects.filter(pk=self.booked.pk).update(end_time=None)
+
+
+class FreeSlotsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+        cls.therapist = Doctor.objects.create(user=User.objects.create(username='doc'), specialty='Терапевт')
+        cls.surgeon = Doctor.objects.create(user=User.objects.create(username='surgeon'), specialty='Хирург')
+        cls.patient = Patient.objects.create(
+            first_name='Пётр', last_name='Пациент', birth_date=date(1990, 1, 1), phone='+79990000000'
+        )
+        cls.day = next_day_at(9).date()
+
+    def _book(self, hour, minute, duration, doctor=None):
+        return Appointment.objects.create(
+            patient=self.patient, doctor=doctor or self.therapist,
+            date_time=next_day_at(hour, minute), duration=duration,
+        )
+
+    def test_free_starts_grid_edges(self):
+        self.assertEqual(list(free_starts(0, 3, 6)), [0, 1, 2, 3])
+        # Занят слот 2: двухслотовый приём начинается с 0, 3 или 4 (последний помещается впритык)
+        self.assertEqual(list(free_starts(0b100, 2, 6)), [0, 3, 4])
+        self.assertEqual(list(free_starts(0b100, 2, 6, not_before=4)), [4])
+        self.assertEqual(list(free_starts(0, 7, 6)), [])
+
+    def test_occupancy_clipped_to_workday(self):
+        self._book(8, 30, 40)   # 08:30–09:10: до начала дня, задевает первый слот
+        self._book(12, 0, 30)   # 12:00–12:30: слоты 18–20
+        self._book(20, 40, 40)  # 20:40–21:20: два последних слота, хвост за концом дня отброшен
+        self._book(20, 40, 30, doctor=self.surgeon)
+        cancelled = self._book(15, 0, 60)
+        Appointment.objects.filter(pk=cancelled.pk).update(status='cancelled')
+
+        occupancy = build_occupancy([self.therapist.pk], self.day, self.day + timedelta(days=1))
+
+        expected = 0b1 | (0b111 << 18) | (0b11 << 70)
+        self.assertEqual(occupancy, {(self.therapist.pk, self.day): expected})
+
+    @override_settings(CLINIC_WORKDAY_HOURS=(9, 10))
+    def test_slots_respect_duration_and_day_end(self):
+        starts = find_free_slots([self.therapist], self.day, self.day, 30, limit=100)
+        self.assertEqual([slot['time'] for slot in starts], ['09:00', '09:10', '09:20', '09:30'])
+        self.assertEqual(starts[-1]['end'], timezone.localtime(next_day_at(10)).isoformat())
+
+        self._book(9, 10, 20)
+        starts = find_free_slots([self.therapist], self.day, self.day, 30, limit=100)
+        self.assertEqual([slot['time'] for slot in starts], ['09:30'])
+        self.assertEqual(find_free_slots([self.therapist], self.day, self.day, 60), [])
+
+    def test_api_validates_doctor_and_matches_specialty_case(self):
+        self.client.force_login(self.admin)
+        params = {'start_date': self.day.isoformat(), 'end_date': self.day.isoformat(), 'limit': 1}
+
+        response = self.client.get('/api/slots/free/', {**params, 'doctor_id': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get('/api/slots/free/', {**params, 'specialty': 'ТЕРАПЕВТ'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([slot['doctor_id'] for slot in response.json()], [self.therapist.pk])
+
+        response = self.client.get('/api/slots/free/', {**params, 'limit': -5})
+        self.assertEqual(len(response.json()), 1)
+
+
+class ScheduleQueryCountTests(TestCase):
+    # Сессия + пользователь + одна выборка расписания
+    VIEW_QUERIES = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+        cls.day = next_day_at(9)
+        cls.doctors = [
+            Doctor.objects.create(
+                user=User.objects.create(username=f'doc_{i}', last_name=f'Врач{i}', first_name='Иван'),
+                specialty='Терапевт',
+            )
+            for i in range(4)
+        ]
+
+    def setUp(self):
+        self.added = 0
+
+    def _add_appointments(self, count):
+        statuses = ['scheduled', 'waiting', 'active', 'completed']
+        for i in range(self.added, self.added + count):
+            patient = Patient.objects.create(
+                first_name='Пётр', last_name=f'Пациент{i}', birth_date=date(1990, 1, 1), phone='+79990000000'
+            )
+            appointment = Appointment.objects.create(
+                patient=patient,
+                doctor=self.doctors[i % len(self.doctors)],
+                date_time=self.day + timedelta(minutes=30 * (i // len(self.doctors))),
+                duration=30,
+            )
+            Appointment.objects.filter(pk=appointment.pk).update(status=statuses[i % len(statuses)])
+        self.added += count
+
+    def _get_schedule(self):
+        self.client.force_login(self.admin)
+        with self.assertNumQueries(self.VIEW_QUERIES):
+            response = self.client.get('/api/schedule/', {'date': self.day.date().isoformat()})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self._add_appointments(2)
+        small = self._get_schedule()
+        self._add_appointments(40)
+        large = self._get_schedule()
+
+        self.assertEqual(sum(len(items) for items in small.values()), 2)
+        self.assertEqual(sum(len(items) for items in large.values()), 42)
+
+    def test_rows_bucketed_by_status_in_time_order(self):
+        self._add_appointments(8)
+        with self.assertNumQueries(1):
+            schedule = load_schedule(self.day.date())
+
+        self.assertEqual([len(schedule[status]) for status in schedule], [2, 2, 2, 2])
+        times = [item['time'] for item in schedule['scheduled']]
+        self.assertEqual(times, ['09:00 - 09:30', '09:30 - 10:00'])
+        self.assertEqual(schedule['waiting'][0]['doctor_name'], 'Врач1 Иван')
+
+
+class ScheduleStreamTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+        cls.doctors = [
+            Doctor.objects.create(user=User.objects.create(username=f'doc_{i}'), specialty='Терапевт') for i in range(2)
+        ]
+        cls.patient = Patient.objects.create(
+            first_name='Пётр', last_name='Пациент', birth_date=date(1990, 1, 1), phone='+79990000000'
+        )
+        cls.start = next_day_at(10)
+        cls.day = cls.start.date()
+
+    def _appointment(self, doctor=0):
+        return Appointment.objects.create(
+            patient=self.patient, doctor=self.doctors[doctor], date_time=self.start, duration=30
+        )
+
+    @staticmethod
+    def _event(kind, pk, day, doctor_id):
+        return {'type': kind, 'id': pk, 'status': 'scheduled', 'date': day.isoformat(), 'doctor_id': doctor_id}
+
+    @staticmethod
+    async def _received(subscription):
+        # deliver() передаёт событие в цикл через call_soon_threadsafe
+        await asyncio.sleep(0)
+        events = []
+        while not subscription.queue.empty():
+            events.append(subscription.queue.get_nowait())
+        return events
+
+    async def test_events_filtered_by_day_and_doctor(self):
+        events = ScheduleBroker()
+        everyone = events.subscribe(self.day)
+        doctor = events.subscribe(self.day, self.doctors[0].pk)
+        other_day = events.subscribe(self.day + timedelta(days=1))
+
+        events.publish(self._event('created', 1, self.day, self.doctors[0].pk))
+        events.publish(self._event('created', 2, self.day, self.doctors[1].pk))
+
+        self.assertEqual([e['id'] for e in await self._received(everyone)], [1, 2])
+        self.assertEqual([e['id'] for e in await self._received(doctor)], [1])
+        self.assertEqual(await self._received(other_day), [])
+
+    async def test_moved_appointment_leaves_old_day_and_doctor(self):
+        events = ScheduleBroker()
+        old_day = events.subscribe(self.day, ids=[7])
+        new_day = events.subscribe(self.day + timedelta(days=1))
+        doctor = events.subscribe(self.day, self.doctors[0].pk, ids=[8])
+
+        events.publish(self._event('updated', 7, self.day + timedelta(days=1), self.doctors[0].pk))
+        events.publish(self._event('updated', 8, self.day, self.doctors[1].pk))
+
+        self.assertEqual(
+            [(e['type'], e['id']) for e in await self._received(old_day)], [('deleted', 7), ('updated', 8)]
+        )
+        self.assertEqual([(e['type'], e['id']) for e in await self._received(new_day)], [('updated', 7)])
+        self.assertEqual([(e['type'], e['id']) for e in await self._received(doctor)], [('deleted', 8)])
+        # Запись ушла со старого дня: повторное изменение туда уже не попадает
+        events.publish(self._event('updated', 7, self.day + timedelta(days=1), self.doctors[0].pk))
+        self.assertEqual(await self._received(old_day), [])
+
+    async def test_overflow_replaced_by_reload(self):
+        events = ScheduleBroker()
+        subscription = events.subscribe(self.day)
+        for pk in range(subscription.queue.maxsize + 1):
+            events.publish(self._event('created', pk, self.day, None))
+
+        self.assertEqual(await self._received(subscription), [{'type': 'reload'}])
+
+    async def test_publish_appointment_reads_row(self):
+        appointment = await sync_to_async(self._appointment)()
+        events = ScheduleBroker()
+        subscription = events.subscribe(self.day)
+
+        await sync_to_async(events.publish_appointment)(appointment.pk, 'created')
+
+        [event] = await self._received(subscription)
+        self.assertEqual((event['type'], event['id'], event['status']), ('created', appointment.pk, 'scheduled'))
+        self.assertEqual(event['item']['time'], f'{self.start:%H:%M} - {self.start + timedelta(minutes=30):%H:%M}')
+
+    @override_settings(SCHEDULE_STREAM_MODE='poll', SCHEDULE_STREAM_POLL_SECONDS=0.01)
+    async def test_poll_mode_reads_changes_from_db(self):
+        appointment = await sync_to_async(self._appointment)()
+        events = ScheduleBroker()
+        subscription = events.subscribe(self.day, ids=[appointment.pk])
+        poller = events._poller
+        # Опрос сначала запоминает последний updated_at — изменения после него
+        await asyncio.sleep(0.1)
+
+        # В режиме poll события текущего процесса не публикуются напрямую — только опросом
+        await sync_to_async(events.publish_appointment)(appointment.pk, 'updated')
+        self.assertEqual(await self._received(subscription), [])
+        appointment.status = 'waiting'
+        await sync_to_async(appointment.save)()
+        event = await asyncio.wait_for(subscription.queue.get(), timeout=2)
+        self.assertEqual((event['type'], event['id'], event['status']), ('updated', appointment.pk, 'waiting'))
+
+        events.unsubscribe(subscription)
+        await asyncio.wait_for(poller, timeout=2)
+        self.assertIsNone(events._poller)
+
+    @override_settings(
+        SCHEDULE_STREAM_MODE='poll', SCHEDULE_STREAM_POLL_SECONDS=0.01, SCHEDULE_STREAM_POLL_GRACE_SECONDS=5
+    )
+    async def test_poll_mode_delivers_late_commits_once(self):
+        first = await sync_to_async(self._appointment)(0)
+        late = await sync_to_async(self._appointment)(1)
+        events = ScheduleBroker()
+        subscription = events.subscribe(self.day)
+        poller = events._poller
+        await asyncio.sleep(0.1)
+        # Записи, изменённые до подписки, не присылаются
+        self.assertEqual(await self._received(subscription), [])
+
+        first.status = 'waiting'
+        await sync_to_async(first.save)()
+        event = await asyncio.wait_for(subscription.queue.get(), timeout=2)
+        self.assertEqual((event['id'], event['status']), (first.pk, 'waiting'))
+
+        # Транзакция зафиксирована позже: updated_at раньше уже увиденного, но в пределах окна
+        updated_at = (await Appointment.objects.aget(pk=first.pk)).updated_at
+        late_commit = Appointment.objects.filter(pk=late.pk)
+        await late_commit.aupdate(status='waiting', updated_at=updated_at - timedelta(seconds=1))
+        event = await asyncio.wait_for(subscription.queue.get(), timeout=2)
+        self.assertEqual((event['type'], event['id'], event['status']), ('updated', late.pk, 'waiting'))
+
+        # Окно перечитывается каждым опросом, но повторов нет; за пределами окна изменение теряется
+        await late_commit.aupdate(status='scheduled', updated_at=updated_at - timedelta(seconds=6))
+        await asyncio.sleep(0.1)
+        self.assertEqual(await self._received(subscription), [])
+
+        events.unsubscribe(subscription)
+        await asyncio.wait_for(poller, timeout=2)
+
+    def test_stream_needs_admin_and_asgi(self):
+        self.client.force_login(User.objects.create(username='doc_user', role='doctor'))
+        self.assertEqual(self.client.get('/api/schedule/stream/').status_code, 403)
+        self.client.force_login(self.admin)
+        self.assertEqual(self.client.get('/api/schedule/stream/').status_code, 501)
+
+    async def test_stream_sends_deltas_for_shown_appointments(self):
+        appointment = await sync_to_async(self._appointment)()
+        await self.async_client.aforce_login(self.admin)
+        response = await self.async_client.get('/api/schedule/stream/', {'date': self.day.isoformat()})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b'retry: 3000\n\n')
+
+        # Запись, показанная при подключении, перенесена на другой день — клиент получает deleted
+        appointment.date_time += timedelta(days=1)
+        await sync_to_async(appointment.save)()
+        await sync_to_async(broker.publish_appointment)(appointment.pk, 'updated')
+
+        chunk = await asyncio.wait_for(anext(stream), timeout=2)
+        self.assertTrue(chunk.startswith(b'event: deleted\n'))
+        self.assertIn(f'"id": {appointment.pk}'.encode(), chunk)
+
+        # Отключение клиента: ASGI-обработчик отменяет задачу, ждущую следующего события
+        reader = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        reader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await reader
+        self.assertEqual(broker._subscribers, set())
+
+
+class AppointmentIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = Doctor.objects.create(user=User.objects.create(username='doc'), specialty='Терапевт')
+
+    def test_day_range_is_local_calendar_day(self):
+        start, end = day_range(date(2026, 3, 1))
+
+        self.assertEqual(timezone.localtime(start).isoformat(), '2026-03-01T00:00:00+03:00')
+        self.assertEqual(end - start, timedelta(days=1))
+
+    def test_doctor_day_filter_uses_composite_index(self):
+        start, end = day_range(timezone.localdate())
+        plan = Appointment.objects.filter(doctor=self.doctor, date_time__gte=start, date_time__lt=end).explain()
+
+        self.assertIn('appointment_doctor_time_idx', plan)
+
+    def test_status_day_filter_uses_composite_index(self):
+        start, end = day_range(timezone.localdate())
+        plan = Appointment.objects.filter(status='scheduled', date_time__gte=start, date_time__lt=end).explain()
+
+        self.assertIn('appointment_status_time_idx', plan)
+
+
+class PersonnelQueryCountTests(TestCase):
+    # Сессия + пользователь + одна выборка страницы
+    LIST_QUERIES = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+
+    def setUp(self):
+        self.added = 0
+        self.client.force_login(self.admin)
+
+    def _add_staff(self, count):
+        for i in range(self.added, self.added + count):
+            Doctor.objects.create(
+                user=User.objects.create(username=f'doc_{i}', last_name=f'Врач{i:02}', first_name='Иван'),
+                specialty='Терапевт',
+            )
+            Nurse.objects.create(
+                user=User.objects.create(username=f'nurse_{i}', last_name=f'Сестра{i:02}', role='nurse'),
+                department='Хирургия',
+            )
+            Receptionist.objects.create(
+                user=User.objects.create(username=f'reg_{i}', last_name=f'Регистратор{i:02}', role='receptionist'),
+            )
+        self.added += count
+
+    def _get(self, url, queries, params=None):
+        with self.assertNumQueries(queries):
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_legacy_lists_query_count_does_not_grow(self):
+        for url in ('/api/personnel/doctors/', '/api/personnel/nurses/', '/api/personnel/receptionists/'):
+            self._add_staff(2)
+            small = self._get(url, self.LIST_QUERIES)
+            self._add_staff(10)
+            large = self._get(url, self.LIST_QUERIES)
+            self.assertEqual(len(large) - len(small), 10)
+        self.assertEqual(large[0]['user_username'], 'reg_0')
+
+    def test_unified_list_filters_and_pages(self):
+        self._add_staff(5)
+        pages, cursor = [], None
+        while True:
+            params = {'limit': 4, **({'cursor': cursor} if cursor else {})}
+            page = self._get('/api/personnel/', self.LIST_QUERIES, params)
+            pages.append(page['results'])
+            cursor = page['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual([len(page) for page in pages], [4, 4, 4, 3])
+        self.assertEqual([item['role'] for item in pages[0]], ['doctor'] * 4)
+        self.assertEqual(len({(item['role'], item['id']) for page in pages for item in page}), 15)
+
+        nurses = self._get('/api/personnel/', self.LIST_QUERIES, {'role': 'nurse,receptionist', 'q': 'Сестра03'})
+        self.assertEqual([(item['full_name'], item['department']) for item in nurses['results']],
+                         [('Сестра03', 'Хирургия')])
+
+    def test_invalid_cursor_rejected(self):
+        response = self.client.get('/api/personnel/', {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_folds_cyrillic_case(self):
+        self._add_staff(1)
+        user = User.objects.create(username='Ivanov', last_name='Иванов', first_name='Семён')
+        Doctor.objects.create(user=user, specialty='Хирург')
+
+        def found(query):
+            return [item['full_name'] for item in self._get('/api/personnel/', self.LIST_QUERIES, {'q': query})['results']]
+
+        for query in ('иванов', 'ИВАНОВ семен', 'ванов', 'ivan'):
+            self.assertEqual(found(query), ['Иванов Семён'], query)
+        self.assertEqual(found('иванов олег'), [])
+
+        user.last_name = 'Петров'
+        user.save(update_fields=['last_name'])
+        self.assertEqual(found('иванов'), [])
+        self.assertEqual(found('петров'), ['Петров Семён'])
+
+
+class PatientSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        def patient(last_name, first_name, middle_name='', phone='+79990000000'):
+            return Patient.objects.create(
+                last_name=last_name, first_name=first_name, middle_name=middle_name,
+                birth_date=date(1990, 1, 1), phone=phone,
+            )
+
+        cls.semenov = patient('Семёнов', 'Артём', 'Ильич', phone='+7 (912) 345-67-89')
+        cls.semenova = patient('Семенова', 'Алёна')
+        cls.ivanov = patient('Иванов', 'Семён')
+        cls.krasnosemenov = patient('Красносеменов', 'Олег')
+
+    def _names(self, query, limit=10):
+        return [p.last_name for p in search_patients(query, limit)]
+
+    def test_rank_prefix_before_substring(self):
+        # Точная фамилия, начало ФИО, начало другого слова, подстрока
+        self.assertEqual(self._names('семенов'), ['Семёнов', 'Семенова', 'Красносеменов'])
+        self.assertEqual(self._names('семен'), ['Семёнов', 'Семенова', 'Иванов', 'Красносеменов'])
+        self.assertEqual(self._names('семен', limit=2), ['Семёнов', 'Семенова'])
+
+    def test_case_and_yo_folding(self):
+        for query in ('СЕМЁНОВ', 'Семенов', '  семёнов  '):
+            self.assertEqual(self._names(query)[0], 'Семёнов', query)
+        self.assertEqual(self._names('алена'), ['Семенова'])
+        self.assertEqual(self._names('семенов артем иль'), ['Семёнов'])
+        self.assertEqual(self._names('АРТЁМ ИЛЬ'), ['Семёнов'])
+
+    def test_substring_and_phone(self):
+        # Середина фамилии — только через подстрочный (trigram) индекс; равные по рангу — по ФИО
+        self.assertEqual(self._names('мено'), ['Красносеменов', 'Семёнов', 'Семенова'])
+        self.assertEqual(self._names('4567'), ['Семёнов'])
+        self.assertEqual(self._names('+7 912 345-67-89'), ['Семёнов'])
+        self.assertEqual(self._names('с'), [])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.krasnosemenov.last_name = 'Петрова'
+        self.krasnosemenov.save()
+        self.assertEqual(self._names('мено'), ['Семёнов', 'Семенова'])
+        self.assertEqual(self._names('етров'), ['Петрова'])
+
+        self.semenova.delete()
+        self.assertEqual(self._names('мено'), ['Семёнов'])
+        Patient.objects.filter(pk=self.ivanov.pk).delete()
+        self.assertEqual(self._names('семен'), ['Семёнов'])
+
+
+class PhoneLookupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+        cls.ivanov = Patient.objects.create(
+            first_name='Иван', last_name='Иванов', birth_date=date(1990, 1, 1), phone='89161234567'
+        )
+        cls.petrov = Patient.objects.create(
+            first_name='Пётр', last_name='Петров', birth_date=date(1990, 1, 1), phone='+79267654567'
+        )
+
+    def test_normalize_phone(self):
+        self.assertEqual(normalize_phone('+7 (916) 123-45-67'), '79161234567')
+        self.assertEqual(normalize_phone('8 916 123 45 67'), '79161234567')
+        self.assertEqual(normalize_phone('9161234567'), '79161234567')
+        # Прочие номера только очищаются от нецифр
+        self.assertEqual(normalize_phone('+375 29 123-45-67'), '375291234567')
+        self.assertEqual(normalize_phone(None), '')
+
+    def test_save_fills_normalized_and_reversed(self):
+        self.assertEqual(self.ivanov.phone_normalized, '79161234567')
+        self.assertEqual(self.ivanov.phone_reversed, '76543216197')
+
+        self.ivanov.phone = '+79160000001'
+        self.ivanov.save(update_fields=['phone'])
+        self.assertEqual(
+            Patient.objects.filter(pk=self.ivanov.pk).values_list('phone_normalized', 'phone_reversed').get(),
+            ('79160000001', '10000006197'),
+        )
+
+    def test_full_number_in_any_format(self):
+        for phone in ('+7 916 123-45-67', '8(916)1234567', '9161234567'):
+            self.assertEqual(find_by_phone(phone), [self.ivanov], phone)
+
+    def test_last_digits(self):
+        self.assertEqual(find_by_phone('34567'), [self.ivanov])
+        self.assertEqual(set(find_by_phone('4567')), {self.ivanov, self.petrov})
+        self.assertEqual(find_by_phone('567'), [])
+        self.assertEqual(find_by_phone('4567', limit=1), find_by_phone('4567')[:1])
+
+    def test_api_by_phone(self):
+        self.client.force_login(self.admin)
+        response = self.client.get('/api/patients/by-phone/', {'phone': '8 916 123-45-67'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['id'] for row in response.json()], [self.ivanov.pk])
+        self.assertEqual(self.client.get('/api/patients/by-phone/', {'phone': '4567', 'limit': 'x'}).status_code, 400)
+        # limit ограничен диапазоном 1..100
+        for limit in ('0', '-5'):
+            response = self.client.get('/api/patients/by-phone/', {'phone': '4567', 'limit': limit})
+            self.assertEqual(len(response.json()), 1, limit)
+        self.assertEqual(len(self.client.get('/api/patients/by-phone/', {'phone': '4567', 'limit': 500}).json()), 2)
+
+
+class PatientSearchCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+        for last_name, first_name in (
+            ('Иванов', 'Пётр'), ('Иванова', 'Мария'), ('Иваненко', 'Олег'), ('Петров', 'Иван'), ('Сидоров', 'Антон'),
+        ):
+            Patient.objects.create(
+                first_name=first_name, last_name=last_name, birth_date=date(1990, 1, 1), phone='+79990000000'
+            )
+
+    def setUp(self):
+        search_cache.clear()
+
+    @staticmethod
+    def _ids(patients):
+        return [patient.id for patient in patients]
+
+    def test_narrowed_results_match_fresh_query(self):
+        cache = PrefixSearchCache()
+        self.assertEqual(self._ids(cache.search('Ива')), self._ids(search_patients('ива')))
+        for query in ('иван', 'ИВАНО', 'иванов', 'иванова'):
+            with self.assertNumQueries(0):
+                narrowed = cache.search(query)
+            self.assertEqual(self._ids(narrowed), self._ids(search_patients(query)), query)
+        self.assertEqual((cache.misses, cache.narrowed, cache.hits), (1, 4, 0))
+
+    def test_patient_create_and_edit_clear_cache(self):
+        self.assertEqual(len(search_cache.search('иван')), 4)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.create(first_name='Ян', last_name='Иванцов', birth_date=date(1990, 1, 1), phone='+79990000001')
+        self.assertEqual(len(search_cache.search('иван')), 5)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            patient = Patient.objects.get(last_name='Сидоров')
+            patient.last_name = 'Иванчук'
+            patient.save()
+        self.assertIn(patient.id, self._ids(search_cache.search('иван')))
+
+    def test_lru_eviction(self):
+        cache = PrefixSearchCache(max_entries=2)
+        cache.search('иван')
+        cache.search('петр')
+        cache.search('иван')  # «иван» свежее «петр»
+        cache.search('сидор')
+
+        self.assertEqual(list(cache._entries), ['иван', 'сидор'])
+        cache.search('петр')
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+        # Лимит суммарного числа строк вытесняет старые записи
+        cache = PrefixSearchCache(max_rows=4)
+        cache.search('иван')
+        cache.search('сидор')
+        self.assertEqual((cache.stats()['entries'], cache.stats()['rows']), (1, 1))
+
+    def test_stats_endpoint_counts_hits_narrowed_and_misses(self):
+        self.client.force_login(self.admin)
+        before = self.client.get('/api/patients/search/stats/').json()
+        for query in ('ива', 'ива', 'иван'):
+            self.assertEqual(self.client.get('/api/patients/search/', {'q': query}).status_code, 200)
+        after = self.client.get('/api/patients/search/stats/').json()
+
+        self.assertEqual(
+            {counter: after[counter] - before[counter] for counter in ('hits', 'narrowed', 'misses')},
+            {'hits': 1, 'narrowed': 1, 'misses': 1},
+        )
+        self.assertEqual(after['entries'], 2)
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # Однофамильцы и тёзки: порядок внутри них решает id
+        for i in range(25):
+            Patient.objects.create(
+                last_name=f'Иванов{i % 3}', first_name=f'Пётр{i % 2}', birth_date=date(1990, 1, 1), phone='+79990000000'
+            )
+
+    def _walk(self, queryset, fields, descending=False, limit=7):
+        pages, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                items, cursor = paginate(queryset, fields, cursor, limit=limit, descending=descending)
+            pages.append([item.pk for item in items])
+            if not cursor:
+                return pages
+
+    def test_pages_follow_full_ordering_without_gaps(self):
+        fields = ('last_name', 'first_name', 'id')
+        for descending in (False, True):
+            pages = self._walk(Patient.objects.all(), fields, descending)
+            expected = list(Patient.objects.order_by(*order(fields, descending)).values_list('pk', flat=True))
+            self.assertEqual([len(page) for page in pages], [7, 7, 7, 4])
+            self.assertEqual([pk for page in pages for pk in page], expected)
+
+    def test_datetime_key_keeps_microseconds(self):
+        # Три документа в одной миллисекунде: курсор не должен пропускать соседей
+        moment = timezone.now().replace(microsecond=123000)
+        ids = []
+        for i in range(3):
+            document = Document.objects.create(title=f'Документ {i}')
+            Document.objects.filter(pk=document.pk).update(created_at=moment + timedelta(microseconds=100 * i))
+            ids.append(document.pk)
+        pages = self._walk(Document.objects.all(), ('created_at', 'id'), descending=True, limit=1)
+        self.assertEqual([pk for page in pages for pk in page], ids[::-1])
+
+    def test_cursor_is_signed(self):
+        _, cursor = paginate(Patient.objects.all(), ('last_name', 'first_name', 'id'), limit=5)
+        with self.assertRaises(CursorError):
+            paginate(Patient.objects.all(), ('last_name', 'first_name', 'id'), cursor[:-1] + 'x', limit=5)
+        with self.assertRaises(CursorError):
+            paginate(Patient.objects.all(), ('last_name', 'id'), cursor, limit=5)
+
+
+class StatusTransitionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = Doctor.objects.create(user=User.objects.create(username='doc'), specialty='Терапевт')
+        cls.patient = Patient.objects.create(
+            first_name='Пётр', last_name='Пациент', birth_date=date(1990, 1, 1), phone='+79990000000'
+        )
+
+    def _appointment(self, hour=9, status='scheduled'):
+        appointment = Appointment.objects.create(
+            patient=self.patient, doctor=self.doctor, date_time=next_day_at(hour), duration=30
+        )
+        if status != 'scheduled':
+            Appointment.objects.filter(pk=appointment.pk).update(status=status)
+        return appointment
+
+    def _visits(self, status):
+        return sum(AppointmentDayStats.objects.filter(status=status).values_list('visits', flat=True))
+
+    def test_allowed_transition_is_one_update_and_moves_rollups(self):
+        appointment = self._appointment()
+        self.assertEqual(self._visits('scheduled'), 1)
+
+        with CaptureQueriesContext(connection) as queries:
+            change_status(appointment.pk, 'waiting', expected='scheduled')
+        # С известным статусом запись читается и меняется одним UPDATE ... RETURNING
+        self.assertEqual([q['sql'].split()[0] for q in queries if '"app_appointment"' in q['sql']], ['UPDATE'])
+
+        self.assertEqual(Appointment.objects.get(pk=appointment.pk).status, 'waiting')
+        self.assertEqual((self._visits('scheduled'), self._visits('waiting')), (0, 1))
+
+    def test_forbidden_and_stale_transitions(self):
+        appointment = self._appointment(status='completed')
+        with self.assertRaisesMessage(TransitionError, 'Нельзя перевести'):
+            change_status(appointment.pk, 'scheduled')
+        with self.assertRaises(TransitionError) as error:
+            change_status(appointment.pk, 'completed', expected='active')
+        self.assertEqual(error.exception.status, 409)
+        with self.assertRaises(TransitionError) as error:
+            change_status(0, 'waiting')
+        self.assertEqual(error.exception.status, 404)
+
+    def test_cancel_requires_reason_and_fills_text(self):
+        appointment = self._appointment()
+        with self.assertRaisesMessage(TransitionError, 'Укажите причину отмены'):
+            change_status(appointment.pk, 'cancelled')
+        change_status(appointment.pk, 'cancelled', cancel_reason_type='doctor_cancelled')
+        self.assertEqual(Appointment.objects.get(pk=appointment.pk).cancel_reason, 'Врач отменил запись')
+
+    def test_restore_to_schedule_checks_overlap(self):
+        cancelled = self._appointment()
+        change_status(cancelled.pk, 'cancelled', cancel_reason='Ошибка')
+        self._appointment()
+        with self.assertRaisesMessage(TransitionError, 'ВРЕМЯ ЗАНЯТО'):
+            change_status(cancelled.pk, 'scheduled', expected='cancelled')
+        self.assertEqual(Appointment.objects.get(pk=cancelled.pk).status, 'cancelled')
+
+    def test_save_validates_only_changed_fields(self):
+        appointment = self._appointment()
+        # Запись уже в прошлом и врач ушёл в отпуск: правка заметок не должна упираться в эти проверки
+        Appointment.objects.filter(pk=appointment.pk).update(date_time=timezone.now() - timedelta(days=1))
+        Doctor.objects.filter(pk=self.doctor.pk).update(is_active=False)
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        appointment.notes = 'Повторный осмотр'
+        with CaptureQueriesContext(connection) as queries:
+            appointment.save()
+        # Ни проверки врача и пациента, ни поиска пересечений
+        touched = ' '.join(q['sql'] for q in queries)
+        self.assertNotIn('"app_doctor"', touched)
+        self.assertNotIn('"app_patient"', touched)
+        self.assertNotIn('"end_time" >', touched)
+
+        appointment.status = 'completed'
+        appointment.save()
+        appointment.status = 'scheduled'
+        with self.assertRaises(ValidationError) as error:
+            appointment.save()
+        self.assertIn('status', error.exception.message_dict)
+
+
+class BulkStatusTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+        cls.doctors = [
+            Doctor.objects.create(user=User.objects.create(username=f'doc_{i}'), specialty='Терапевт') for i in range(2)
+        ]
+        cls.patient = Patient.objects.create(
+            first_name='Пётр', last_name='Пациент', birth_date=date(1990, 1, 1), phone='+79990000000'
+        )
+
+    def _appointments(self, count, doctor=0, days=2):
+        return [
+            Appointment.objects.create(
+                patient=self.patient, doctor=self.doctors[doctor], duration=30,
+                date_time=next_day_at(8, days=days + i // 20) + timedelta(minutes=30 * (i % 20)),
+            ).pk
+            for i in range(count)
+        ]
+
+    def _post(self, payload):
+        self.client.force_login(self.admin)
+        return self.client.post('/api/appointments/bulk-status/', payload, content_type='application/json')
+
+    def _count_queries(self, ids, status, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            bulk_change_status(ids, status, **kwargs)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_batch(self):
+        small = self._count_queries(self._appointments(3, days=2), 'cancelled', cancel_reason_type='doctor_cancelled')
+        large = self._count_queries(self._appointments(60, days=5), 'cancelled', cancel_reason_type='doctor_cancelled')
+        self.assertEqual(small, large)
+
+        cancelled = Appointment.objects.filter(status='cancelled')
+        self.assertEqual(cancelled.count(), 63)
+        self.assertEqual(set(cancelled.values_list('cancel_reason', flat=True)), {'Врач отменил запись'})
+        self.assertEqual(sum(AppointmentDayStats.objects.filter(status='scheduled').values_list('visits', flat=True)), 0)
+        self.assertEqual(sum(AppointmentDayStats.objects.filter(status='cancelled').values_list('visits', flat=True)), 63)
+
+    def test_cancel_keeps_comment_and_defaults_type(self):
+        first, second = self._appointments(2)
+        Appointment.objects.filter(pk=first).update(cancel_reason='Заболел')
+        bulk_change_status([first, second], 'cancelled')
+        rows = dict(Appointment.objects.filter(pk__in=[first, second]).values_list('pk', 'cancel_reason'))
+        self.assertEqual(rows, {first: 'Заболел', second: 'Запись отменена'})
+        self.assertEqual(set(Appointment.objects.values_list('cancel_reason_type', flat=True)), {'other'})
+
+    def test_invalid_rows_reject_whole_batch(self):
+        ids = self._appointments(3)
+        Appointment.objects.filter(pk=ids[0]).update(status='completed')
+        response = self._post({'ids': ids + [0], 'status': 'no_show'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(set(response.json()['errors']), {str(ids[0]), '0'})
+        self.assertFalse(Appointment.objects.filter(status='no_show').exists())
+
+        response = self._post({'ids': ids, 'status': 'no_show', 'skip_invalid': True})
+        self.assertEqual(response.json()['updated'], ids[1:])
+
+    def test_restore_to_schedule_checks_overlaps_setwise(self):
+        ids = self._appointments(2)
+        bulk_change_status(ids, 'cancelled', cancel_reason='Ошибка')
+        taken = self._appointments(1)[0]  # занимает время первой записи
+        with self.assertRaises(BulkTransitionError) as error:
+            bulk_change_status(ids, 'scheduled')
+        self.assertEqual(list(error.exception.errors), [ids[0]])
+
+        Appointment.objects.filter(pk=taken).delete()
+        bulk_change_status(ids, 'scheduled')
+        self.assertEqual(Appointment.objects.filter(status='scheduled').count(), 2)
+
+
+class RollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctors = [
+            Doctor.objects.create(user=User.objects.create(username=f'doc_{i}'), specialty='Терапевт') for i in range(2)
+        ]
+        cls.patients = [
+            Patient.objects.create(
+                first_name='Пётр', last_name=f'Пациент{i}', birth_date=date(1990, 1, 1), phone='+79990000000'
+            )
+            for i in range(2)
+        ]
+        cls.service = Service.objects.create(name='Осмотр', price=Decimal('500.00'))
+        cls.day = next_day_at(10).date()
+
+    @staticmethod
+    def _stats():
+        """Ненулевые строки всех сводок (инкрементальный учёт оставляет обнулённые строки)"""
+        return {
+            model._meta.model_name: sorted(
+                row for row in model.objects.values_list(*key, *totals) if any(row[len(key):])
+            )
+            for model, key, totals in (
+                (AppointmentDayStats, ('day', 'doctor_id', 'status'), ('visits', 'duration')),
+                (ServiceDayStats, ('day', 'doctor_id', 'service_id'), ('quantity', 'revenue')),
+                (PatientDayStats, ('day', 'doctor_id', 'patient_id'), ('visits',)),
+            )
+        }
+
+    def _appointment(self, doctor, patient, hour, duration):
+        return Appointment.objects.create(
+            patient=self.patients[patient], doctor=self.doctors[doctor], date_time=next_day_at(hour), duration=duration
+        )
+
+    def _day_stats(self, day, doctor):
+        rows = AppointmentDayStats.objects.filter(day=day, doctor=self.doctors[doctor]).exclude(visits=0)
+        return {status: (visits, duration) for status, visits, duration in rows.values_list('status', 'visits', 'duration')}
+
+    def test_signal_deltas_match_rebuild(self):
+        first = self._appointment(0, 0, 10, 30)
+        second = self._appointment(0, 1, 11, 20)
+        self.assertEqual(self._day_stats(self.day, 0), {'scheduled': (2, 50)})
+
+        # Перенос на другой день и к другому врачу
+        first.date_time += timedelta(days=1)
+        first.doctor = self.doctors[1]
+        first.save()
+        self.assertEqual(self._day_stats(self.day, 0), {'scheduled': (1, 20)})
+        self.assertEqual(self._day_stats(self.day + timedelta(days=1), 1), {'scheduled': (1, 30)})
+
+        second.status = 'waiting'
+        second.save()
+        self.assertEqual(self._day_stats(self.day, 0), {'waiting': (1, 20)})
+
+        # Строка счёта и её правка
+        invoice = Invoice.objects.create(appointment=second)
+        line = InvoiceService.objects.create(invoice=invoice, service=self.service, quantity=1, price_at_time=500)
+        line.quantity = 3
+        line.save()
+        self.assertEqual(
+            list(ServiceDayStats.objects.exclude(quantity=0).values_list('day', 'quantity', 'revenue')),
+            [(self.day, 3, Decimal('1500.00'))],
+        )
+
+        # Перенос записи со счётом переносит и услуги
+        second.date_time += timedelta(days=2)
+        second.save()
+        self.assertEqual(
+            list(ServiceDayStats.objects.exclude(quantity=0).values_list('day', 'quantity')),
+            [(self.day + timedelta(days=2), 3)],
+        )
+
+        first.delete()
+        self.assertEqual(self._day_stats(self.day + timedelta(days=1), 1), {})
+
+        incremental = self._stats()
+        rollups.rebuild()
+        self.assertEqual(incremental, self._stats())
+
+    def test_same_patient_day_keeps_patient_visits(self):
+        appointment = self._appointment(0, 0, 10, 30)
+        appointment.duration = 40
+        appointment.save()
+        self.assertEqual(
+            list(PatientDayStats.objects.values_list('patient_id', 'visits')), [(self.patients[0].pk, 1)]
+        )
+        self.assertEqual(self._day_stats(self.day, 0), {'scheduled': (1, 40)})
+
+
+class StatsCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = Doctor.objects.create(user=User.objects.create(username='doc'), specialty='Терапевт')
+        cls.today = timezone.localdate()
+        cls.start, cls.end = cls.today - timedelta(days=10), cls.today - timedelta(days=5)
+
+    def setUp(self):
+        cache.clear()
+        self.computed = 0
+
+    def _compute(self):
+        self.computed += 1
+        return self.computed
+
+    def _cached(self, start=None, end=None):
+        return stats_cache.cached_stats({'metric': 'visits'}, start or self.start, end or self.end, self._compute)
+
+    def test_write_to_closed_day_makes_range_stale(self):
+        self.assertEqual((self._cached(), self._cached()), (1, 1))
+
+        # Изменение сводки за день вне диапазона результат не трогает
+        with self.captureOnCommitCallbacks(execute=True):
+            rollups._add(
+                AppointmentDayStats, {'day': self.end + timedelta(days=1), 'doctor_id': self.doctor.pk, 'status': 'completed'},
+                visits=1,
+            )
+        self.assertEqual(self._cached(), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            rollups._add(
+                AppointmentDayStats, {'day': self.start, 'doctor_id': self.doctor.pk, 'status': 'completed'}, visits=1,
+            )
+        self.assertEqual((self._cached(), self._cached()), (2, 2))
+
+        # Пересборка сводок устаревает всё
+        stats_cache.touch_all()
+        self.assertEqual(self._cached(), 3)
+
+    def test_range_with_today_gets_short_ttl(self):
+        with mock.patch.object(cache, 'set', wraps=cache.set) as cache_set:
+            self._cached()
+            self._cached(end=self.today)
+        timeouts = [call.kwargs['timeout'] for call in cache_set.call_args_list if call.args[0].startswith('stats:result:')]
+        self.assertEqual(timeouts, [None, settings.STATS_CACHE_TODAY_SECONDS])
+
+    def test_waits_for_concurrent_computation(self):
+        key = stats_cache._entry_key({'metric': 'visits'}, self.start, self.end)
+        stamps = stats_cache._stamps(self.start, self.end)
+        # Блокировку держит другой запрос; он кладёт результат через 0.1 с
+        cache.add(f'{key}:lock', 1)
+        timer = threading.Timer(0.1, lambda: cache.set(key, (stamps, 'чужой результат')))
+        timer.start()
+        try:
+            self.assertEqual(self._cached(), 'чужой результат')
+        finally:
+            timer.join()
+        self.assertEqual(self.computed, 0)
+
+    @override_settings(STATS_CACHE_LOCK_SECONDS=0.1)
+    def test_lock_timeout_computes_without_lock(self):
+        key = stats_cache._entry_key({'metric': 'visits'}, self.start, self.end)
+        # Владелец блокировки завис: после STATS_CACHE_LOCK_SECONDS считаем сами
+        cache.add(f'{key}:lock', 1, timeout=None)
+        started = time.monotonic()
+
+        self.assertEqual(self._cached(), 1)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertEqual(cache.get(f'{key}:lock'), 1)
+
+    def test_api_rejects_bad_dates(self):
+        self.client.force_login(User.objects.create(username='chief', role='admin'))
+        response = self.client.get('/api/stats/data/', {'startDate': self.start.isoformat(), 'endDate': self.end.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        for params in ({'startDate': 'foo'}, {'endDate': '2026-02-30'}):
+            response = self.client.get('/api/stats/data/', params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('error', response.json())
+
+
+class StatsCubeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+        cls.therapist = Doctor.objects.create(
+            user=User.objects.create(username='doc', last_name='Терапевтов', first_name='Иван'), specialty='Терапевт'
+        )
+        cls.surgeon = Doctor.objects.create(
+            user=User.objects.create(username='surgeon', last_name='Хирургов', first_name='Олег'), specialty='Хирург'
+        )
+        cls.service = Service.objects.create(name='Осмотр', price=Decimal('500.00'))
+        patient = Patient.objects.create(
+            first_name='Пётр', last_name='Пациент', birth_date=date(1990, 1, 1), phone='+79990000000'
+        )
+        cls.march, cls.april = date(2026, 3, 10), date(2026, 4, 2)
+        AppointmentDayStats.objects.bulk_create([
+            AppointmentDayStats(day=cls.march, doctor=cls.therapist, status='completed', visits=3, duration=90),
+            AppointmentDayStats(day=cls.march, doctor=cls.therapist, status='no_show', visits=1, duration=30),
+            AppointmentDayStats(day=cls.april, doctor=cls.surgeon, status='completed', visits=2, duration=120),
+            # Обнулённая строка сводки в кубе не участвует
+            AppointmentDayStats(day=cls.april, doctor=cls.therapist, status='completed', visits=0, duration=0),
+        ])
+        ServiceDayStats.objects.bulk_create([
+            ServiceDayStats(day=cls.march, doctor=cls.therapist, service=cls.service, quantity=2, revenue=Decimal('1000')),
+            ServiceDayStats(day=cls.april, doctor=cls.therapist, service=cls.service, quantity=1, revenue=Decimal('500')),
+        ])
+        PatientDayStats.objects.bulk_create([
+            PatientDayStats(day=cls.march, doctor=cls.therapist, patient=patient, visits=4),
+            PatientDayStats(day=cls.april, doctor=cls.therapist, patient=patient, visits=1),
+        ])
+
+    def setUp(self):
+        cache.clear()
+
+    def _cube(self, measures, dimensions=(), filters=None):
+        return run_cube(date(2026, 3, 1), date(2026, 4, 30), measures, dimensions, filters)
+
+    def test_validation(self):
+        for measures, dimensions, filters in (
+            ([], (), None),
+            (['profit'], (), None),
+            (['visits'], ('doctor', 'doctor'), None),
+            (['visits'], ('day', 'month'), None),
+            (['visits'], ('service',), None),
+            (['revenue'], (), {'status': ['completed']}),
+            (['visits'], (), {'room': ['1']}),
+        ):
+            with self.assertRaises(CubeError, msg=(measures, dimensions, filters)):
+                self._cube(measures, dimensions, filters)
+
+    def test_measures_from_different_rollups_merge_by_key(self):
+        rows = self._cube(['visits', 'no_shows', 'avg_duration', 'revenue', 'unique_patients'], ['doctor'])
+
+        self.assertEqual(rows, [
+            {'doctor': {'id': self.therapist.pk, 'name': 'Терапевтов Иван'},
+             'visits': 4, 'no_shows': 1, 'avg_duration': 30.0, 'revenue': 1500.0, 'unique_patients': 1},
+            # Выручки и пациентов у хирурга нет — ноль, а не пропуск
+            {'doctor': {'id': self.surgeon.pk, 'name': 'Хирургов Олег'},
+             'visits': 2, 'no_shows': 0, 'avg_duration': 60.0, 'revenue': 0, 'unique_patients': 0},
+        ])
+
+    def test_month_and_specialty_with_filters(self):
+        rows = self._cube(['visits', 'revenue'], ['month', 'specialty'], {'status': [], 'specialty': ['Терапевт']})
+        self.assertEqual(rows, [
+            {'month': '2026-03-01', 'specialty': 'Терапевт', 'visits': 4, 'revenue': 1000.0},
+            {'month': '2026-04-01', 'specialty': 'Терапевт', 'visits': 0, 'revenue': 500.0},
+        ])
+        rows = self._cube(['visits'], ['status'], {'doctor': [self.therapist.pk]})
+        self.assertEqual([(row['status'], row['visits']) for row in rows], [('completed', 3), ('no_show', 1)])
+
+    def test_totals_without_dimensions(self):
+        self.assertEqual(self._cube(['visits', 'avg_duration', 'revenue']), [
+            {'visits': 6, 'avg_duration': 40.0, 'revenue': 1500.0},
+        ])
+
+    def test_api_runs_named_queries_and_reports_errors(self):
+        self.client.force_login(self.admin)
+        payload = {
+            'start': '2026-03-01', 'end': '2026-04-30',
+            'queries': {
+                'total': {'measures': ['visits', 'revenue']},
+                'by_day': {'measures': ['visits'], 'dimensions': ['day'], 'filters': {'doctor': [self.surgeon.pk]}},
+            },
+        }
+        response = self.client.post('/api/stats/cube/', payload, content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'total': [{'visits': 6, 'revenue': 1500.0}],
+            'by_day': [{'day': '2026-04-02', 'visits': 2}],
+        })
+        response = self.client.get('/api/stats/cube/', {'measures': 'visits', 'dimensions': 'week,month'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+        cls.doctor = Doctor.objects.create(
+            user=User.objects.create(username='doc', last_name='Терапевтов', first_name='Иван'), specialty='Терапевт'
+        )
+        other = Doctor.objects.create(user=User.objects.create(username='other'), specialty='Хирург')
+        cls.patient = Patient.objects.create(
+            first_name='Пётр', last_name='Пациент', birth_date=date(1990, 1, 1), phone='+79990000000'
+        )
+        Patient.objects.create(
+            first_name='Анна', last_name='Без записей', birth_date=date(1985, 5, 5), phone='+79990000001'
+        )
+        cls.start = next_day_at(9)
+        cls.appointments = [
+            Appointment.objects.create(
+                patient=cls.patient, doctor=cls.doctor, duration=30, date_time=cls.start + timedelta(hours=i),
+                reason='Боль <справа> & отёк\x01',
+            )
+            for i in range(3)
+        ]
+        Appointment.objects.create(patient=cls.patient, doctor=other, duration=30, date_time=cls.start)
+        Appointment.objects.filter(pk=cls.appointments[2].pk).update(status='completed')
+        service = Service.objects.create(name='Осмотр', price=Decimal('1000.00'))
+        invoice = Invoice.objects.create(appointment=cls.appointments[2])
+        InvoiceService.objects.create(invoice=invoice, service=service, quantity=2, price_at_time=Decimal('1000.00'))
+        Invoice.objects.create(appointment=cls.appointments[1])
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def _get(self, dataset, **params):
+        response = self.client.get(f'/api/export/{dataset}/', params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, list(response.streaming_content)
+
+    def _csv(self, dataset, **params):
+        response, chunks = self._get(dataset, format='csv', **params)
+        body = b''.join(chunks).decode()
+        self.assertTrue(body.startswith('\ufeff'))
+        return list(csv.reader(body[1:].splitlines()))
+
+    def test_csv_with_filters(self):
+        rows = self._csv('appointments', doctor_id=self.doctor.pk, status='scheduled')
+        self.assertEqual(rows[0][:4], ['ID', 'Дата и время', 'Длительность (мин)', 'Статус'])
+        self.assertEqual([row[0] for row in rows[1:]], [str(a.pk) for a in self.appointments[:2]])
+        self.assertEqual(rows[1][1], f'{self.start:%Y-%m-%d %H:%M}')
+        self.assertEqual(rows[1][3:7], ['Запланирован', 'Пациент Пётр', '+79990000000', 'Терапевтов Иван'])
+
+        day = self.start.date().isoformat()
+        self.assertEqual(len(self._csv('appointments', startDate=day, endDate=day)), 5)
+        # Фильтры записей ограничивают и пациентов
+        self.assertEqual(len(self._csv('patients')), 3)
+        self.assertEqual(len(self._csv('patients', startDate=day)), 2)
+
+    def test_invoice_rows_per_service(self):
+        rows = self._csv('invoices')
+        self.assertEqual(rows[1][4:13], ['Осмотр', '2', '1000.00', '2000.00', '2000.00', '0', '2000.00', 'Нет', ''])
+        # Счёт без услуг — строка с пустой услугой
+        self.assertEqual(rows[2][4:9], ['', '', '', '', '0.00'])
+
+    def test_streams_in_chunks(self):
+        with mock.patch.object(export, 'CHUNK_SIZE', 2):
+            _, chunks = self._get('appointments', format='csv')
+        # BOM, два куска по две строки и остаток
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(len(b''.join(chunks).decode().splitlines()), 5)
+
+    def test_xlsx(self):
+        response, chunks = self._get('appointments', format='xlsx', doctor_id=self.doctor.pk)
+        self.assertEqual(response['Content-Type'], export.CONTENT_TYPES['xlsx'])
+        self.assertIn('attachment; filename="appointments_', response['Content-Disposition'])
+
+        path = os.path.join(tempfile.mkdtemp(), 'export.xlsx')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'wb') as file:
+            file.writelines(chunks)
+        with zipfile.ZipFile(path) as archive:
+            self.assertIsNone(archive.testzip())
+            sheet = archive.read('xl/worksheets/sheet1.xml').decode()
+        self.assertEqual(sheet.count('<row>'), 4)
+        self.assertIn(f'<c><v>{self.appointments[0].pk}</v></c>', sheet)
+        # Текст экранирован, управляющие символы, недопустимые в XML, убраны
+        self.assertIn('<t xml:space="preserve">Боль &lt;справа&gt; &amp; отёк</t>', sheet)
+
+    def test_management_command_output(self):
+        out = io.StringIO()
+        call_command('export', 'appointments', '--doctor', str(self.doctor.pk), stdout=out)
+        rows = list(csv.reader(out.getvalue().lstrip('\ufeff').splitlines()))
+        self.assertEqual([row[0] for row in rows[1:]], [str(a.pk) for a in self.appointments])
+
+        out = io.BytesIO()
+        call_command('export', 'patients', '--format', 'xlsx', stdout=out)
+        with zipfile.ZipFile(out) as archive:
+            self.assertEqual(archive.read('xl/worksheets/sheet1.xml').decode().count('<row>'), 3)
+        with self.assertRaises(CommandError):
+            call_command('export', 'patients', '--format', 'xlsx', stdout=io.StringIO())
+
+    def test_errors(self):
+        self.assertEqual(self.client.get('/api/export/doctors/').status_code, 400)
+        self.assertEqual(self.client.get('/api/export/patients/', {'format': 'pdf'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/export/patients/', {'startDate': '2026-13-01'}).status_code, 400)
+        self.client.force_login(self.doctor.user)
+        self.assertEqual(self.client.get('/api/export/patients/').status_code, 403)
+
+
+class BulkImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+        cls.doctor = Doctor.objects.create(user=User.objects.create(username='doc'), specialty='Терапевт')
+        cls.patient = Patient.objects.create(
+            first_name='Пётр', last_name='Пациент', birth_date=date(1990, 1, 1), phone='+7 (999) 000-00-00'
+        )
+        cls.start = next_day_at(10)
+        Appointment.objects.create(patient=cls.patient, doctor=cls.doctor, date_time=cls.start, duration=30)
+
+    def setUp(self):
+        cache.clear()
+
+    def _at(self, minutes):
+        return f'{timezone.localtime(self.start) + timedelta(minutes=minutes):%Y-%m-%d %H:%M}'
+
+    def _appointments_csv(self, *rows):
+        lines = ['doctor_id,patient_id,patient_phone,date_time,duration']
+        lines += [','.join(str(value) for value in row) for row in rows]
+        return run_import('appointments', io.StringIO('\n'.join(lines)), 'csv')
+
+    def test_patient_errors_by_line(self):
+        self.assertEqual(counters.get_counter('patients'), 1)
+        self.assertEqual(list(search_patients('Петрова')), [])
+        text = '\n'.join([
+            '{"last_name": "Иванов", "first_name": "Иван", "birth_date": "1980-02-03", "phone": "+79991112233"}',
+            '',
+            'не json',
+            '["список"]',
+            '{"last_name": "Сидоров", "first_name": "Сидор", "birth_date": "03.02.1980", "phone": "12", "discount": 150}',
+            '{"last_name": "Петрова", "first_name": "Анна", "birth_date": "1991-04-05", "phone": "89990001122"}',
+        ])
+        report = run_import('patients', io.StringIO(text), 'jsonl').as_dict()
+
+        self.assertEqual(report['created'], 2)
+        self.assertEqual([error['line'] for error in report['errors']], [3, 4, 5])
+        self.assertTrue(report['errors'][0]['error'].startswith('Некорректный JSON'))
+        self.assertEqual(set(part.split(':')[0] for part in report['errors'][2]['error'].split('; ')),
+                         {'birth_date', 'phone', 'discount'})
+        # bulk_create мимо сигналов — счётчик и поиск сброшены импортом
+        self.assertEqual(counters.get_counter('patients'), 3)
+        self.assertEqual([p.last_name for p in search_patients('Петрова')], ['Петрова'])
+        self.assertEqual(Patient.objects.get(last_name='Иванов').phone_normalized, '79991112233')
+
+    def test_appointment_checks_in_batches(self):
+        with mock.patch('app.imports.BATCH_SIZE', 2):
+            report = self._appointments_csv(
+                (self.doctor.pk, '', '89990000000', self._at(60), 30),
+                (self.doctor.pk, '', '89990000000', self._at(20), 30),   # занято существующей записью
+                (self.doctor.pk, '', '+70000000000', self._at(120), 30),  # неизвестный телефон
+                (999, self.patient.pk, '', self._at(180), 30),
+                (self.doctor.pk, self.patient.pk, '', self._at(200), 30),
+                (self.doctor.pk, self.patient.pk, '', self._at(220), 15),  # длительность не кратна 10
+                (self.doctor.pk, self.patient.pk, '', self._at(300), 30),
+            ).as_dict()
+
+        self.assertEqual(report['created'], 3)
+        # Ошибки пачки идут по этапам проверки, а не по строкам
+        self.assertEqual(sorted((error['line'], error['error'].split(':')[0]) for error in report['errors']), [
+            (3, 'date_time'), (4, 'patient_phone'), (5, 'doctor_id'), (7, 'duration'),
+        ])
+        self.assertEqual(Appointment.objects.count(), 4)
+
+    def test_overlaps_inside_file(self):
+        report = self._appointments_csv(
+            (self.doctor.pk, self.patient.pk, '', self._at(60), 30),
+            (self.doctor.pk, self.patient.pk, '', self._at(80), 30),
+        ).as_dict()
+        self.assertEqual(report['created'], 1)
+        self.assertEqual(report['errors'], [{'line': 3, 'error': 'date_time: Пересекается с записью в строке 2'}])
+
+    def test_constraint_violation_rolls_back_batch(self):
+        # Предпроверка пересечений пропущена (как при гонке) — пачку останавливает ограничение БД
+        with mock.patch('app.imports._reject_overlaps', side_effect=lambda report, candidates: candidates):
+            report = self._appointments_csv(
+                (self.doctor.pk, self.patient.pk, '', self._at(60), 30),
+                (self.doctor.pk, self.patient.pk, '', self._at(20), 30),
+                (self.doctor.pk, self.patient.pk, '', self._at(120), 30),
+            ).as_dict()
+
+        self.assertEqual(report['created'], 2)
+        self.assertEqual([error['line'] for error in report['errors']], [3])
+        self.assertTrue(report['errors'][0]['error'].startswith('Нарушено ограничение БД'))
+        # Строки откатившейся пачки вставлены заново по одной, без дублей
+        self.assertEqual(
+            sorted(Appointment.objects.values_list('date_time', flat=True)),
+            [self.start, self.start + timedelta(minutes=60), self.start + timedelta(minutes=120)],
+        )
+
+    def test_api(self):
+        self.client.force_login(self.admin)
+        upload = SimpleUploadedFile(
+            'patients.csv', '\ufefflast_name,first_name,birth_date,phone\nИванов,Иван,1980-02-03,+79991112233\n,,,\n'.encode()
+        )
+        response = self.client.post('/api/import/patients/', {'file': upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['created'], 1)
+        self.assertEqual([error['line'] for error in response.json()['errors']], [3])
+
+        upload = SimpleUploadedFile('patients.xlsx', b'')
+        self.assertEqual(self.client.post('/api/import/patients/', {'file': upload}).status_code, 400)
+        self.client.force_login(self.doctor.user)
+        self.assertEqual(self.client.post('/api/import/patients/', {'file': upload}).status_code, 403)
+
+
+class CounterCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = Doctor.objects.create(user=User.objects.create(username='doc'), specialty='Терапевт')
+        cls.patient = Patient.objects.create(
+            first_name='Пётр', last_name='Пациент', birth_date=date(1990, 1, 1), phone='+79990000000'
+        )
+
+    def setUp(self):
+        cache.clear()
+        counters.reset_clinic_info()
+        self.addCleanup(counters.reset_clinic_info)
+
+    def test_counters_cached_until_commit(self):
+        self.assertEqual(counters.get_counter('patients'), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(counters.get_counter('patients'), 1)
+
+        # Откат транзакции счётчик не сбрасывает
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Patient.objects.create(
+                        first_name='Анна', last_name='Откат', birth_date=date(1985, 5, 5), phone='+79990000001'
+                    )
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+        self.assertEqual(counters.get_counter('patients'), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.create(first_name='Анна', last_name='Новая', birth_date=date(1985, 5, 5), phone='+79990000001')
+        self.assertEqual(counters.get_counter('patients'), 2)
+
+        self.assertEqual(counters.get_counter('doctors'), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.doctor.is_active = False
+            self.doctor.save()
+        self.assertEqual(counters.get_counter('doctors'), 0)
+
+    def test_appointments_today_follows_day(self):
+        day = next_day_at(10).date()
+        self.assertEqual(counters.get_counter('appointments_today'), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            Appointment.objects.create(patient=self.patient, doctor=self.doctor, duration=30, date_time=next_day_at(10))
+        with mock.patch('app.counters.timezone.localdate', return_value=day):
+            # Новый день — новый ключ, вчерашнее значение не используется
+            self.assertEqual(counters.get_counter('appointments_today'), 1)
+            with self.captureOnCommitCallbacks(execute=True):
+                Appointment.objects.create(patient=self.patient, doctor=self.doctor, duration=30, date_time=next_day_at(11))
+            self.assertEqual(counters.get_counter('appointments_today'), 2)
+
+    def test_clinic_info(self):
+        self.assertEqual(counters.clinic_info().name, 'Клиника')
+        with self.captureOnCommitCallbacks(execute=True):
+            clinic = ClinicInfo.objects.create(name='Улыбка')
+        with self.assertNumQueries(1):
+            self.assertEqual(counters.clinic_info().name, 'Улыбка')
+            self.assertEqual(counters.clinic_info().name, 'Улыбка')
+
+        # Изменение в другом процессе (мимо сигналов) видно после CLINIC_INFO_CACHE_SECONDS
+        ClinicInfo.objects.filter(pk=clinic.pk).update(name='Улыбка+')
+        self.assertEqual(counters.clinic_info().name, 'Улыбка')
+        expired = time.monotonic() + settings.CLINIC_INFO_CACHE_SECONDS + 1
+        with mock.patch('app.counters.time.monotonic', return_value=expired):
+            self.assertEqual(counters.clinic_info().name, 'Улыбка+')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            clinic.delete()
+        self.assertEqual(counters.clinic_info().name, 'Клиника')
+
+
+class CloseDayTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+        cls.doctor = Doctor.objects.create(user=User.objects.create(username='doc'), specialty='Терапевт')
+        cls.patient = Patient.objects.create(
+            first_name='Пётр', last_name='Пациент', birth_date=date(1990, 1, 1), phone='+79990000000', discount=10
+        )
+        cls.services = [
+            Service.objects.create(name='Осмотр', price=Decimal('1000.00')),
+            Service.objects.create(name='Снимок', price=Decimal('555.55')),
+        ]
+        cls.day = next_day_at(8).date()
+
+    def _completed(self, count, services=2, days=2):
+        ids = []
+        for i in range(count):
+            appointment = Appointment.objects.create(
+                patient=self.patient, doctor=self.doctor, duration=10,
+                date_time=next_day_at(8, days=days) + timedelta(minutes=10 * i),
+            )
+            appointment.services.set(self.services[:services])
+            ids.append(appointment.pk)
+        Appointment.objects.filter(pk__in=ids).update(status='completed')
+        return ids
+
+    def test_invoices_with_discount_and_rollups(self):
+        ids = self._completed(3)
+        self._completed(1, services=0)
+        result = close_day(self.day, user=self.admin)
+        self.assertEqual((result['invoices'], result['lines'], result['without_services']), (3, 6, 1))
+
+        invoice = Invoice.objects.get(appointment_id=ids[0])
+        self.assertEqual(invoice.total_amount, Decimal('1555.55'))
+        self.assertEqual(invoice.items_count, 2)
+        self.assertEqual(invoice.discount_applied, 10)
+        self.assertEqual(invoice.final_amount, Decimal('1400.00'))
+        self.assertEqual(invoice.created_by, self.admin)
+        self.assertEqual(result['final_amount'], Decimal('4200.00'))
+        revenue = dict(ServiceDayStats.objects.values_list('service_id', 'revenue'))
+        self.assertEqual(revenue, {self.services[0].pk: Decimal('3000.00'), self.services[1].pk: Decimal('1666.65')})
+
+    def test_rerun_is_idempotent(self):
+        self._completed(2)
+        close_day(self.day)
+        self._completed(1, days=3)  # другой день не затрагивается
+        result = close_day(self.day)
+        self.assertEqual((result['invoices'], result['lines']), (0, 0))
+        self.assertEqual(Invoice.objects.count(), 2)
+        self.assertEqual(InvoiceService.objects.count(), 4)
+
+    def test_query_count_does_not_grow_with_day(self):
+        self._completed(2, days=2)
+        self._completed(40, days=3)
+        with CaptureQueriesContext(connection) as small:
+            close_day(self.day)
+        with CaptureQueriesContext(connection) as large:
+            close_day(self.day + timedelta(days=1))
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(Invoice.objects.count(), 42)
+
+    def test_api_requires_admin(self):
+        self._completed(1)
+        self.client.force_login(self.doctor.user)
+        response = self.client.post('/api/billing/close-day/', {'date': self.day.isoformat()}, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_login(self.admin)
+        response = self.client.post('/api/billing/close-day/', {'date': self.day.isoformat()}, content_type='application/json')
+        self.assertEqual(response.json()['invoices'], 1)
+        self.assertEqual(response.json()['final_amount'], 1400.0)
+
+
+class InvoiceTotalsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        doctor = Doctor.objects.create(user=User.objects.create(username='doc'), specialty='Терапевт')
+        patient = Patient.objects.create(
+            first_name='Пётр', last_name='Пациент', birth_date=date(1990, 1, 1), phone='+79990000000'
+        )
+        cls.appointment = Appointment.objects.create(patient=patient, doctor=doctor, duration=30, date_time=next_day_at(9))
+        cls.services = [
+            Service.objects.create(name='Осмотр', price=Decimal('1000.00')),
+            Service.objects.create(name='Снимок', price=Decimal('555.55')),
+        ]
+
+    def _totals(self, invoice):
+        invoice.refresh_from_db()
+        return invoice.total_amount, invoice.items_count, invoice.final_amount
+
+    def test_lines_update_totals_incrementally(self):
+        invoice = Invoice.objects.create(appointment=self.appointment, discount_applied=10)
+        first = InvoiceService.objects.create(invoice=invoice, service=self.services[0], price_at_time=Decimal('1000.00'))
+        second = InvoiceService.objects.create(invoice=invoice, service=self.services[1], quantity=2, price_at_time=0)
+        self.assertEqual(self._totals(invoice), (Decimal('2111.10'), 2, Decimal('1899.99')))
+
+        first.quantity = 3
+        first.save()
+        self.assertEqual(self._totals(invoice), (Decimal('4111.10'), 2, Decimal('3699.99')))
+
+        second.delete()
+        self.assertEqual(self._totals(invoice), (Decimal('3000.00'), 1, Decimal('2700.00')))
+
+        # Скидка меняется на счёте — итог пересчитывает Invoice.save() от хранимой суммы
+        invoice.discount_applied = 0
+        invoice.save()
+        self.assertEqual(self._totals(invoice), (Decimal('3000.00'), 1, Decimal('3000.00')))
+
+    def test_stale_instance_save_keeps_totals(self):
+        invoice = Invoice.objects.create(appointment=self.appointment, discount_applied=10)
+        stale = Invoice.objects.get(pk=invoice.pk)
+        InvoiceService.objects.create(invoice=invoice, service=self.services[0], price_at_time=Decimal('1000.00'))
+
+        stale.is_paid = True
+        stale.save()
+        self.assertEqual(self._totals(invoice), (Decimal('1000.00'), 1, Decimal('900.00')))
+        self.assertTrue(invoice.is_paid)
+
+        stale.discount_applied = 50
+        stale.save(update_fields=['discount_applied'])
+        self.assertEqual(self._totals(invoice), (Decimal('1000.00'), 1, Decimal('500.00')))
+
+    def test_verify_repairs_drift(self):
+        invoice = Invoice.objects.create(appointment=self.appointment)
+        InvoiceService.objects.create(invoice=invoice, service=self.services[0], price_at_time=Decimal('1000.00'))
+        InvoiceService.objects.filter(invoice=invoice).update(quantity=2)  # в обход сигналов
+
+        checked, drift = verify_invoice_totals(repair=False)
+        self.assertEqual((checked, list(drift)), (1, [invoice.pk]))
+        self.assertEqual(self._totals(invoice), (Decimal('1000.00'), 1, Decimal('1000.00')))
+
+        verify_invoice_totals(chunk_size=1)
+        self.assertEqual(self._totals(invoice), (Decimal('2000.00'), 1, Decimal('2000.00')))
+        self.assertEqual(verify_invoice_totals()[1], {})
+
+
+class ChunkedUploadTests(TestCase):
+    CONTENT = os.urandom(300_000)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        settings = override_settings(MEDIA_ROOT=media, UPLOAD_PARTS_DIR=os.path.join(media, 'uploads'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.client.force_login(self.admin)
+
+    def _start(self, content=CONTENT):
+        response = self.client.post('/api/uploads/', {'filename': 'снимок.zip', 'size': len(content)},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        return response.json()['id']
+
+    def _put(self, upload_id, start, end, content=CONTENT):
+        return self.client.put(
+            f'/api/uploads/{upload_id}/', content[start:end], content_type='application/octet-stream',
+            headers={'Content-Range': f'bytes {start}-{end - 1}/{len(content)}'},
+        )
+
+    def _upload(self, content=CONTENT):
+        upload_id = self._start(content)
+        self._put(upload_id, 0, len(content), content)
+        # Файл переносится в хранилище после фиксации транзакции
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post(f'/api/uploads/{upload_id}/complete/').status_code, 200)
+        return upload_id
+
+    def _document(self, **data):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/documents/create/', {'title': 'Согласие', **data})
+        self.assertEqual(response.status_code, 200, response.content)
+        return Document.objects.get(pk=response.json()['id'])
+
+    def test_resume_after_interrupted_chunk(self):
+        upload_id = self._start()
+        self.assertEqual(self._put(upload_id, 0, 100_000).json()['offset'], 100_000)
+
+        skipped = self._put(upload_id, 200_000, 300_000)
+        self.assertEqual((skipped.status_code, skipped.json()['offset']), (409, 100_000))
+        offset = self.client.get(f'/api/uploads/{upload_id}/').json()['offset']
+        self.assertEqual(self._put(upload_id, offset, len(self.CONTENT)).json()['offset'], len(self.CONTENT))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                f'/api/uploads/{upload_id}/complete/', {'sha256': hashlib.sha256(self.CONTENT).hexdigest()},
+                content_type='application/json',
+            )
+        self.assertEqual(response.json()['deduplicated'], False)
+        document = self._document(upload=upload_id)
+        self.assertEqual(document.filename, 'снимок.zip')
+        with document.file.open('rb') as f:
+            self.assertEqual(f.read(), self.CONTENT)
+
+    def test_checksum_mismatch_restarts_upload(self):
+        upload_id = self._start()
+        self._put(upload_id, 0, len(self.CONTENT))
+        response = self.client.post(
+            f'/api/uploads/{upload_id}/complete/', {'sha256': '0' * 64}, content_type='application/json',
+        )
+        self.assertEqual((response.status_code, response.json()['offset']), (422, 0))
+        self.assertFalse(Blob.objects.exists())
+
+    def test_identical_files_share_blob(self):
+        first = self._document(upload=self._upload())
+        second = self._document(file=SimpleUploadedFile('copy.zip', self.CONTENT))
+        blob = Blob.objects.get()
+        self.assertEqual((first.blob_id, second.blob_id, blob.ref_count), (blob.pk, blob.pk, 2))
+        path = first.file.path
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+        self.assertTrue(os.path.exists(path))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(os.path.exists(path))
+
+    def _stored_files(self):
+        return [name for _, _, names in os.walk(os.path.join(settings.MEDIA_ROOT, 'blobs')) for name in names]
+
+    def test_store_during_pending_release_keeps_file(self):
+        document = self._document(upload=self._upload())
+        path = document.file.path
+        # Последняя ссылка снята, удаление файла ждёт фиксации...
+        with self.captureOnCommitCallbacks() as pending:
+            document.delete()
+        # ...а тем временем сохраняется то же содержимое
+        copy = self._document(file=SimpleUploadedFile('copy.zip', self.CONTENT))
+        for callback in pending:
+            callback()
+
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+        with copy.file.open('rb') as f:
+            self.assertEqual(f.read(), self.CONTENT)
+        self.assertEqual(copy.file.path, path)
+        self.assertEqual(os.listdir(settings.UPLOAD_PARTS_DIR), [])
+
+    def test_rollback_leaves_no_stored_file(self):
+        upload_id = self._start()
+        self._put(upload_id, 0, len(self.CONTENT))
+        with self.assertRaises(ZeroDivisionError), self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                complete_upload(upload_id)
+                attach_file(Document(title='Откат'), SimpleUploadedFile('copy.zip', self.CONTENT))
+                1 / 0
+        self.assertEqual(self._stored_files(), [])
+        self.assertFalse(Blob.objects.exists())
+
+        # Часть загрузки на месте — завершение повторяется; часть формы дочищает expire_uploads
+        with self.captureOnCommitCallbacks(execute=True):
+            upload, created = complete_upload(upload_id)
+        self.assertTrue(created)
+        self.assertEqual(len(self._stored_files()), 1)
+        [form_part] = [entry.path for entry in os.scandir(settings.UPLOAD_PARTS_DIR)]
+        os.utime(form_part, (0, 0))
+        expire_uploads(1)
+        self.assertEqual(os.listdir(settings.UPLOAD_PARTS_DIR), [])
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+
+
+class SerializerTests(TestCase):
+    DATA = {
+        'price': Decimal('1250.50'),
+        'at': timezone.make_aware(datetime(2026, 3, 1, 9, 30)),
+        'day': date(2026, 3, 1),
+        'name': 'Иванов',
+    }
+    EXPECTED = {'price': 1250.5, 'at': '2026-03-01T09:30:00+03:00', 'day': '2026-03-01', 'name': 'Иванов'}
+
+    def _encoders(self):
+        encoders = [serializers.stdlib_dumps]
+        if serializers.orjson is not None:
+            encoders.append(serializers.orjson_dumps)
+        return encoders
+
+    def test_encoders_format_decimal_and_dates_alike(self):
+        for encoder in self._encoders():
+            self.assertEqual(json.loads(encoder(self.DATA)), self.EXPECTED, encoder.__name__)
+        # Кириллица не экранируется
+        self.assertIn('Иванов'.encode(), serializers.stdlib_dumps(self.DATA))
+
+    def test_falls_back_to_stdlib_without_orjson(self):
+        with mock.patch.object(serializers, 'orjson', None), override_settings(API_JSON_ENCODER=None):
+            self.assertEqual(json.loads(serializers.dumps(self.DATA)), self.EXPECTED)
+            self.assertIs(serializers._dumps, serializers.stdlib_dumps)
+
+    def test_encoder_setting_change_applies(self):
+        serializers.dumps([])
+        with override_settings(API_JSON_ENCODER='app.tests.marker_dumps'):
+            self.assertEqual(serializers.dumps([]), b'"marker"')
+        self.assertEqual(serializers.dumps([]), b'[]')
+
+    def test_serializer_formats_columns_in_clinic_timezone(self):
+        serializer = serializers.Serializer({
+            'id': 'id',
+            'name': serializers.Field('last_name', 'first_name', 'middle_name', format=serializers.full_name),
+            'price': serializers.Field('price', format=serializers.as_float),
+            'at': serializers.Field('at', format=serializers.LocalTime('%d.%m %H:%M')),
+        })
+        rows = [
+            {'id': 1, 'last_name': 'Иванов', 'first_name': 'Иван', 'middle_name': None,
+             'price': Decimal('10.10'), 'at': datetime(2026, 3, 1, 6, 30, tzinfo=dt_timezone.utc)},
+            {'id': 2, 'last_name': 'Петров', 'first_name': 'Пётр', 'middle_name': 'Ильич', 'price': None, 'at': None},
+        ]
+
+        self.assertEqual(serializer.columns, ('id', 'last_name', 'first_name', 'middle_name', 'price', 'at'))
+        self.assertEqual(serializer.many(rows), [
+            {'id': 1, 'name': 'Иванов Иван', 'price': 10.1, 'at': '01.03 09:30'},
+            {'id': 2, 'name': 'Петров Пётр Ильич', 'price': None, 'at': None},
+        ])
+
+
+class DocumentDownloadTests(TestCase):
+    CONTENT = bytes(range(256)) * 40
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='chief', role='admin')
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        settings = override_settings(MEDIA_ROOT=media, UPLOAD_PARTS_DIR=os.path.join(media, 'uploads'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.document = Document(title='Снимок')
+        with self.captureOnCommitCallbacks(execute=True):
+            attach_file(self.document, SimpleUploadedFile('scan.pdf', self.CONTENT))
+        self.url = f'/documents/{self.document.pk}/download/'
+        self.client.force_login(self.admin)
+
+    def _get(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_full_and_conditional(self):
+        response, body = self._get()
+        self.assertEqual((response.status_code, body), (200, self.CONTENT))
+        self.assertEqual(response['ETag'], f'"{hashlib.sha256(self.CONTENT).hexdigest()}"')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        response, body = self._get(If_None_Match=response['ETag'])
+        self.assertEqual((response.status_code, body), (304, b''))
+        response, _ = self._get(If_Modified_Since=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_ranges(self):
+        response, body = self._get(Range='bytes=10-19')
+        self.assertEqual((response.status_code, body), (206, self.CONTENT[10:20]))
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.CONTENT)}')
+        self.assertEqual(response['Content-Length'], '10')
+
+        self.assertEqual(self._get(Range='bytes=10000-')[1], self.CONTENT[10000:])
+        self.assertEqual(self._get(Range='bytes=-5')[1], self.CONTENT[-5:])
+        self.assertEqual(self._get(Range=f'bytes={len(self.CONTENT)}-')[0].status_code, 416)
+        # Другая версия файла у клиента — диапазон игнорируется
+        response, body = self._get(Range='bytes=10-19', If_Range='"stale"')
+        self.assertEqual((response.status_code, body), (200, self.CONTENT))
+
+    def test_accel_mode_and_permissions(self):
+        with self.settings(DOCUMENT_DOWNLOAD_MODE='x-accel'):
+            response, body = self._get()
+        self.assertEqual(body, b'')
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.document.file.name}')
+
+        self.client.force_login(User.objects.create(username='nurse', role='nurse'))
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_media_url_skips_document_files(self):
+        media = settings.MEDIA_ROOT
+        os.makedirs(os.path.join(media, 'photos'))
+        with open(os.path.join(media, 'photos', 'logo.txt'), 'w') as f:
+            f.write('logo')
+        request = RequestFactory().get('/media/')
+
+        response = public_media(request, 'photos/logo.txt', document_root=media)
+        self.assertEqual(b''.join(response.streaming_content), b'logo')
+        for path in (self.document.file.name, f'photos/../{self.document.file.name}', 'uploads/', 'documents/x.pdf'):
+            with self.assertRaises(Http404, msg=path):
+                public_media(request, path, document_root=media)
@@ -0,0 +1,271 @@
+"""
+Смена статуса записи по машине состояний Appointment.STATUS_TRANSITIONS.
+
+Переход — один условный UPDATE: он меняет строку, только если её текущий
+статус равен ожидаемому, а правила нового статуса (свободное время при
+возврате в расписание) выполняются в той же команде. Где СУБД умеет
+UPDATE ... RETURNING (PostgreSQL, SQLite 3.35+), поля для сводок статистики
+приходят тем же запросом. Проверяются только правила перехода: дата, врач
+и длительность не менялись и повторно не валидируются.
+
+bulk_change_status() переводит пачку записей: проверка всей пачки по
+множеству строк (переходы, пересечения), один UPDATE и дельты сводок
+пачкой — число запросов не зависит от размера пачки.
+"""
+from bisect import bisect_left
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, CharField, F, Q, TextField, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import rollups
+from .database import APPOINTMENT_OVERLAP_CONSTRAINT
+from .models import Appointment
+
+RETURNING_FIELDS = ('date_time', 'doctor_id', 'patient_id', 'duration')
+
+
+class TransitionError(ValueError):
+    """Переход невозможен; status — HTTP-код для API"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class BulkTransitionError(TransitionError):
+    """Пачка отклонена целиком; errors — {id записи: причина}"""
+
+    def __init__(self, errors):
+        super().__init__(f'Переход невозможен для {len(errors)} записей', status=409)
+        self.errors = errors
+
+
+def _label(status):
+    return dict(Appointment.STATUS_CHOICES).get(status, status)
+
+
+def check_transition(old, new):
+    if new not in dict(Appointment.STATUS_CHOICES):
+        raise TransitionError('Недопустимый статус')
+    if new not in Appointment.STATUS_TRANSITIONS.get(old, ()):
+        raise TransitionError(f'Нельзя перевести запись из «{_label(old)}» в «{_label(new)}»')
+
+
+def cancel_fields(cancel_reason_type=None, cancel_reason=''):
+    """Поля отмены по правилам Appointment.clean()/save()"""
+    if cancel_reason_type and cancel_reason_type not in Appointment.CANCEL_REASON_TEXT:
+        raise TransitionError('Неизвестный тип причины отмены')
+    if not cancel_reason_type and not cancel_reason:
+        raise TransitionError('Укажите причину отмены')
+    return {
+        'cancel_reason_type': cancel_reason_type or None,
+        'cancel_reason': cancel_reason or Appointment.CANCEL_REASON_TEXT[cancel_reason_type],
+    }
+
+
+def _supports_returning():
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 35)
+    return False
+
+
+def _update(pk, old, new, fields):
+    """Условный UPDATE; строка RETURNING_FIELDS или None, если условие не выполнено"""
+    qn = connection.ops.quote_name
+    table = qn(Appointment._meta.db_table)
+    assignments = ', '.join(f'{qn(column)} = %s' for column in fields)
+    sql = f'UPDATE {table} SET {assignments} WHERE {qn("id")} = %s AND {qn("status")} = %s'
+    params = [
+        Appointment._meta.get_field(column).get_db_prep_save(value, connection) for column, value in fields.items()
+    ] + [pk, old]
+
+    if new == 'scheduled':
+        # Возврат в расписание: время у врача должно быть свободно (как Appointment.find_overlapping)
+        sql += (
+            f' AND NOT EXISTS (SELECT 1 FROM {table} other'
+            f' WHERE other.{qn("doctor_id")} = {table}.{qn("doctor_id")}'
+            f' AND other.{qn("status")} = %s AND other.{qn("id")} <> {table}.{qn("id")}'
+            f' AND other.{qn("date_time")} < {table}.{qn("end_time")}'
+            f' AND other.{qn("end_time")} > {table}.{qn("date_time")})'
+        )
+        params.append('scheduled')
+
+    with connection.cursor() as cursor:
+        if _supports_returning():
+            cursor.execute(sql + ' RETURNING ' + ', '.join(qn(column) for column in RETURNING_FIELDS), params)
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            if connection.vendor == 'sqlite':
+                # Сырой курсор SQLite отдаёт дату без пояса (или строкой) — приводим как ORM
+                row = (connection.ops.convert_datetimefield_value(row[0], None, connection), *row[1:])
+            return dict(zip(RETURNING_FIELDS, row))
+        cursor.execute(sql, params)
+        if not cursor.rowcount:
+            return None
+    return Appointment.objects.filter(pk=pk).values(*RETURNING_FIELDS).get()
+
+
+def change_status(pk, status, expected=None, cancel_reason_type=None, cancel_reason=''):
+    """
+    Переводит запись pk в status. expected — статус, который видел клиент
+    (перетаскивание на дашборде): с ним переход занимает один запрос.
+    Возвращает {'id', 'status', 'previous'}; TransitionError, если переход невозможен.
+    """
+    if expected is None:
+        expected = Appointment.objects.filter(pk=pk).values_list('status', flat=True).first()
+        if expected is None:
+            raise TransitionError('Запись не найдена', status=404)
+    check_transition(expected, status)
+
+    fields = {'status': status, 'updated_at': timezone.now()}
+    if status == 'cancelled':
+        fields.update(cancel_fields(cancel_reason_type, cancel_reason))
+
+    with transaction.atomic():
+        if status == 'scheduled':
+            # Ограничение на пересечения может сработать при гонке — savepoint сохраняет транзакцию
+            try:
+                with transaction.atomic():
+                    row = _update(pk, expected, status, fields)
+            except IntegrityError as e:
+                if APPOINTMENT_OVERLAP_CONSTRAINT not in str(e):
+                    raise
+                row = None
+        else:
+            row = _update(pk, expected, status, fields)
+        if row is None:
+            _explain_failure(pk, expected, status)
+
+        state = {**rollups.appointment_state_of_row(row), 'status': expected}
+        rollups.appointment_changed(pk, state, {**state, 'status': status})
+    return {'id': pk, 'status': status, 'previous': expected}
+
+
+def _explain_failure(pk, expected, status):
+    """Почему UPDATE не изменил строку: записи нет, статус уже другой или время занято"""
+    appointment = Appointment.objects.filter(pk=pk).select_related('doctor__user').first()
+    if appointment is None:
+        raise TransitionError('Запись не найдена', status=404)
+    if appointment.status != expected:
+        raise TransitionError(
+            f'Статус записи уже изменён: «{_label(appointment.status)}»', status=409
+        )
+    raise TransitionError(appointment._check_time_overlap() or '⏰ ВРЕМЯ ЗАНЯТО!', status=409)
+
+
+# ---------- Пачка записей ----------
+BULK_FIELDS = ('id', 'status', 'date_time', 'end_time', 'doctor_id', 'duration')
+
+
+def _cancel_expressions(cancel_reason_type=None, cancel_reason=''):
+    """
+    Поля отмены для UPDATE пачки. Без типа и комментария тип остаётся прежним
+    (или 'other'), пустой комментарий заполняется текстом типа — прямо в SQL.
+    """
+    if cancel_reason_type and cancel_reason_type not in Appointment.CANCEL_REASON_TEXT:
+        raise TransitionError('Неизвестный тип причины отмены')
+    reason_type = (
+        Value(cancel_reason_type) if cancel_reason_type
+        else Coalesce(F('cancel_reason_type'), Value('other'), output_field=CharField())
+    )
+    if cancel_reason:
+        reason = Value(cancel_reason)
+    elif cancel_reason_type:
+        reason = Case(
+            When(cancel_reason='', then=Value(Appointment.CANCEL_REASON_TEXT[cancel_reason_type])),
+            default=F('cancel_reason'),
+            output_field=TextField(),
+        )
+    else:
+        reason = Case(
+            *[
+                When(cancel_reason='', cancel_reason_type=key, then=Value(text))
+                for key, text in Appointment.CANCEL_REASON_TEXT.items()
+            ],
+            When(cancel_reason='', then=Value(Appointment.CANCEL_REASON_TEXT['other'])),
+            default=F('cancel_reason'),
+            output_field=TextField(),
+        )
+    return {'cancel_reason_type': reason_type, 'cancel_reason': reason}
+
+
+def _overlap_errors(rows):
+    """
+    Пересечения записей, возвращаемых в расписание: один запрос занятых интервалов
+    врачей пачки, затем проход по отсортированным интервалам (как при импорте).
+    """
+    errors = {}
+    ids = [row['id'] for row in rows]
+    busy = {row['doctor_id']: ([], []) for row in rows}  # врач -> (начала, окончания) по возрастанию
+    existing = Appointment.objects.filter(
+        status='scheduled', doctor_id__in=busy,
+        date_time__lt=max(row['end_time'] for row in rows), end_time__gt=min(row['date_time'] for row in rows),
+    ).exclude(pk__in=ids).order_by('doctor_id', 'date_time').values_list('doctor_id', 'date_time', 'end_time')
+    for doctor_id, start, end in existing:
+        busy[doctor_id][0].append(start)
+        busy[doctor_id][1].append(end)
+
+    last = {}  # врач -> (окончание, id) последней принятой записи пачки
+    for row in sorted(rows, key=lambda r: (r['doctor_id'], r['date_time'])):
+        starts, ends = busy[row['doctor_id']]
+        index = bisect_left(starts, row['end_time']) - 1
+        if index >= 0 and ends[index] > row['date_time']:
+            errors[row['id']] = f'Время занято: запись с {timezone.localtime(starts[index]):%d.%m.%Y %H:%M}'
+            continue
+        previous = last.get(row['doctor_id'])
+        if previous and previous[0] > row['date_time']:
+            errors[row['id']] = f'Пересекается с записью #{previous[1]} из этой же пачки'
+            continue
+        last[row['doctor_id']] = (row['end_time'], row['id'])
+    return errors
+
+
+def bulk_change_status(ids, status, cancel_reason_type=None, cancel_reason='', skip_invalid=False):
+    """
+    Переводит записи ids в status одной транзакцией.
+    Недопустимые записи отклоняют всю пачку (BulkTransitionError), а при
+    skip_invalid=True пропускаются. Возвращает {'updated': [...], 'unchanged': [...], 'errors': {...}}.
+    """
+    if status not in dict(Appointment.STATUS_CHOICES):
+        raise TransitionError('Недопустимый статус')
+    ids = {int(pk) for pk in ids}
+    fields = {'status': status, 'updated_at': timezone.now()}
+    if status == 'cancelled':
+        fields.update(_cancel_expressions(cancel_reason_type, cancel_reason))
+
+    with transaction.atomic():
+        rows = list(Appointment.objects.filter(pk__in=ids).select_for_update().values(*BULK_FIELDS))
+        errors = {pk: 'Запись не найдена' for pk in ids - {row['id'] for row in rows}}
+        unchanged, moving = [], []
+        for row in rows:
+            if row['status'] == status:
+                unchanged.append(row['id'])
+            elif status not in Appointment.STATUS_TRANSITIONS.get(row['status'], ()):
+                errors[row['id']] = f'Нельзя перевести запись из «{_label(row["status"])}» в «{_label(status)}»'
+            else:
+                moving.append(row)
+        if status == 'scheduled' and moving:
+            errors.update(_overlap_errors(moving))
+            moving = [row for row in moving if row['id'] not in errors]
+        if errors and not skip_invalid:
+            raise BulkTransitionError(errors)
+
+        if moving:
+            # Строки заблокированы выше: условие на прежние статусы — страховка, а не гонка
+            try:
+                Appointment.objects.filter(
+                    Q(pk__in=[row['id'] for row in moving]), ~Q(status=status)
+                ).update(**fields)
+            except IntegrityError as e:
+                # Параллельная запись заняла время между проверкой и UPDATE
+                if APPOINTMENT_OVERLAP_CONSTRAINT not in str(e):
+                    raise
+                raise TransitionError('⏰ ВРЕМЯ ЗАНЯТО!', status=409)
+            rollups.statuses_changed(moving, status)
+    return {'updated': sorted(row['id'] for row in moving), 'unchanged': sorted(unchanged), 'errors': errors}
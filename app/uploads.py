@@ -0,0 +1,359 @@
+"""
+Загрузка документов частями и хранилище файлов по хэшу содержимого.
+
+Протокол (только администраторы):
+  POST /api/uploads/                {"filename", "size"} -> {"id", "offset", "chunk_size", ...}
+  PUT  /api/uploads/<id>/           тело — байты части, Content-Range: bytes начало-конец/размер
+  GET  /api/uploads/<id>/           сколько получено — с этого смещения загрузка продолжается
+  POST /api/uploads/<id>/complete/  {"sha256": необязательно} -> файл сохранён в хранилище
+Готовая загрузка прикрепляется к документу полем upload в api_document_create/update.
+
+Часть принимается, только если начинается ровно с полученного смещения: сервер
+занимает интервал условным UPDATE (pending), потоково пишет тело запроса в файл
+части буферами UPLOAD_BUFFER_BYTES, попутно обновляя SHA-256, и только после
+записи сдвигает received. Тело не попадает ни в память целиком, ни во временные
+файлы Django; hashlib отпускает GIL на больших буферах. Состояние хэша живёт в
+памяти процесса; если часть принял другой процесс, недостающее дочитывается с
+диска при завершении.
+
+Готовый файл переносится в blobs/ по хэшу переименованием, без копирования,
+после фиксации транзакции: при откате часть остаётся на месте и завершение
+можно повторить. Если такой Blob уже есть, часть удаляется и у Blob растёт
+счётчик ссылок. Ссылку держит завершённая загрузка, затем её забирает документ;
+при нуле ссылок файл и Blob удаляются после фиксации под блокировкой строки
+Blob — той же, под которой _store добавляет ссылку, поэтому параллельное
+сохранение того же содержимого не теряет файл.
+"""
+import hashlib
+import os
+import re
+import threading
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Blob, Upload
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+# Через сколько часть, запись которой не закончилась (процесс упал), можно прислать заново
+STALE_CHUNK = timedelta(minutes=10)
+
+
+class UploadError(ValueError):
+    """Загрузка невозможна; status — HTTP-код для API, offset — сколько байт уже получено"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def _part_path(upload_id):
+    return os.path.join(settings.UPLOAD_PARTS_DIR, f'{upload_id}.part')
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def describe(upload):
+    return {
+        'id': str(upload.pk),
+        'filename': upload.filename,
+        'size': upload.size,
+        'offset': upload.received,
+        'complete': upload.blob_id is not None,
+        'chunk_size': settings.UPLOAD_CHUNK_MAX_BYTES,
+    }
+
+
+# ---------- SHA-256 по мере получения частей ----------
+_hashes = {}  # id загрузки -> (смещение, объект hashlib), досчитанный до смещения
+_hashes_lock = threading.Lock()
+
+
+def _take_hash(upload_id, offset):
+    """Хэш, досчитанный ровно до offset, или None — тогда часть дохэшируется с диска"""
+    with _hashes_lock:
+        state = _hashes.get(upload_id)
+        if state and state[0] == offset:
+            del _hashes[upload_id]
+            return state[1]
+    return hashlib.sha256() if offset == 0 else None
+
+
+def _put_hash(upload_id, offset, hasher):
+    with _hashes_lock:
+        _hashes[upload_id] = (offset, hasher)
+
+
+def _digest(upload_id, path, size):
+    """SHA-256 файла части: с сохранённого состояния, остаток — чтением с диска"""
+    with _hashes_lock:
+        state = _hashes.pop(upload_id, None)
+    offset, hasher = state if state and state[0] <= size else (0, hashlib.sha256())
+    buffer = bytearray(settings.UPLOAD_BUFFER_BYTES)
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while offset < size:
+            read = f.readinto(view[:min(len(buffer), size - offset)])
+            if not read:
+                raise UploadError('Файл части короче заявленного размера', status=409, offset=offset)
+            hasher.update(view[:read])
+            offset += read
+    return hasher.hexdigest()
+
+
+# ---------- Загрузка частями ----------
+def start_upload(filename, size, user=None):
+    filename = os.path.basename(str(filename or '')).strip()[:255]
+    if not filename:
+        raise UploadError('Укажите имя файла')
+    if not isinstance(size, int) or size < 0:
+        raise UploadError('Укажите размер файла в байтах')
+    if size > settings.UPLOAD_MAX_BYTES:
+        raise UploadError(f'Файл больше {settings.UPLOAD_MAX_BYTES} байт')
+    upload = Upload.objects.create(filename=filename, size=size, created_by=user)
+    os.makedirs(settings.UPLOAD_PARTS_DIR, exist_ok=True)
+    open(_part_path(upload.pk), 'wb').close()
+    return upload
+
+
+def get_upload(upload_id):
+    upload = Upload.objects.filter(pk=upload_id).first()
+    if upload is None:
+        raise UploadError('Загрузка не найдена', status=404)
+    return upload
+
+
+def _write(path, offset, stream, length, hasher):
+    """Потоковая запись length байт из stream с позиции offset"""
+    buffer_size = settings.UPLOAD_BUFFER_BYTES
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        remaining = length
+        while remaining:
+            data = stream.read(min(buffer_size, remaining))
+            if not data:
+                raise UploadError('Часть получена не полностью', offset=offset)
+            f.write(data)
+            if hasher is not None:
+                hasher.update(data)
+            remaining -= len(data)
+
+
+def write_chunk(upload_id, stream, content_range, content_length):
+    """Принимает часть из потока stream; возвращает новое смещение"""
+    match = CONTENT_RANGE.match(content_range or '')
+    if not match:
+        raise UploadError('Нужен заголовок Content-Range: bytes начало-конец/размер')
+    start, end = int(match[1]), int(match[2]) + 1
+    if not 0 < end - start <= settings.UPLOAD_CHUNK_MAX_BYTES:
+        raise UploadError(f'Часть должна быть от 1 до {settings.UPLOAD_CHUNK_MAX_BYTES} байт')
+    if content_length != end - start:
+        raise UploadError('Длина тела не совпадает с Content-Range')
+
+    upload = get_upload(upload_id)
+    if end > upload.size or (match[3] != '*' and int(match[3]) != upload.size):
+        raise UploadError('Часть выходит за размер файла', offset=upload.received)
+    # Интервал занимается до записи: повторная или параллельная часть с того же смещения получит 409.
+    # Занятый интервал процесса, который оборвался при записи, освобождается через STALE_CHUNK
+    now = timezone.now()
+    claimed = Upload.objects.filter(
+        Q(pending__isnull=True) | Q(updated_at__lt=now - STALE_CHUNK),
+        pk=upload.pk, received=start, blob__isnull=True,
+    ).update(pending=end, updated_at=now)
+    if not claimed:
+        current = get_upload(upload.pk)
+        if current.blob_id:
+            raise UploadError('Загрузка уже завершена', status=409, offset=current.received)
+        if current.pending and current.received == start:
+            raise UploadError('Эта часть уже принимается', status=409, offset=current.received)
+        raise UploadError(
+            f'Ожидается часть со смещения {current.received}', status=409, offset=current.received
+        )
+
+    hasher = _take_hash(upload.pk, start)
+    try:
+        _write(_part_path(upload.pk), start, stream, end - start, hasher)
+    except BaseException:
+        # Обрыв: интервал освобождается, часть можно прислать снова
+        Upload.objects.filter(pk=upload.pk, pending=end).update(pending=None)
+        raise
+    if not Upload.objects.filter(pk=upload.pk, received=start, pending=end).update(
+        received=end, pending=None, updated_at=timezone.now()
+    ):
+        raise UploadError('Часть принята другим запросом', status=409, offset=get_upload(upload.pk).received)
+    if hasher is not None:
+        _put_hash(upload.pk, end, hasher)
+    return end
+
+
+def complete_upload(upload_id, sha256=None):
+    """Переносит полученный файл в хранилище; возвращает (загрузка, новый ли Blob)"""
+    upload = get_upload(upload_id)
+    if upload.blob_id:
+        return upload, False
+    if upload.received != upload.size:
+        raise UploadError(
+            f'Получено {upload.received} из {upload.size} байт', status=409, offset=upload.received
+        )
+    path = _part_path(upload.pk)
+    try:
+        digest = _digest(upload.pk, path, upload.size)
+    except FileNotFoundError:
+        # Часть уже перенёс в хранилище параллельный запрос завершения
+        upload = get_upload(upload.pk)
+        if upload.blob_id:
+            return upload, False
+        raise
+    if sha256 and sha256.lower() != digest:
+        Upload.objects.filter(pk=upload.pk).update(received=0)
+        raise UploadError('Контрольная сумма не совпадает — загрузите файл заново', status=422, offset=0)
+
+    with transaction.atomic():
+        # Завершение под блокировкой загрузки: параллельный запрос ждёт и видит готовый Blob
+        upload = Upload.objects.select_for_update().get(pk=upload.pk)
+        if upload.blob_id:
+            return upload, False
+        blob, created = _store(path, digest, upload.size)
+        Upload.objects.filter(pk=upload.pk).update(blob=blob)
+        upload.refresh_from_db()
+    return upload, created
+
+
+# ---------- Хранилище по хэшу ----------
+def _place(path, target):
+    """Переносит файл в хранилище, если его там ещё нет; иначе удаляет"""
+    if os.path.exists(target):
+        _remove(path)
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.replace(path, target)
+    except FileNotFoundError:
+        # Часть уже перенёс параллельный запрос
+        pass
+
+
+def _store(path, sha256, size):
+    """
+    Blob с содержимым файла path и ссылкой для вызывающего. Файл переносится
+    в хранилище (или удаляется как дубликат) после фиксации транзакции.
+    """
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(sha256=sha256).first()
+        created = blob is None
+        if created:
+            try:
+                with transaction.atomic():
+                    blob = Blob.objects.create(sha256=sha256, size=size, ref_count=1)
+            except IntegrityError:
+                # Тот же файл только что сохранила параллельная загрузка — содержимое совпадает
+                created = False
+        if not created:
+            # Blob с нулём ссылок, ещё не удалённый _purge, снова в деле: _purge его не тронет
+            Blob.objects.filter(sha256=sha256).update(ref_count=F('ref_count') + 1)
+            blob = Blob.objects.get(sha256=sha256)
+        target = default_storage.path(blob.name)
+        transaction.on_commit(lambda: _place(path, target))
+    return blob, created
+
+
+def store_file(uploaded):
+    """Blob для файла обычной multipart-формы (UploadedFile) со ссылкой для вызывающего"""
+    os.makedirs(settings.UPLOAD_PARTS_DIR, exist_ok=True)
+    path = _part_path(f'form-{uuid.uuid4()}')
+    hasher, size = hashlib.sha256(), 0
+    try:
+        with open(path, 'wb') as f:
+            for chunk in uploaded.chunks(settings.UPLOAD_BUFFER_BYTES):
+                f.write(chunk)
+                hasher.update(chunk)
+                size += len(chunk)
+        return _store(path, hasher.hexdigest(), size)[0]
+    except BaseException:
+        _remove(path)
+        raise
+
+
+def _purge(sha256):
+    """Удаляет файл и Blob без ссылок; под блокировкой строки, которую ждёт _store"""
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(sha256=sha256, ref_count=0).first()
+        if blob:
+            default_storage.delete(blob.name)
+            blob.delete()
+
+
+def release(blob_id):
+    """Снимает ссылку на Blob; после последней ссылки Blob и файл удаляются при фиксации"""
+    with transaction.atomic():
+        Blob.objects.filter(pk=blob_id, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+        sha256 = Blob.objects.filter(pk=blob_id, ref_count=0).values_list('sha256', flat=True).first()
+        if sha256:
+            transaction.on_commit(lambda: _purge(sha256))
+
+
+# ---------- Документы ----------
+def _attach(document, blob, filename):
+    previous = document.blob_id
+    document.blob = blob
+    document.file.name = blob.name
+    document.filename = filename
+    document.save()
+    if previous:
+        release(previous)
+
+
+def attach_upload(document, upload_id):
+    """Прикрепляет завершённую загрузку к документу и сохраняет его; ссылка на Blob переходит документу"""
+    with transaction.atomic():
+        upload = Upload.objects.filter(pk=upload_id, blob__isnull=False).select_related('blob').first()
+        if upload is None or not Upload.objects.filter(pk=upload.pk).delete()[0]:
+            raise UploadError('Загрузка не найдена или не завершена')
+        _attach(document, upload.blob, upload.filename)
+
+
+def attach_file(document, uploaded):
+    """То же для файла обычной multipart-формы"""
+    with transaction.atomic():
+        _attach(document, store_file(uploaded), os.path.basename(uploaded.name))
+
+
+def expire_uploads(hours=None):
+    """
+    Удаляет незавершённые и неприкреплённые загрузки старше hours часов; возвращает их число.
+    Заодно дочищает то, что оставили откаты и оборванные процессы: части форм и Blob без ссылок.
+    """
+    cutoff = timezone.now() - timedelta(hours=hours or settings.UPLOAD_EXPIRE_HOURS)
+    expired = 0
+    for pk, blob_id in Upload.objects.filter(updated_at__lt=cutoff).values_list('pk', 'blob_id'):
+        with transaction.atomic():
+            if not Upload.objects.filter(pk=pk, updated_at__lt=cutoff).delete()[0]:
+                continue
+            if blob_id:
+                release(blob_id)
+            else:
+                path = _part_path(pk)
+                transaction.on_commit(lambda path=path: _remove(path))
+        with _hashes_lock:
+            _hashes.pop(pk, None)
+        expired += 1
+
+    for sha256 in Blob.objects.filter(ref_count=0).values_list('sha256', flat=True):
+        _purge(sha256)
+    if os.path.isdir(settings.UPLOAD_PARTS_DIR):
+        for entry in os.scandir(settings.UPLOAD_PARTS_DIR):
+            if entry.name.startswith('form-') and entry.stat().st_mtime < cutoff.timestamp():
+                _remove(entry.path)
+    return expired
@@ -30,12 +30,20 @@ urlpatterns = [
     path('api/services/<int:pk>/update/', views.api_service_update, name='api_service_update'),
     path('api/services/<int:pk>/', views.api_service_detail, name='api_service_detail'),
     path('api/patients/search/', views.api_patients_search, name='api_patients_search'),
+    path('api/patients/search/stats/', views.api_patients_search_stats, name='api_patients_search_stats'),
+    path('api/patients/by-phone/', views.api_patients_by_phone, name='api_patients_by_phone'),
     path('api/patients/<int:pk>/update/', views.api_patient_update, name='api_patient_update'),
     path('api/schedule/', views.api_schedule_by_date_and_doctor, name='api_schedule_by_date_and_doctor'),
+    path('api/schedule/stream/', views.api_schedule_stream, name='api_schedule_stream'),
+    path('api/slots/free/', views.api_free_slots, name='api_free_slots'),
     path('api/patients/create/', views.api_patient_create, name='api_patient_create'),
     path('api/appointments/create/', views.api_appointment_create, name='api_appointment_create'),
     path('api/appointments/<int:pk>/update-status/', views.api_appointment_update_status,
          name='api_appointment_update_status'),
+    path('api/appointments/bulk-status/', views.api_appointments_bulk_status, name='api_appointments_bulk_status'),
+    path('api/billing/close-day/', views.api_close_day, name='api_close_day'),
+    # PERSONNEL
+    path('api/personnel/', views.api_personnel, name='api_personnel'),
     # DOCTOR
     path('api/personnel/doctors/', views.api_doctors_list, name='api_doctors_list'),
     path('api/personnel/doctors/create/', views.api_doctor_create, name='api_doctor_create'),
@@ -58,10 +66,17 @@ urlpatterns = [
     path('api/personnel/receptionists/<int:pk>/', views.api_receptionist_detail, name='api_receptionist_detail'),
 
     # DOCUMENTS
+    path('documents/<int:pk>/download/', views.document_download, name='document_download'),
     path('api/documents/create/', views.api_document_create, name='api_document_create'),
     path('api/documents/<int:pk>/update/', views.api_document_update, name='api_document_update'),
     path('api/documents/<int:pk>/delete/', views.api_document_delete, name='api_document_delete'),
+    path('api/uploads/', views.api_upload_start, name='api_upload_start'),
+    path('api/uploads/<uuid:pk>/', views.api_upload, name='api_upload'),
+    path('api/uploads/<uuid:pk>/complete/', views.api_upload_complete, name='api_upload_complete'),
 
     # STATISTICS
     path('api/stats/data/', views.api_stats_data, name='api_stats_data'),
+    path('api/stats/cube/', views.api_stats_cube, name='api_stats_cube'),
+    path('api/export/<str:dataset>/', views.api_export, name='api_export'),
+    path('api/import/<str:dataset>/', views.api_import, name='api_import'),
 ]
@@ -2,15 +2,40 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login, logout as auth_logout
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.core.handlers.asgi import ASGIRequest
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from .models import Patient, Service, Appointment, Doctor, Nurse, Receptionist, User, ClinicInfo, Document, \
-    InvoiceService
+    InvoiceService, AppointmentDayStats, PatientDayStats, ServiceDayStats
+from . import rollups
+from .billing import close_day
+from .booking import book_appointment
+from .counters import clinic_info
+from .cube import run_cube
+from .downloads import document_response
+from .export import DATASETS, CONTENT_TYPES as EXPORT_CONTENT_TYPES, FORMATS as EXPORT_FORMATS, stream_export
+from .pagination import CursorError, page_size, paginate
+from .serializers import SERVICE, json_response
+from .personnel import load_personnel, staff_detail, staff_list
+from .imports import IMPORTERS, FORMATS as IMPORT_FORMATS, run_import
+from .events import broker
+from .schedule import day_appointments, day_range, load_schedule
+from .search import find_by_phone, search_cache
+from .slots import find_free_slots, SLOT_MINUTES
+from .stats_cache import cached_stats
+from .transitions import BulkTransitionError, TransitionError, bulk_change_status, change_status
+from .uploads import (
+    UploadError, attach_file, attach_upload, complete_upload, describe, get_upload, start_upload, write_chunk,
+)
 from datetime import datetime, timedelta
 from django.db.models import Count, Sum, F
 from django.utils import timezone
+from django.conf import settings
+import io
 import json
+import asyncio
 from django.db.models.functions import TruncMonth
 
 
@@ -81,13 +106,8 @@ def admin_dashboard(request):
     if not is_admin(request.user):
         return redirect('access_denied')
 
-    today = date.today()
-    appointments = Appointment.objects.filter(date_time__date=today).select_related('patient', 'doctor', 'doctor__user')
-
-    scheduled = appointments.filter(status='scheduled')
-    waiting = appointments.filter(status='waiting')
-    active = appointments.filter(status='active')
-    completed = appointments.filter(status='completed')
+    today = timezone.localdate()
+    schedule = load_schedule(today)
 
     # Добавь это:
     current_year = today.year
@@ -99,10 +119,7 @@ def admin_dashboard(request):
     ]
 
     context = {
-        'scheduled': scheduled,
-        'waiting': waiting,
-        'active': active,
-        'completed': completed,
+        **schedule,
         'current_year': current_year,
         'current_month': current_month,
         'months': months,
@@ -114,8 +131,7 @@ def admin_dashboard(request):
 def about_view(request):
     if not is_admin(request.user):
         return redirect('access_denied')
-    clinic = ClinicInfo.objects.first()
-    return render(request, 'about.html', {'clinic': clinic})
+    return render(request, 'about.html', {'clinic': clinic_info()})
 
 
 @login_required
@@ -126,28 +142,57 @@ def doctor_dashboard(request):
         doctor_instance = Doctor.objects.get(user=request.user)
     except Doctor.DoesNotExist:
         return redirect('access_denied')
-    today = date.today()
-    appointments = Appointment.objects.filter(doctor=doctor_instance, date_time__date=today)
+    start, end = day_range(timezone.localdate())
+    appointments = Appointment.objects.filter(
+        doctor=doctor_instance, date_time__gte=start, date_time__lt=end
+    ).select_related('patient')
     context = {
         'appointments': appointments,
     }
     return render(request, 'doctor_dashboard.html', context)
 
 
+# ---------- Страницы списков (keyset-пагинация, см. pagination.py) ----------
+PATIENT_ORDERING = ('last_name', 'first_name', 'id')
+SERVICE_ORDERING = ('name', 'id')
+DOCUMENT_ORDERING = ('created_at', 'id')
+
+
+def _cursor_params(request):
+    """(курсор, размер страницы) из ?cursor=&limit="""
+    return request.GET.get('cursor') or None, page_size(request.GET.get('limit'))
+
+
+def _list_page(request, template, name, queryset, ordering, descending=False):
+    """HTML-список: одна страница строк и ссылка на следующую"""
+    try:
+        cursor, limit = _cursor_params(request)
+        items, next_cursor = paginate(queryset, ordering, cursor, limit, descending)
+    except CursorError:
+        # Битый или устаревший курсор — просто первая страница
+        cursor = None
+        items, next_cursor = paginate(queryset, ordering, descending=descending)
+    return render(request, template, {name: items, 'cursor': cursor, 'next_cursor': next_cursor})
+
+
+def _json_list(items, next_cursor):
+    """Список в прежнем формате (массив), курсор следующей страницы — в заголовке X-Next-Cursor"""
+    return json_response(items, headers={'X-Next-Cursor': next_cursor} if next_cursor else None)
+
+
 @login_required
 def patient_list(request):
     if not is_admin(request.user):
         return redirect('access_denied')
-    patients = Patient.objects.all()
-    return render(request, 'patient_list.html', {'patients': patients})
+    # Отдельного шаблона списка нет: та же картотека, что и patients_search
+    return _list_page(request, 'patients_search.html', 'patients', Patient.objects.all(), PATIENT_ORDERING)
 
 
 @login_required
 def service_list(request):
     if not is_admin(request.user):
         return redirect('access_denied')
-    services = Service.objects.all()
-    return render(request, 'service_list.html', {'services': services})
+    return _list_page(request, 'service_list.html', 'services', Service.objects.all(), SERVICE_ORDERING)
 
 
 @login_required
@@ -161,23 +206,8 @@ def services_management(request):
 def personnel_management(request):
     if not is_admin(request.user):
         return redirect('access_denied')
-    doctors = Doctor.objects.all()
-    nurses = Nurse.objects.all()
-    receptionists = Receptionist.objects.all()
-    users = User.objects.all()
-    return render(request, 'personnel_management.html', {
-        'doctors': doctors,
-        'nurses': nurses,
-        'receptionists': receptionists,
-        'users': users,
-    })
-
-
-@login_required
-def documents_view(request):
-    if not is_admin(request.user):
-        return redirect('access_denied')
-    return render(request, 'documents.html')
+    # Таблицы заполняет страница запросом к /api/personnel/
+    return render(request, 'personnel_management.html')
 
 
 @login_required
@@ -195,9 +225,12 @@ def doctors_list(request):
 def api_services_list(request):
     if not is_admin(request.user):
         return JsonResponse({'error': 'Доступ запрещён'}, status=403)
-    services = Service.objects.all()
-    data = [{'id': s.id, 'name': s.name, 'price': float(s.price), 'duration': s.duration} for s in services]
-    return JsonResponse(data, safe=False)
+    try:
+        cursor, limit = _cursor_params(request)
+        services, next_cursor = paginate(SERVICE.values(Service.objects.all()), SERVICE_ORDERING, cursor, limit)
+    except CursorError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return _json_list(SERVICE.many(services), next_cursor)
 
 
 @csrf_exempt
@@ -272,8 +305,7 @@ def api_service_delete(request, pk):
 def patients_search(request):
     if not is_admin(request.user):
         return redirect('access_denied')
-    patients = Patient.objects.all()
-    return render(request, 'patients_search.html', {'patients': patients})
+    return _list_page(request, 'patients_search.html', 'patients', Patient.objects.all(), PATIENT_ORDERING)
 
 
 from django.db.models import Q
@@ -285,17 +317,37 @@ def api_patients_search(request):
     if len(query) < 2:
         return JsonResponse([], safe=False)
 
-    q_lower = query.lower()
-    patients = []
+    # Индексированный поиск без учёта регистра (в т.ч. кириллицы), с ранжированием;
+    # следующие нажатия клавиш сужают закэшированный результат без запроса к БД
+    patients = search_cache.search(query, limit=10)
+
+    data = [{
+        'id': p.id,
+        'full_name': p.get_full_name(),
+        'phone': p.phone,
+        'birth_date': p.birth_date.isoformat()
+    } for p in patients]
+    return JsonResponse(data, safe=False)
+
+
+@login_required
+def api_patients_search_stats(request):
+    """Счётчики кэша поиска пациентов этого процесса"""
+    if not is_admin(request.user):
+        return JsonResponse({'error': 'Доступ запрещён'}, status=403)
+    return JsonResponse(search_cache.stats())
+
+
+@login_required
+def api_patients_by_phone(request):
+    """Пациенты по полному номеру или последним цифрам телефона (?phone=...)"""
+    phone = request.GET.get('phone', '').strip()
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 10)), 100))
+    except ValueError:
+        return JsonResponse({'error': 'Некорректный limit'}, status=400)
 
-    # Фильтрация в Python — для регистра
-    for p in Patient.objects.all():
-        if (q_lower in p.last_name.lower() or
-                q_lower in p.first_name.lower() or
-                q_lower in p.phone.lower()):
-            patients.append(p)
-            if len(patients) >= 10:
-                break
+    patients = find_by_phone(phone, limit=limit)
 
     data = [{
         'id': p.id,
@@ -363,51 +415,116 @@ def api_schedule_by_date_and_doctor(request):
     doctor_id = request.GET.get('doctor_id', None)
 
     try:
-        selected_date = datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else date.today()
+        selected_date = datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else timezone.localdate()
     except ValueError:
         return JsonResponse({'error': 'Неверный формат даты'}, status=400)
 
-    appointments = Appointment.objects.filter(date_time__date=selected_date)
+    if doctor_id and not Doctor.objects.filter(id=doctor_id).exists():
+        return JsonResponse({'error': 'Врач не найден'}, status=400)
 
-    if doctor_id:
+    # ✅ Один запрос, разложенный по статусам (отсортирован по времени)
+    data = load_schedule(selected_date, doctor_id)
+
+    return json_response(data)
+
+
+@login_required
+async def api_schedule_stream(request):
+    """Server-Sent Events: дельты расписания на день (создание записей и смена статуса)"""
+    user = await request.auser()
+    if not is_admin(user):
+        return JsonResponse({'error': 'Доступ запрещён'}, status=403)
+    # Потоковый ответ держит соединение открытым — только под ASGI (CLINIC.asgi)
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'error': 'Поток доступен только при запуске через ASGI'}, status=501)
+
+    date_str = request.GET.get('date', '')
+    doctor_id = request.GET.get('doctor_id')
+    try:
+        selected_date = datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else timezone.localdate()
+        doctor_id = int(doctor_id) if doctor_id else None
+    except ValueError:
+        return JsonResponse({'error': 'Неверные параметры'}, status=400)
+
+    # Записи, уже показанные клиентом: их перенос на другой день придёт ему как deleted
+    shown = [pk async for pk in day_appointments(selected_date, doctor_id).values_list('pk', flat=True)]
+    subscription = broker.subscribe(selected_date, doctor_id, shown)
+    heartbeat = settings.SCHEDULE_STREAM_HEARTBEAT_SECONDS
+
+    async def events():
         try:
-            doctor = Doctor.objects.get(id=doctor_id)
-            appointments = appointments.filter(doctor=doctor)
-        except Doctor.DoesNotExist:
-            return JsonResponse({'error': 'Врач не найден'}, status=400)
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    # Комментарий SSE: держит соединение живым через прокси
+                    yield ': ping\n\n'
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        finally:
+            broker.unsubscribe(subscription)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
-    # ✅ Сортируем по времени
-    scheduled = appointments.filter(status='scheduled').order_by('date_time')
-    waiting = appointments.filter(status='waiting').order_by('date_time')
-    active = appointments.filter(status='active').order_by('date_time')
-    completed = appointments.filter(status='completed').order_by('date_time')
 
-    data = {
-        'scheduled': [{
-            'id': a.id,
-            'patient_name': a.patient.get_full_name(),
-            'time': a.get_time_slot_display(),
-            'doctor_name': a.doctor.get_full_name()
-        } for a in scheduled],
-        'waiting': [{
-            'id': a.id,
-            'patient_name': a.patient.get_full_name(),
-            'doctor_name': a.doctor.get_full_name()
-        } for a in waiting],
-        'active': [{
-            'id': a.id,
-            'patient_name': a.patient.get_full_name(),
-            'doctor_name': a.doctor.get_full_name()
-        } for a in active],
-        'completed': [{
-            'id': a.id,
-            'patient_name': a.patient.get_full_name(),
-            'time': a.date_time.strftime('%H:%M'),
-            'doctor_name': a.doctor.get_full_name()
-        } for a in completed],
-    }
+@login_required
+def api_free_slots(request):
+    if not is_admin(request.user):
+        return JsonResponse({'error': 'Доступ запрещён'}, status=403)
 
-    return JsonResponse(data)
+    try:
+        duration = int(request.GET.get('duration', 30))
+        limit = max(1, min(int(request.GET.get('limit', 10)), 100))
+        doctor_id = int(request.GET['doctor_id']) if request.GET.get('doctor_id') else None
+    except ValueError:
+        return JsonResponse({'error': 'Неверные параметры'}, status=400)
+    if duration < SLOT_MINUTES or duration % SLOT_MINUTES != 0:
+        return JsonResponse({'error': 'Длительность должна быть кратна 10 минутам'}, status=400)
+
+    start_str = request.GET.get('start_date', '')
+    end_str = request.GET.get('end_date', '')
+    try:
+        start_date = datetime.strptime(start_str, '%Y-%m-%d').date() if start_str else timezone.localdate()
+        end_date = datetime.strptime(end_str, '%Y-%m-%d').date() if end_str else start_date + timedelta(days=30)
+    except ValueError:
+        return JsonResponse({'error': 'Неверный формат даты'}, status=400)
+    start_date = max(start_date, timezone.localdate())
+    if end_date < start_date or (end_date - start_date).days > 92:
+        return JsonResponse({'error': 'Неверный диапазон дат (не более 3 месяцев)'}, status=400)
+
+    doctors = Doctor.objects.filter(is_active=True).select_related('user')
+    if doctor_id:
+        doctors = doctors.filter(id=doctor_id)
+    specialty = request.GET.get('specialty', '').strip().casefold()
+    if specialty:
+        # iexact в SQLite не меняет регистр кириллицы — сравниваем в Python (активных врачей немного)
+        doctors = [doctor for doctor in doctors if doctor.specialty.strip().casefold() == specialty]
+
+    slots = find_free_slots(doctors, start_date, end_date, duration, limit=limit)
+    return JsonResponse(slots, safe=False)
+
+
+# --- PERSONNEL ---
+@login_required
+def api_personnel(request):
+    """Весь персонал: ?role=doctor,nurse,receptionist&q=...&cursor=...&limit=50"""
+    if not is_admin(request.user):
+        return JsonResponse({'error': 'Доступ запрещён'}, status=403)
+    try:
+        cursor, limit = _cursor_params(request)
+        data = load_personnel(
+            roles=_split_param(request, 'role'),
+            query=request.GET.get('q', '').strip(),
+            cursor=cursor,
+            limit=limit,
+        )
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return json_response(data)
 
 
 # --- DOCTOR ---
@@ -416,18 +533,11 @@ def api_schedule_by_date_and_doctor(request):
 def api_doctors_list(request):
     if not is_admin(request.user):
         return JsonResponse({'error': 'Доступ запрещён'}, status=403)
-    doctors = Doctor.objects.all()
-    data = []
-    for d in doctors:
-        data.append({
-            'id': d.id,
-            'full_name': d.get_full_name(),
-            'specialty': d.specialty,
-            'room': d.room,
-            'is_active': d.is_active,
-            'user_username': d.user.username
-        })
-    return JsonResponse(data, safe=False)
+    try:
+        cursor, limit = _cursor_params(request)
+        return _json_list(*staff_list('doctor', cursor=cursor, limit=limit))
+    except CursorError as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
 
 @csrf_exempt
@@ -511,15 +621,9 @@ def api_doctor_delete(request, pk):
 def api_doctor_detail(request, pk):
     if not is_admin(request.user):
         return JsonResponse({'error': 'Доступ запрещён'}, status=403)
-    doctor = get_object_or_404(Doctor, pk=pk)
-    data = {
-        'id': doctor.id,
-        'full_name': doctor.get_full_name(),
-        'specialty': doctor.specialty,
-        'room': doctor.room,
-        'is_active': doctor.is_active,
-        'user_username': doctor.user.username
-    }
+    data = staff_detail('doctor', pk)
+    if data is None:
+        raise Http404
     return JsonResponse(data)
 
 
@@ -535,18 +639,11 @@ def nurse_dashboard(request):
 def api_nurses_list(request):
     if not is_admin(request.user):
         return JsonResponse({'error': 'Доступ запрещён'}, status=403)
-    nurses = Nurse.objects.all()
-    data = []
-    for n in nurses:
-        data.append({
-            'id': n.id,
-            'full_name': n.get_full_name(),
-            'department': n.department,
-            'room': n.room,
-            'is_active': n.is_active,
-            'user_username': n.user.username
-        })
-    return JsonResponse(data, safe=False)
+    try:
+        cursor, limit = _cursor_params(request)
+        return _json_list(*staff_list('nurse', cursor=cursor, limit=limit))
+    except CursorError as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
 
 @csrf_exempt
@@ -631,15 +728,9 @@ def api_nurse_delete(request, pk):
 def api_nurse_detail(request, pk):
     if not is_admin(request.user):
         return JsonResponse({'error': 'Доступ запрещён'}, status=403)
-    nurse = get_object_or_404(Nurse, pk=pk)
-    data = {
-        'id': nurse.id,
-        'full_name': nurse.get_full_name(),
-        'department': nurse.department,
-        'room': nurse.room,
-        'is_active': nurse.is_active,
-        'user_username': nurse.user.username
-    }
+    data = staff_detail('nurse', pk)
+    if data is None:
+        raise Http404
     return JsonResponse(data)
 
 
@@ -655,17 +746,11 @@ def reception_dashboard(request):
 def api_receptionists_list(request):
     if not is_admin(request.user):
         return JsonResponse({'error': 'Доступ запрещён'}, status=403)
-    receptionists = Receptionist.objects.all()
-    data = []
-    for r in receptionists:
-        data.append({
-            'id': r.id,
-            'full_name': r.get_full_name(),
-            'office': r.office,
-            'is_active': r.is_active,
-            'user_username': r.user.username
-        })
-    return JsonResponse(data, safe=False)
+    try:
+        cursor, limit = _cursor_params(request)
+        return _json_list(*staff_list('receptionist', cursor=cursor, limit=limit))
+    except CursorError as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
 
 @csrf_exempt
@@ -746,14 +831,9 @@ def api_receptionist_delete(request, pk):
 def api_receptionist_detail(request, pk):
     if not is_admin(request.user):
         return JsonResponse({'error': 'Доступ запрещён'}, status=403)
-    receptionist = get_object_or_404(Receptionist, pk=pk)
-    data = {
-        'id': receptionist.id,
-        'full_name': receptionist.get_full_name(),
-        'office': receptionist.office,
-        'is_active': receptionist.is_active,
-        'user_username': receptionist.user.username
-    }
+    data = staff_detail('receptionist', pk)
+    if data is None:
+        raise Http404
     return JsonResponse(data)
 
 
@@ -762,8 +842,31 @@ def api_receptionist_detail(request, pk):
 def documents_view(request):
     if not is_admin(request.user):
         return redirect('access_denied')
-    documents = Document.objects.all().order_by('-created_at')
-    return render(request, 'documents.html', {'documents': documents})
+    return _list_page(request, 'documents.html', 'documents', Document.objects.all(), DOCUMENT_ORDERING,
+                      descending=True)
+
+
+def _document_data(doc):
+    return {
+        'id': doc.id,
+        'title': doc.title,
+        'description': doc.description,
+        'filename': doc.filename,
+        'file_url': reverse('document_download', args=[doc.id]) if doc.file else None,
+        'created_at': doc.created_at.strftime('%d.%m.%Y %H:%M')
+    }
+
+
+def _save_document(request, doc):
+    """Сохраняет документ с файлом: завершённая загрузка (upload) или файл формы (file)"""
+    upload_id = request.POST.get('upload')
+    file = request.FILES.get('file')
+    if upload_id:
+        attach_upload(doc, upload_id)
+    elif file:
+        attach_file(doc, file)
+    else:
+        doc.save()
 
 
 @csrf_exempt
@@ -772,26 +875,23 @@ def api_document_create(request):
     if not is_admin(request.user):
         return JsonResponse({'error': 'Доступ запрещён'}, status=403)
     try:
-        title = request.POST.get('title')
-        description = request.POST.get('description', '')
-        file = request.FILES.get('file')
-
-        doc = Document.objects.create(
-            title=title,
-            description=description,
-            file=file
-        )
-        return JsonResponse({
-            'id': doc.id,
-            'title': doc.title,
-            'description': doc.description,
-            'file_url': doc.file.url if doc.file else None,
-            'created_at': doc.created_at.strftime('%d.%m.%Y %H:%M')
-        })
+        doc = Document(title=request.POST.get('title'), description=request.POST.get('description', ''))
+        _save_document(request, doc)
+        return JsonResponse(_document_data(doc))
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
 
 
+@require_http_methods(["GET", "HEAD"])
+@login_required
+def document_download(request, pk):
+    """Файл документа: Range, ETag/Last-Modified и 304; ?download=1 — сохранить как файл"""
+    if not is_admin(request.user):
+        return JsonResponse({'error': 'Доступ запрещён'}, status=403)
+    document = get_object_or_404(Document.objects.select_related('blob'), pk=pk)
+    return document_response(request, document, as_attachment=request.GET.get('download') == '1')
+
+
 @login_required
 def api_document_delete(request, pk):
     if not is_admin(request.user):
@@ -811,87 +911,112 @@ def api_document_update(request, pk):
         return JsonResponse({'error': 'Доступ запрещён'}, status=403)
     try:
         doc = get_object_or_404(Document, pk=pk)
-        title = request.POST.get('title')
-        description = request.POST.get('description', '')
-        file = request.FILES.get('file')
-
-        doc.title = title
-        doc.description = description
-        if file:
-            doc.file = file
-        doc.save()
+        doc.title = request.POST.get('title')
+        doc.description = request.POST.get('description', '')
+        _save_document(request, doc)
+        return JsonResponse(_document_data(doc))
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
-        return JsonResponse({
-            'id': doc.id,
-            'title': doc.title,
-            'description': doc.description,
-            'file_url': doc.file.url if doc.file else None,
-            'created_at': doc.created_at.strftime('%d.%m.%Y %H:%M')
-        })
+
+def _upload_error(e):
+    return JsonResponse({'error': str(e), 'offset': e.offset}, status=e.status)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@login_required
+def api_upload_start(request):
+    """Начало загрузки частями: {"filename": "...", "size": байты}"""
+    if not is_admin(request.user):
+        return JsonResponse({'error': 'Доступ запрещён'}, status=403)
+    try:
+        data = json.loads(request.body)
+        upload = start_upload(data.get('filename'), data.get('size'), user=request.user)
+        return JsonResponse(describe(upload), status=201)
+    except UploadError as e:
+        return _upload_error(e)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
 
 
-# СТАТИСТИКА
+@csrf_exempt
+@require_http_methods(["GET", "PUT"])
 @login_required
-def stats_full_view(request):
+def api_upload(request, pk):
+    """GET — сколько получено; PUT — часть файла (тело — байты, заголовок Content-Range)"""
     if not is_admin(request.user):
-        return redirect('access_denied')
-    return render(request, 'stats_full.html')
+        return JsonResponse({'error': 'Доступ запрещён'}, status=403)
+    try:
+        if request.method == 'PUT':
+            # Тело читается потоком: request.body не трогаем, чтобы часть не копилась в памяти
+            write_chunk(
+                pk, request, request.headers.get('Content-Range'),
+                int(request.META.get('CONTENT_LENGTH') or 0),
+            )
+        return JsonResponse(describe(get_upload(pk)))
+    except UploadError as e:
+        return _upload_error(e)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
 
+@csrf_exempt
+@require_http_methods(["POST"])
 @login_required
-def api_stats_data(request):
+def api_upload_complete(request, pk):
+    """Завершение загрузки: {"sha256": "..."} (необязательно) — файл переносится в хранилище"""
     if not is_admin(request.user):
         return JsonResponse({'error': 'Доступ запрещён'}, status=403)
+    try:
+        data = json.loads(request.body) if request.content_type == 'application/json' and request.body else {}
+        upload, created = complete_upload(pk, data.get('sha256'))
+        return JsonResponse({**describe(upload), 'sha256': upload.blob.sha256, 'deduplicated': not created})
+    except UploadError as e:
+        return _upload_error(e)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
-    # ✅ Исправлено: startDate → start_date (нет, наоборот!)
-    start_date_str = request.GET.get('startDate')  # ✅
-    end_date_str = request.GET.get('endDate')      # ✅
 
-    if start_date_str:
-        start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
-    else:
-        start_date = datetime.now() - timedelta(days=30)
+# СТАТИСТИКА
+@login_required
+def stats_full_view(request):
+    if not is_admin(request.user):
+        return redirect('access_denied')
+    return render(request, 'stats_full.html')
 
-    if end_date_str:
-        end_date = datetime.strptime(end_date_str, '%Y-%m-%d')
-    else:
-        end_date = datetime.now()
+def _stats_data(start_date, end_date):
+    # Суммы по дневным сводкам (rollups.py) за дни [start_date, end_date]
+    days = {'day__gte': start_date, 'day__lte': end_date}
 
-    # 1. Пациенты по месяцам
+    # 1. Пациенты по месяцам (уникальные в пределах месяца)
     patients_by_month = (
-        Patient.objects.filter(
-            appointments__date_time__range=[start_date, end_date]
-        )
-        .annotate(month=TruncMonth('appointments__date_time'))
+        PatientDayStats.objects.filter(visits__gt=0, **days)
+        .annotate(month=TruncMonth('day'))
         .values('month')
-        .annotate(count=Count('id', distinct=True))
+        .annotate(count=Count('patient_id', distinct=True))
         .order_by('month')
     )
 
     # 2. Записи по врачам
     appointments_by_doctor = (
-        Appointment.objects.filter(
-            date_time__range=[start_date, end_date]
-        )
+        AppointmentDayStats.objects.filter(visits__gt=0, **days)
         .values('doctor__user__last_name', 'doctor__user__first_name')
-        .annotate(count=Count('id'))
+        .annotate(count=Sum('visits'))
         .order_by('-count')
     )
 
     # 3. Прибыль по услугам
     revenue_by_service = (
-        InvoiceService.objects.filter(
-            invoice__appointment__date_time__range=[start_date, end_date]
-        )
+        ServiceDayStats.objects.filter(quantity__gt=0, **days)
         .values('service__name')
-        .annotate(total=Sum(F('price_at_time') * F('quantity')))
+        .annotate(total=Sum('revenue'))
         .order_by('-total')
     )
 
-    data = {
+    return {
         'patients_by_month': [
-            {'month': str(item['month'].date()), 'count': item['count']} for item in patients_by_month
+            {'month': str(item['month']), 'count': item['count']} for item in patients_by_month
         ],
         'appointments_by_doctor': list(appointments_by_doctor),
         'revenue_by_service': [
@@ -902,8 +1027,133 @@ def api_stats_data(request):
         ]
     }
 
+
+@login_required
+def api_stats_data(request):
+    if not is_admin(request.user):
+        return JsonResponse({'error': 'Доступ запрещён'}, status=403)
+
+    # ✅ Исправлено: startDate → start_date (нет, наоборот!)
+    start_date_str = request.GET.get('startDate')  # ✅
+    end_date_str = request.GET.get('endDate')      # ✅
+
+    today = timezone.localdate()
+    try:
+        start_date = date.fromisoformat(start_date_str) if start_date_str else today - timedelta(days=30)
+        end_date = date.fromisoformat(end_date_str) if end_date_str else today
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    data = cached_stats('stats_data', start_date, end_date, lambda: _stats_data(start_date, end_date))
     return JsonResponse(data)
 
+
+def _split_param(request, name):
+    value = request.GET.get(name, '')
+    return [item for item in value.split(',') if item]
+
+
+@csrf_exempt
+@login_required
+def api_stats_cube(request):
+    """
+    Куб статистики.
+    GET ?start=&end=&measures=visits,revenue&dimensions=month,doctor&doctor=1,2&specialty=&service=&status=
+    POST {"start", "end", "filters", "queries": {"имя": {"measures", "dimensions", "filters"}}} —
+    все графики страницы одним запросом.
+    """
+    if not is_admin(request.user):
+        return JsonResponse({'error': 'Доступ запрещён'}, status=403)
+    try:
+        if request.method == 'POST':
+            data = json.loads(request.body)
+        else:
+            data = {
+                'start': request.GET.get('start'),
+                'end': request.GET.get('end'),
+                'filters': {name: _split_param(request, name) for name in ('doctor', 'specialty', 'service', 'status')},
+                'queries': {'rows': {
+                    'measures': _split_param(request, 'measures'),
+                    'dimensions': _split_param(request, 'dimensions'),
+                }},
+            }
+
+        today = timezone.localdate()
+        start_date = date.fromisoformat(data['start']) if data.get('start') else today - timedelta(days=30)
+        end_date = date.fromisoformat(data['end']) if data.get('end') else today
+        filters = data.get('filters') or {}
+
+        result = {}
+        for name, query in data['queries'].items():
+            cube = {
+                'measures': list(query.get('measures') or []),
+                'dimensions': list(query.get('dimensions') or []),
+                'filters': {**filters, **(query.get('filters') or {})},
+            }
+            result[name] = cached_stats(
+                ['cube', cube], start_date, end_date, lambda: run_cube(start_date, end_date, **cube)
+            )
+        return JsonResponse(result)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+
+@login_required
+def api_export(request, dataset):
+    """
+    Потоковая выгрузка: /api/export/<appointments|invoices|patients>/?format=csv|xlsx
+    Фильтры как у статистики: startDate, endDate, doctor_id, status (через запятую)
+    """
+    if not is_admin(request.user):
+        return JsonResponse({'error': 'Доступ запрещён'}, status=403)
+    file_format = request.GET.get('format', 'csv')
+    if dataset not in DATASETS or file_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': 'Неизвестный набор данных или формат'}, status=400)
+    try:
+        start_date_str = request.GET.get('startDate')
+        end_date_str = request.GET.get('endDate')
+        filters = {
+            'start': date.fromisoformat(start_date_str) if start_date_str else None,
+            'end': date.fromisoformat(end_date_str) if end_date_str else None,
+            'doctor_id': int(request.GET['doctor_id']) if request.GET.get('doctor_id') else None,
+            'statuses': _split_param(request, 'status'),
+        }
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    response = StreamingHttpResponse(
+        stream_export(dataset, file_format, **filters), content_type=EXPORT_CONTENT_TYPES[file_format]
+    )
+    filename = f"{dataset}_{timezone.localdate():%Y-%m-%d}.{file_format}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@login_required
+def api_import(request, dataset):
+    """
+    Массовый импорт: /api/import/<patients|appointments>/, файл в поле file (CSV или JSONL).
+    Ответ — отчёт: сколько создано и ошибки по номерам строк.
+    """
+    if not is_admin(request.user):
+        return JsonResponse({'error': 'Доступ запрещён'}, status=403)
+    upload = request.FILES.get('file')
+    if dataset not in IMPORTERS or upload is None:
+        return JsonResponse({'error': 'Неизвестный набор данных или не передан файл'}, status=400)
+    file_format = request.POST.get('format') or upload.name.rsplit('.', 1)[-1].lower()
+    if file_format not in IMPORT_FORMATS:
+        return JsonResponse({'error': 'Формат файла: csv или jsonl'}, status=400)
+    try:
+        # Загруженный файл читается построчно, без чтения целиком в память
+        stream = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+        report = run_import(dataset, stream, file_format)
+        return JsonResponse(report.as_dict())
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+
 # Добавление пациента
 @csrf_exempt
 @login_required
@@ -964,8 +1214,8 @@ def api_appointment_create(request):
         # ✅ Делаем aware
         aware_dt = timezone.make_aware(naive_dt)
 
-        # Создаём запись
-        appointment = Appointment.objects.create(
+        # Создаём запись (проверка пересечений и вставка под блокировкой врача на день)
+        appointment = book_appointment(
             patient=patient,
             doctor=doctor,
             date_time=aware_dt,
@@ -995,28 +1245,68 @@ def api_appointment_update_status(request, pk):
         return JsonResponse({'error': 'Доступ запрещён'}, status=403)
     try:
         data = json.loads(request.body)
-        new_status = data['status']
-
-        # Проверяем, что статус допустим
-        valid_statuses = ['scheduled', 'waiting', 'active', 'completed']
-        if new_status not in valid_statuses:
-            return JsonResponse({'error': 'Недопустимый статус'}, status=400)
+        # Переход по машине состояний одним условным UPDATE; from — статус, который видел клиент
+        result = change_status(
+            pk, data['status'],
+            expected=data.get('from'),
+            cancel_reason_type=data.get('cancel_reason_type'),
+            cancel_reason=data.get('cancel_reason', ''),
+        )
+        broker.publish_appointment(pk, 'updated')
+        return JsonResponse({'success': True, **result})
+    except TransitionError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
-        # ✅ Обновляем статус напрямую, без валидации
-        rows_updated = Appointment.objects.filter(id=pk).update(status=new_status)
 
-        if rows_updated == 0:
-            return JsonResponse({'error': 'Запись не найдена'}, status=404)
+@csrf_exempt
+@require_http_methods(["POST"])
+@login_required
+def api_appointments_bulk_status(request):
+    """
+    Смена статуса нескольких записей: {"ids": [...], "status": "...", "cancel_reason_type": "...",
+    "cancel_reason": "...", "skip_invalid": false}. Пачка проверяется и применяется целиком.
+    """
+    if not is_admin(request.user):
+        return JsonResponse({'error': 'Доступ запрещён'}, status=403)
+    try:
+        data = json.loads(request.body)
+        ids = data['ids']
+        if not isinstance(ids, list) or not ids:
+            return JsonResponse({'error': 'Передайте непустой список ids'}, status=400)
+        if len(ids) > settings.APPOINTMENTS_BULK_LIMIT:
+            return JsonResponse({'error': f'Не больше {settings.APPOINTMENTS_BULK_LIMIT} записей за раз'}, status=400)
+        if data['status'] == 'cancelled' and not data.get('cancel_reason_type') and not data.get('cancel_reason'):
+            return JsonResponse({'error': 'Укажите причину отмены'}, status=400)
+        result = bulk_change_status(
+            ids, data['status'],
+            cancel_reason_type=data.get('cancel_reason_type'),
+            cancel_reason=data.get('cancel_reason', ''),
+            skip_invalid=bool(data.get('skip_invalid')),
+        )
+        broker.publish_appointments(result['updated'], 'updated')
+        return JsonResponse({'success': True, **result})
+    except BulkTransitionError as e:
+        return JsonResponse({'error': str(e), 'errors': e.errors}, status=e.status)
+    except TransitionError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
-        # Возвращаем обновлённые данные
-        appointment = Appointment.objects.get(id=pk)
 
-        return JsonResponse({
-            'success': True,
-            'id': appointment.id,
-            'status': appointment.status
-        })
-    except Appointment.DoesNotExist:
-        return JsonResponse({'error': 'Запись не найдена'}, status=404)
+@csrf_exempt
+@require_http_methods(["POST"])
+@login_required
+def api_close_day(request):
+    """Счета за завершённые приёмы дня без счёта: {"date": "ГГГГ-ММ-ДД"} (по умолчанию — сегодня)"""
+    if not is_admin(request.user):
+        return JsonResponse({'error': 'Доступ запрещён'}, status=403)
+    try:
+        data = json.loads(request.body) if request.body else {}
+        day = datetime.strptime(data['date'], '%Y-%m-%d').date() if data.get('date') else None
+        result = close_day(day, user=request.user)
+        result['final_amount'] = float(result['final_amount'])
+        return JsonResponse({'success': True, **result})
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)